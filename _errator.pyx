@@ -1,13 +1,49 @@
+from array import array
 from collections import deque, defaultdict
+from functools import partial
 import inspect
+import os
+import struct
 import sys
-from threading import Thread, current_thread
+from threading import Thread, Lock, current_thread, local
 from typing import Iterable
 import traceback
+from time import perf_counter_ns
 
 _default_options = {"auto_prune": True,
                     "check": False,
-                    "verbose": False}
+                    "verbose": False,
+                    "timing": False}
+
+# new threads' narrations start with the options in _default_options_items, which is
+# replaced whole rather than changed so one thread can read it while another changes the
+# defaults; _default_options is only changed through update_default_options()
+_default_options_items = tuple(_default_options.items())
+_options_lock = Lock()
+
+# _timing is set once any thread's narration has the timing option, so that until then
+# checking a thread's option costs a single test
+cdef bint _timing = False
+
+
+cdef void _note_timing(bint value):
+    global _timing
+    if value:
+        _timing = True
+
+
+def update_default_options(**options):
+    """
+    Change the options that narrations of threads started from now on will have; see
+    errator.set_default_options()
+    """
+    global _default_options_items
+    with _options_lock:
+        for name, value in options.items():
+            if value is not None:
+                _default_options[name] = bool(value)
+        _default_options_items = tuple(_default_options.items())
+        return dict(_default_options)
 
 
 class ErratorException(Exception):
@@ -17,9 +53,9 @@ class ErratorException(Exception):
 class ErratorDeque(deque):
 
     def __init__(self, iterable: Iterable = (), auto_prune: bool = None,
-                 check: bool = None, verbose:bool = None):
+                 check: bool = None, verbose:bool = None, timing: bool = None):
         super(ErratorDeque, self).__init__(iterable=iterable)
-        self.__dict__.update(_default_options)
+        self.__dict__.update(_default_options_items)
         if auto_prune is not None:
             self.auto_prune = bool(auto_prune)
 
@@ -29,6 +65,22 @@ class ErratorDeque(deque):
         if verbose is not None:
             self.verbose = bool(verbose)
 
+        if timing is not None:
+            self.timing = bool(timing)
+        _note_timing(self.timing)
+
+        # slot and call depth of this thread in the live table; see enable_live_table()
+        self.live_slot = -1
+        self.live_depth = 0
+        # the greatest number of fragments held at once; see stats()
+        self.peak_depth = 0
+        # fragments this thread has created and taken from its pools; see stats()
+        self.fragments_created = 0
+        self.fragments_reused = 0
+        # free fragments for reuse, by class; each thread has its own so that taking and
+        # returning them never contends with another thread
+        self.pools = defaultdict(list)
+
     def set_check(self, value):
         """
         sets the check flag to the provided boolean value
@@ -62,6 +114,18 @@ class ErratorDeque(deque):
             self.verbose = bool(value)
         return self
 
+    def set_timing(self, value):
+        """
+        sets the timing flag to the provided boolean value
+        :param value: interpreted as a boolean value for self.timing; if None don't
+            change
+        :return: self
+        """
+        if value is not None:
+            self.timing = bool(value)
+            _note_timing(self.timing)
+        return self
+
     def pop_until_true(self, f):
         """
         Performs pop(right) from the deque up to and including the element for which f
@@ -75,21 +139,646 @@ class ErratorDeque(deque):
 
         :param f: callable of one argument, an item on the deque. Returns True if the
             item is the last one to pop from the deque, False otherwise.
-        :return: None
+        :return: the number of elements popped
         """
+        cdef int popped = 0
         selfpop = self.pop
+        pools = self.pools
         while self and not f(self[-1]):
             inst = selfpop()
-            inst.__class__.return_instance(inst)
+            inst.__class__.return_instance(inst, pools)
+            popped += 1
         if self:
             inst = selfpop()
-            inst.__class__.return_instance(inst)
-        return
+            inst.__class__.return_instance(inst, pools)
+            popped += 1
+        return popped
+
+    def truncate(self, depth):
+        """
+        Removes all but the first depth fragments from the deque, returning them to the
+        thread's pools of free fragments
+
+        :param depth: the number of fragments to keep
+        :return: the number of fragments removed
+        """
+        cdef Py_ssize_t excess = len(self) - depth
+        if excess <= 0:
+            return 0
+        if depth == 0:
+            removed = list(self)
+            self.clear()
+        else:
+            selfpop = self.pop
+            removed = [selfpop() for _ in range(excess)]
+        pools = self.pools
+        for inst in removed:
+            inst.__class__.return_instance(inst, pools)
+        return excess
+
+
+class _PoolRelease(object):
+    # kept in a thread-local so that it's discarded when its thread ends, taking the
+    # thread's pooled fragments with it; the deque itself stays for get_narration()
+    __slots__ = ("pools",)
+
+    def __init__(self, pools):
+        self.pools = pools
+
+    def __del__(self):
+        self.pools.clear()
+
+
+_thread_state = local()
+
+
+class _ThreadNarrations(defaultdict):
+    def __missing__(self, key):
+        # setdefault() is atomic, so two threads can't both install a deque for a name
+        return self.setdefault(key, self.default_factory())
 
 
 # _thread_fragments is hashed by a thread's name and contains a deque NarrationFragment
 # for each frame in the thread's call path
-_thread_fragments = defaultdict(ErratorDeque)
+_thread_fragments = _ThreadNarrations(ErratorDeque)
+
+# the most free fragments of each class a thread keeps for reuse; deeper call paths
+# than this allocate the excess
+POOL_LIMIT = 64
+
+
+# Statistics on errator's own operation; see stats(). Orphaned fragments are ones left
+# on a deque above a fragment whose function or context completes normally, which happens
+# when an exception was handled without the narration being reset.
+# the metrics' format counters when reset_stats() was last called
+cdef unsigned long long _format_calls_reset = 0
+cdef unsigned long long _format_ns_reset = 0
+cdef unsigned long long _stack_walks = 0
+cdef unsigned long long _orphaned_fragments = 0
+cdef unsigned long long _observer_errors = 0
+
+
+cdef inline void _note_depth(d):
+    cdef Py_ssize_t depth = len(d)
+    if depth > d.peak_depth:
+        d.peak_depth = depth
+
+
+cdef inline void _note_pruned(int popped):
+    global _orphaned_fragments
+    if popped > 1:
+        _orphaned_fragments += popped - 1
+
+
+def stats():
+    """
+    Return counters describing errator's own operation; see errator.stats()
+    """
+    threads = {}
+    pool_sizes = {"NarrationFragment": 0, "NarrationFragmentContextManager": 0}
+    created = reused = 0
+    for name, d in list(_thread_fragments.items()):
+        threads[name] = {"depth": len(d), "peak_depth": d.peak_depth}
+        created += d.fragments_created
+        reused += d.fragments_reused
+        for cls, pool in list(d.pools.items()):
+            pool_sizes[cls.__name__] = pool_sizes.get(cls.__name__, 0) + len(pool)
+    return {"fragments_created": created,
+            "fragments_reused": reused,
+            "pool_sizes": pool_sizes,
+            "threads": threads,
+            "format_calls": _format_calls - _format_calls_reset,
+            "format_seconds": (_format_ns - _format_ns_reset) / 1e9,
+            "stack_walks": _stack_walks,
+            "orphaned_fragments": _orphaned_fragments,
+            "observer_errors": _observer_errors}
+
+
+def reset_stats():
+    """
+    Zero the counters returned by stats(); see errator.reset_stats()
+    """
+    global _format_calls_reset, _format_ns_reset
+    global _stack_walks, _orphaned_fragments, _observer_errors
+    # the format counters are shared with the metrics, which never go back
+    _format_calls_reset = _format_calls
+    _format_ns_reset = _format_ns
+    _stack_walks = _orphaned_fragments = _observer_errors = 0
+    for d in list(_thread_fragments.values()):
+        d.peak_depth = len(d)
+        d.fragments_created = d.fragments_reused = 0
+
+
+# Observers
+# Callables registered with add_observer() are called as fragment_observer(event,
+# fragment) at points in each fragment's life. The callables for each event are kept in
+# a tuple so notifying is a simple loop, and _observing is only True when some are
+# registered, so without observers the cost is a single test per event.
+OBSERVER_EVENTS = ("push", "pop", "raise", "passthru", "format")
+cdef bint _observing = False
+cdef tuple _on_push = (), _on_pop = (), _on_raise = (), _on_passthru = (), _on_format = ()
+_observer_registry = []
+_observer_lock = Lock()
+
+
+cdef void _notify(tuple callbacks, str event, fragment):
+    global _observer_errors
+    for callback in callbacks:
+        try:
+            callback(event, fragment)
+        except Exception:
+            # an observer mustn't disturb the code being narrated
+            _observer_errors += 1
+
+
+cdef void _rebuild_observers():
+    global _observing, _on_push, _on_pop, _on_raise, _on_passthru, _on_format
+    by_event = {e: tuple(cb for cb, events in _observer_registry if e in events)
+                for e in OBSERVER_EVENTS}
+    _on_push, _on_pop, _on_raise = by_event["push"], by_event["pop"], by_event["raise"]
+    _on_passthru, _on_format = by_event["passthru"], by_event["format"]
+    _observing = len(_observer_registry) != 0
+
+
+def add_observer(callback, events=None):
+    """
+    Register a callable to be told about fragment events; see errator.add_observer()
+    """
+    events = frozenset(OBSERVER_EVENTS if events is None else events)
+    unknown = events.difference(OBSERVER_EVENTS)
+    if unknown:
+        raise ErratorException("unknown observer events: {}".format(sorted(unknown)))
+    with _observer_lock:
+        _observer_registry.append((callback, events))
+        _rebuild_observers()
+
+
+def remove_observer(callback):
+    """
+    Unregister a callable registered with add_observer(); see errator.remove_observer()
+    """
+    with _observer_lock:
+        _observer_registry[:] = [(cb, e) for cb, e in _observer_registry
+                                 if cb is not callback]
+        _rebuild_observers()
+
+
+# Tags
+# Each distinct tag string is given a bit the first time it's seen, and a fragment's tags
+# are the bitwise OR of their bits, so filtering a narration by tags is an AND per
+# fragment. tag_mask() caches the mask of each collection of tags it's given, so tags
+# given to narrate(), narrate_cm() and get_narration() are only looked at once. Tags are
+# meant to come from a small fixed set; past TAG_LIMIT distinct tags, new ones are refused
+# rather than letting masks grow into ever larger ints.
+TAG_LIMIT = 256
+_tag_bits = {}
+_tag_names = []
+_tag_masks = {}
+_tags_lock = Lock()
+
+
+def tag_mask(tags):
+    """
+    Return the bit mask for an iterable of tag strings, giving any new tags a bit; raises
+    ErratorException if that would make more than TAG_LIMIT distinct tags
+    """
+    # lists are the usual unhashable argument; convert them up front
+    key = tuple(tags) if type(tags) is list else tags
+    try:
+        return _tag_masks[key]
+    except KeyError:
+        pass
+    except TypeError:
+        # some other unhashable iterable, such as a set
+        key = tuple(tags)
+        try:
+            return _tag_masks[key]
+        except KeyError:
+            pass
+    mask = 0
+    with _tags_lock:
+        for tag in key:
+            bit = _tag_bits.get(tag)
+            if bit is None:
+                if len(_tag_names) >= TAG_LIMIT:
+                    raise ErratorException("too many distinct tags; {} would be more than "
+                                           "{}. Tags should come from a small fixed set, "
+                                           "not be made from data such as ids"
+                                           .format(repr(tag), TAG_LIMIT))
+                bit = 1 << len(_tag_names)
+                _tag_bits[tag] = bit
+                _tag_names.append(tag)
+            mask |= bit
+        if len(_tag_masks) >= 4096:
+            # tags made up on the fly; don't let the cache grow without limit
+            _tag_masks.clear()
+        _tag_masks[key] = mask
+    return mask
+
+
+def tag_names(mask):
+    """
+    Return the frozenset of tag strings whose bits are set in mask
+    """
+    if not mask:
+        return _no_tags
+    return frozenset(name for i, name in enumerate(_tag_names[:mask.bit_length()])
+                     if mask >> i & 1)
+
+
+_no_tags = frozenset()
+
+
+# Call sites
+# Each use of narrate() is registered as a call site when the function is decorated, and
+# each use of narrate_cm() the first time it's needed. Sites are keyed by code rather than
+# by the objects given, which may be made for each use: a narrated function by its code
+# and text, a narrate_cm() callable by its code, and a narrate_cm() string by the line
+# it's used on. A site's id is its index in _sites, which holds (func_name, source_file,
+# text) tuples. Once SITE_LIMIT sites are registered, any more share one last site.
+SITE_LIMIT = 10000
+_OTHER_SITE = (None, None, "<other sites>")
+_sites = []
+_site_ids = {}
+_sites_lock = Lock()
+
+
+def _site_code(func):
+    # the code that identifies a callable: a partial's function's, an instance's
+    # __call__'s, or None for callables without any, such as builtins
+    while isinstance(func, partial):
+        func = func.func
+    code = getattr(func, "__code__", None)
+    if code is None:
+        code = getattr(getattr(type(func), "__call__", None), "__code__", None)
+    return code
+
+
+def _callable_key(func):
+    # never the callable itself, unless it's a class, so the registry keeps nothing alive
+    code = _site_code(func)
+    if code is not None:
+        return code
+    return func if isinstance(func, type) else type(func)
+
+
+def _register_site(key, func_name, source_file, text_or_func):
+    cdef int site_id
+    try:
+        return _site_ids[key]
+    except KeyError:
+        pass
+    if callable(text_or_func):
+        code = _site_code(text_or_func)
+        text = ("{} at line {}".format(code.co_name, code.co_firstlineno)
+                if code is not None else "<{}>".format(type(text_or_func).__name__))
+        if source_file is None and code is not None:
+            source_file = code.co_filename
+    else:
+        text = str(text_or_func)
+    with _sites_lock:
+        site_id = _site_ids.get(key, -1)
+        if site_id >= 0:
+            return site_id
+        site_id = len(_sites)
+        if site_id > SITE_LIMIT:
+            return SITE_LIMIT
+        if site_id == SITE_LIMIT:
+            _sites.append(_OTHER_SITE)
+        else:
+            _sites.append((func_name, source_file, text))
+            _site_ids[key] = site_id
+        if site_id >= _site_failures.shape[0]:
+            _grow_site_counters(2 * site_id)
+    if _live_table is not None:
+        _live_table.add_site(site_id, _sites[site_id])
+    return site_id
+
+
+cdef int _cm_site_id(text_or_func):
+    # only called while the with statement's frame is the innermost one outside errator,
+    # and that frame reports the with statement's line both on entry and on exit
+    if isinstance(text_or_func, str):
+        frame = _calling_frame()
+        code = frame.f_code
+        return _register_site(("narrate_cm", code, frame.f_lineno), code.co_name,
+                              code.co_filename, text_or_func)
+    return _register_site(("narrate_cm", _callable_key(text_or_func)), None, None,
+                          text_or_func)
+
+
+# Metrics
+# Failures are counted per call site in arrays indexed by site id, so counting is just an
+# increment; the arrays are replaced by larger copies as sites are registered. A
+# 'failure' is an exception leaving a site; 'raised' counts only the site nearest the
+# exception's origin. Nothing here is touched unless there's an exception or a fragment is
+# formatted. The increments aren't atomic, so without the GIL threads failing at once may
+# lose counts; the docs say the counts are approximate on free-threaded builds.
+cdef unsigned long long[::1] _site_failures = array("Q", bytes(8 * 256))
+cdef unsigned long long[::1] _site_raised = array("Q", bytes(8 * 256))
+cdef unsigned long long _format_errors = 0
+cdef unsigned long long _format_calls = 0
+cdef unsigned long long _format_ns = 0
+_exception_counts = {}
+
+
+# arrays that have been replaced by larger copies; on free-threaded builds they're kept
+# so that a thread still incrementing one of them never writes to freed memory. With the
+# GIL no thread can be part way through an increment, so they're freed at once.
+_retired_counters = []
+cdef bint _keep_retired = not getattr(sys, "_is_gil_enabled", lambda: True)()
+
+
+cdef unsigned long long[::1] _grown(unsigned long long[::1] counters, Py_ssize_t size):
+    cdef unsigned long long[::1] new = array("Q", bytes(8 * size))
+    new[:counters.shape[0]] = counters
+    if _keep_retired:
+        _retired_counters.append(counters)
+    return new
+
+
+cdef void _grow_site_counters(Py_ssize_t size):
+    # called with _sites_lock held
+    global _site_failures, _site_raised, _prof_calls, _prof_failures, _prof_self_ns
+    _site_failures = _grown(_site_failures, size)
+    _site_raised = _grown(_site_raised, size)
+    _prof_calls = _grown(_prof_calls, size)
+    _prof_failures = _grown(_prof_failures, size)
+    _prof_self_ns = _grown(_prof_self_ns, size)
+
+
+cdef inline void _count_failure(int site_id, bint raised, etype):
+    _site_failures[site_id] += 1
+    if raised:
+        _site_raised[site_id] += 1
+        _exception_counts[etype] = _exception_counts.get(etype, 0) + 1
+
+
+cdef inline void _count_format(unsigned long long start_ns, bint failed):
+    global _format_errors, _format_calls, _format_ns
+    _format_calls += 1
+    _format_ns += perf_counter_ns() - start_ns
+    if failed:
+        _format_errors += 1
+
+
+# Profiling
+# When enabled, each narrated call or context counts a call against its site, and the time
+# spent in errator's own code (excluding the decorated function or the body of the
+# context) is added to the site's self time.
+cdef bint _profiling = False
+cdef unsigned long long[::1] _prof_calls = array("Q", bytes(8 * 256))
+cdef unsigned long long[::1] _prof_failures = array("Q", bytes(8 * 256))
+cdef unsigned long long[::1] _prof_self_ns = array("Q", bytes(8 * 256))
+
+
+cdef inline void _profile_record(int site_id, long long self_ns, bint failed):
+    _prof_calls[site_id] += 1
+    _prof_self_ns[site_id] += self_ns
+    if failed:
+        _prof_failures[site_id] += 1
+
+
+def set_profiling(bint enabled):
+    global _profiling
+    _profiling = enabled
+
+
+def reset_profile():
+    with _sites_lock:
+        _prof_calls[:] = 0
+        _prof_failures[:] = 0
+        _prof_self_ns[:] = 0
+
+
+def profile_snapshot():
+    """
+    Return the profile counts of each site that has been called while profiling; see
+    errator.profile_data()
+    """
+    with _sites_lock:
+        sites = list(_sites)
+        calls = list(_prof_calls[:len(sites)])
+        failures = list(_prof_failures[:len(sites)])
+        self_ns = list(_prof_self_ns[:len(sites)])
+    return [(sites[i], calls[i], failures[i], self_ns[i]) for i in range(len(sites))
+            if calls[i]]
+
+
+def metrics_snapshot():
+    """
+    Return the current values of errator's failure metrics
+    :return: a dict with keys 'sites', a list of (site, failures, raised) tuples where
+        site is a (func_name, source_file, text) tuple, for sites with any failures;
+        'exceptions', a dict of exception type to the number of times it was raised from
+        a narrated site; 'format_errors', the number of times a fragment couldn't be
+        formatted; 'format_calls' and 'format_seconds', the number of times a fragment
+        was formatted and the total time taken to do so
+    """
+    with _sites_lock:
+        sites = list(_sites)
+        failures = list(_site_failures[:len(sites)])
+        raised = list(_site_raised[:len(sites)])
+    return {"sites": [(sites[i], failures[i], raised[i]) for i in range(len(sites))
+                      if failures[i]],
+            "exceptions": dict(_exception_counts),
+            "format_errors": _format_errors,
+            "format_calls": _format_calls,
+            "format_seconds": _format_ns / 1e9}
+
+
+# Live table
+# When enabled, each thread's stack of narrated calls is mirrored into a shared memory
+# mapping of a file so another process can see what each thread is in the middle of
+# without interrupting it. The mapping is an array of unsigned 32 bit words:
+#   header, LIVE_HEADER_WORDS words: magic, version, pid, max_threads, max_depth,
+#       words per thread slot, first word of the slots, first word of the sites region,
+#       number of words in the sites region, number of words of it used, number of sites
+#   thread slots, max_threads of them, each: in use flag, low and high words of the
+#       thread ident, call depth, LIVE_NAME_WORDS words of UTF-8 thread name, then
+#       max_depth site ids, outermost call first
+#   sites region: for each site, its id, a byte count, then that many bytes (padded to a
+#       whole word) of UTF-8 func_name, source_file and text separated by NULs
+# Pushes and pops are plain stores into the mapping; there is no locking between the
+# writer and readers, so a reader may see a stack that's in the middle of changing.
+LIVE_MAGIC = 0x4C525245
+LIVE_VERSION = 1
+LIVE_HEADER_WORDS = 16
+LIVE_SLOT_HEADER_WORDS = 12
+LIVE_NAME_WORDS = 8
+
+
+cdef class _LiveTable(object):
+    cdef public object mm
+    cdef unsigned int[::1] words
+    cdef public str path
+    cdef public int max_threads, max_depth
+    cdef int slot_words, slots_base, sites_base, sites_words
+    cdef object lock
+    cdef list slot_threads
+
+    def __init__(self, str path, int max_threads, int max_depth, int site_words):
+        import mmap
+        cdef int total
+        self.path = path
+        self.max_threads = max_threads
+        self.max_depth = max_depth
+        self.slot_words = LIVE_SLOT_HEADER_WORDS + max_depth
+        self.slots_base = LIVE_HEADER_WORDS
+        self.sites_base = self.slots_base + max_threads * self.slot_words
+        self.sites_words = site_words
+        total = self.sites_base + site_words
+        with open(path, "w+b") as f:
+            f.truncate(total * 4)
+            self.mm = mmap.mmap(f.fileno(), total * 4)
+        self.words = memoryview(self.mm).cast("I")
+        self.lock = Lock()
+        self.slot_threads = [None] * max_threads
+        header = [LIVE_MAGIC, LIVE_VERSION, os.getpid(), max_threads, max_depth,
+                  self.slot_words, self.slots_base, self.sites_base, site_words, 0, 0]
+        for i, v in enumerate(header):
+            self.words[i] = v
+
+    def add_site(self, int site_id, tuple site):
+        cdef int used, nwords, start
+        data = "\0".join("" if v is None else str(v) for v in site).encode("utf-8",
+                                                                         "replace")
+        nwords = (len(data) + 3) // 4
+        with self.lock:
+            used = self.words[9]
+            if used + 2 + nwords > self.sites_words:
+                return
+            start = self.sites_base + used
+            self.words[start] = site_id
+            self.words[start + 1] = len(data)
+            self.mm[(start + 2) * 4:(start + 2) * 4 + len(data)] = data
+            # publish the site only once it's completely written
+            self.words[10] = self.words[10] + 1
+            self.words[9] = used + 2 + nwords
+
+    def claim_slot(self, thread):
+        cdef int i, base
+        with self.lock:
+            for i in range(self.max_threads):
+                t = self.slot_threads[i]
+                if t is None or not t.is_alive():
+                    break
+            else:
+                return -2
+            self.slot_threads[i] = thread
+            base = self.slots_base + i * self.slot_words
+            ident = thread.ident or 0
+            name = thread.name.encode("utf-8", "replace")[:LIVE_NAME_WORDS * 4]
+            self.words[base + 3] = 0
+            self.words[base + 1] = ident & 0xFFFFFFFF
+            self.words[base + 2] = (ident >> 32) & 0xFFFFFFFF
+            self.mm[(base + 4) * 4:(base + 4 + LIVE_NAME_WORDS) * 4] = \
+                name.ljust(LIVE_NAME_WORDS * 4, b"\0")
+            self.words[base] = 1
+            return i
+
+    cdef inline void push(self, int slot, int depth, int site_id):
+        cdef int base = self.slots_base + slot * self.slot_words
+        if depth < self.max_depth:
+            self.words[base + LIVE_SLOT_HEADER_WORDS + depth] = site_id
+        self.words[base + 3] = depth + 1
+
+    cdef inline void set_depth(self, int slot, int depth):
+        self.words[self.slots_base + slot * self.slot_words + 3] = depth
+
+    def close(self):
+        self.words = None
+        self.mm.close()
+
+
+cdef bint _inspecting = False
+cdef _LiveTable _live_table = None
+
+
+def enable_live_table(str path, int max_threads, int max_depth, int site_words):
+    global _inspecting, _live_table
+    disable_live_table()
+    table = _LiveTable(path, max_threads, max_depth, site_words)
+    with _sites_lock:
+        sites = list(_sites)
+    for site_id, site in enumerate(sites):
+        table.add_site(site_id, site)
+    _live_table = table
+    _inspecting = True
+
+
+def disable_live_table():
+    global _inspecting, _live_table
+    cdef _LiveTable table = _live_table
+    _inspecting = False
+    _live_table = None
+    if table is not None:
+        table.close()
+    for d in list(_thread_fragments.values()):
+        d.live_slot = -1
+        d.live_depth = 0
+
+
+cdef int _live_push(frag_deque, int site_id):
+    # records a call to site_id; returns the depth to restore when the call finishes,
+    # or -1 if the call isn't being mirrored
+    cdef _LiveTable table = _live_table
+    cdef int slot, depth
+    if table is None:
+        return -1
+    slot = frag_deque.live_slot
+    if slot == -1:
+        slot = table.claim_slot(current_thread())
+        frag_deque.live_slot = slot
+    if slot < 0:
+        return -1
+    depth = frag_deque.live_depth
+    table.push(slot, depth, site_id)
+    frag_deque.live_depth = depth + 1
+    return depth
+
+
+cdef void _live_pop(frag_deque, int depth):
+    cdef _LiveTable table = _live_table
+    cdef int slot = frag_deque.live_slot
+    if table is None or slot < 0:
+        return
+    table.set_depth(slot, depth)
+    frag_deque.live_depth = depth
+
+
+cdef long long _deadline_ns(deadline) except -1:
+    if deadline is None:
+        return 0
+    if deadline <= 0:
+        raise ErratorException("deadline must be a positive number of seconds")
+    return max(<long long>(deadline * 1e9), 1)
+
+
+cdef str _format_elapsed(long long ns):
+    if ns >= 1000000000:
+        return "{:.1f}s".format(ns / 1e9)
+    if ns >= 1000000:
+        return "{:.1f}ms".format(ns / 1e6)
+    return "{:.0f}us".format(ns / 1e3)
+
+
+cdef _take_instance(cls, frag_deque, text_or_func, narrated_callable, tuple args,
+                    dict kwargs):
+    # a fragment from the calling thread's pool, or a new one if it's empty
+    cdef NarrationFragment inst
+    cdef list pool = frag_deque.pools[cls]
+    try:
+        inst = pool.pop()
+        inst.__init__(text_or_func, narrated_callable, *args, **kwargs)
+        frag_deque.fragments_reused += 1
+    except IndexError:
+        inst = cls(text_or_func, narrated_callable, *args, **kwargs)
+        frag_deque.fragments_created += 1
+        if getattr(_thread_state, "pool_release", None) is None:
+            # the first this thread has made; its pools are released when it ends
+            _thread_state.pool_release = _PoolRelease(frag_deque.pools)
+    return inst
 
 
 cdef class NarrationFragment(object):
@@ -102,7 +791,21 @@ cdef class NarrationFragment(object):
     cdef public int status
     cdef public str func_name, source_file
     cdef public int lineno
-    cdef public frozenset tags
+    # the bits of the fragment's tags; see tag_mask()
+    cdef public object tag_mask
+    cdef public int live_depth
+    # the call site of a narrated function, or -1; see tell_fragments()
+    cdef public int site_id
+    # perf_counter_ns() when pushed, if timing; elapsed ns when it failed, or -1
+    cdef public long long start_ns, elapsed_ns
+    cdef bint _elapsed_told
+    # perf_counter_ns() by which the call should have finished, or 0; see enable_watchdog()
+    cdef public long long deadline_ns
+    # the number of narrations attached to exceptions that include this fragment; while
+    # there are any it mustn't be reused. If it's returned meanwhile, the pools it's to
+    # go to once the last of them is gone
+    cdef public int pinned
+    cdef public object pinned_pools
     # CYTHON
 
     IN_PROCESS = 1
@@ -110,26 +813,30 @@ cdef class NarrationFragment(object):
     PASSEDTHRU_EXCEPTION = 3
     COMPLETED = 4
 
-    _free_instances = deque()
-
     _callable_id_to_filename = {}
 
-    _empty_set = frozenset()
-
 
     @classmethod
     def get_instance(cls, text_or_func, narrated_callable, *args, **kwargs):
-        cdef NarrationFragment inst
-        try:
-            inst = cls._free_instances.pop()
-            inst.__init__(text_or_func, narrated_callable, *args, **kwargs)
-        except IndexError:
-            inst = cls(text_or_func, narrated_callable, *args, **kwargs)
-        return inst
+        return _take_instance(cls, _thread_fragments[current_thread().name],
+                              text_or_func, narrated_callable, args, kwargs)
 
     @classmethod
-    def return_instance(cls, inst):
-        cls._free_instances.append(inst)
+    def return_instance(cls, inst, pools=None):
+        if pools is None:
+            pools = _thread_fragments[current_thread().name].pools
+        if inst.pinned:
+            # see _NarrationSnapshot; only this thread pins fragments, but a snapshot may
+            # unpin them from any thread
+            with _pins_lock:
+                if inst.pinned:
+                    inst.pinned_pools = pools
+                    return
+        # don't let pooled fragments keep the last call's arguments alive
+        inst.args = inst.kwargs = inst.calling = inst.text_or_func = None
+        pool = pools[cls]
+        if len(pool) < POOL_LIMIT:
+            pool.append(inst)
 
     def __init__(self, text_or_func, narrated_callable, *args, **kwargs):
         """
@@ -152,16 +859,39 @@ cdef class NarrationFragment(object):
         self.func_name = None
         self.source_file = None
         self.lineno = 0
-        self.tags = self._empty_set
+        self.tag_mask = 0
+        self.live_depth = -1
+        self.site_id = -1
+        self.start_ns = 0
+        self.elapsed_ns = -1
+        self._elapsed_told = False
+        self.deadline_ns = 0
+        self.pinned = 0
+        self.pinned_pools = None
+
+    property tags:
+        # the frozenset of the fragment's tag strings
+        def __get__(self):
+            return tag_names(self.tag_mask)
 
-    cpdef set_tags(self, tags: frozenset):
-        self.tags = tags
+        def __set__(self, tags):
+            self.tag_mask = tag_mask(tags)
+
+    cpdef set_tags(self, tags):
+        self.tag_mask = tag_mask(tags)
+
+    def set_deadline(self, deadline):
+        """
+        Set the number of seconds this context is expected to last at most; must be
+        called before the context is entered
+        """
+        self.deadline_ns = _deadline_ns(deadline)
 
-    cdef bint are_tags_disjoint(self, frozenset other_tags):
-        return self.tags.isdisjoint(other_tags)
+    cdef bint are_tags_disjoint(self, other_mask):
+        return not (self.tag_mask & other_mask)
 
     cdef bint any_tags(self):
-        return len(self.tags) != 0
+        return self.tag_mask != 0
 
     cpdef bint frame_describes_func(self, frame):
         """
@@ -182,20 +912,29 @@ cdef class NarrationFragment(object):
 
     @classmethod
     def clone(cls, NarrationFragment src):
-        cdef NarrationFragment new = cls(src.text_or_func, None,
-                                         *src.args if src.args is not None else (),
-                                         **src.kwargs if src.kwargs is not None else {})
+        # only NarrationFragment's __init__, as the rest is copied from src; a context
+        # manager's would walk the stack for func_name and source_file when verbose
+        cdef NarrationFragment new = cls.__new__(cls)
+        NarrationFragment.__init__(new, src.text_or_func, None,
+                                   *src.args if src.args is not None else (),
+                                   **src.kwargs if src.kwargs is not None else {})
         new.exception_text = src.exception_text
         new.calling = src.calling
         new.func_name = src.func_name
         new.source_file = src.source_file
         new.lineno = src.lineno
+        new.status = src.status
+        new.tag_mask = src.tag_mask
+        new.site_id = src.site_id
+        new.start_ns = src.start_ns
+        new.elapsed_ns = src.elapsed_ns
+        new._elapsed_told = src._elapsed_told
         return new
 
     cpdef str format(self, bint verbose=False, bint best_effort_return=False):
         cdef str result
         cdef str tale
-
+        cdef unsigned long long start_ns = perf_counter_ns()
         try:
             tale = (self.text_or_func(*self.args, **self.kwargs)
                     if callable(self.text_or_func)
@@ -203,6 +942,9 @@ cdef class NarrationFragment(object):
 
             self.args = self.kwargs = None
 
+            if self.elapsed_ns >= 0 and not self._elapsed_told:
+                tale = "{} (took {})".format(tale, _format_elapsed(self.elapsed_ns))
+                self._elapsed_told = True
             if self.exception_text:
                 tale = "{}, but {} was raised".format(tale, self.exception_text)
                 self.exception_text = None
@@ -219,7 +961,9 @@ cdef class NarrationFragment(object):
                                                             str(self.source_file))])
             else:
                 result = tale
+            _count_format(start_ns, False)
         except Exception as _:
+            _count_format(start_ns, True)
             if not best_effort_return:
                 raise
             etype, val, tb = sys.exc_info()
@@ -240,30 +984,100 @@ cdef class NarrationFragment(object):
                                  f"now continues")
             result = '\n'.join(nested_result)
 
+        if _observing:
+            _notify(_on_format, "format", self)
         return result
 
     cpdef str tell(self, verbose=False):
         cdef str tale = self.format(verbose=verbose, best_effort_return=True)
         return tale
 
+    cdef inline void note_elapsed(self):
+        if self.start_ns:
+            self.elapsed_ns = perf_counter_ns() - self.start_ns
+
     cpdef fragment_exception_text(self, etype, text):
         self.exception_text = "exception type: {}, value: '{}'".format(etype.__name__,
                                                                        text)
 
 
+# guards the pinned and pinned_pools of every fragment
+_pins_lock = Lock()
+
+
+cdef class _NarrationSnapshot(object):
+    # the fragments of a thread's narration when an exception reached it; see
+    # errator.narration_of(). A cdef class's deallocator is cheaper than a finalizer
+    cdef public tuple fragments
+    cdef public bint verbose
+
+    def __dealloc__(self):
+        # fragments that have left their thread's narration meanwhile can be reused now
+        cdef NarrationFragment fragment
+        if self.fragments is None:
+            return
+        freed = []
+        with _pins_lock:
+            for fragment in self.fragments:
+                fragment.pinned -= 1
+                if not fragment.pinned and fragment.pinned_pools is not None:
+                    freed.append((fragment, fragment.pinned_pools))
+                    fragment.pinned_pools = None
+        for fragment, pools in freed:
+            fragment.__class__.return_instance(fragment, pools)
+
+
+cdef void _attach_narration(exc, frag_deque, NarrationFragment current):
+    # only the first narrated frame an exception reaches sees the whole narration; it may
+    # be raised again later from a frame that handled it. That frame's fragment is current
+    cdef NarrationFragment fragment
+    cdef _NarrationSnapshot snapshot
+    if getattr(exc, "_errator_narration", None) is not None:
+        return
+    snapshot = _NarrationSnapshot()
+    try:
+        exc._errator_narration = snapshot
+    except AttributeError:
+        # the exception doesn't take attributes, so there's nothing to build
+        return
+    snapshot.verbose = frag_deque.verbose
+    # the calls still in process and the one the exception is leaving, but not what's left
+    # of earlier failures that were handled without pruning the narration
+    chain = []
+    for fragment in frag_deque:
+        if fragment.status == NarrationFragment.IN_PROCESS or fragment is current:
+            chain.append(fragment)
+    snapshot.fragments = tuple(chain)
+    with _pins_lock:
+        for fragment in snapshot.fragments:
+            fragment.pinned += 1
+
+
+# modules whose frames are errator's own rather than its user's
+_errator_modules = frozenset(("errator", "_errator", "_errator_py"))
+
+
+def _calling_frame():
+    # the innermost frame that isn't in errator; this function has no frame of its own
+    f = sys._getframe(0)
+    while f.f_back is not None and f.f_globals.get("__name__") in _errator_modules:
+        f = f.f_back
+    return f
+
+
 cdef inline bint _pop_until_found_calling(item):
     return item.calling == item
 
 
 cdef class NarrationFragmentContextManager(NarrationFragment):
-    _free_instances = deque()
-
     def __init__(self, *args, **kwargs):
         super(NarrationFragmentContextManager, self).__init__(*args, **kwargs)
+        global _stack_walks
         if _thread_fragments[current_thread().name].verbose:
-            calling_frame = inspect.stack()[3]
-            self.func_name = calling_frame[3]
-            self.source_file = calling_frame[1]
+            _stack_walks += 1
+            code = _calling_frame().f_code
+            self.func_name = code.co_name
+            self.source_file = code.co_filename
 
     cpdef str format(self, bint verbose=False, bint best_effort_return=False):
         cdef str tale = super(NarrationFragmentContextManager,
@@ -273,16 +1087,54 @@ cdef class NarrationFragmentContextManager(NarrationFragment):
         parts = [" " * (i + 2) + parts[i] for i in range(len(parts))]
         return "\n".join(parts)
 
+    cdef int _site(self):
+        # found on first use and kept, as format() replaces text_or_func with its tale
+        if self.site_id < 0:
+            self.site_id = _cm_site_id(self.text_or_func)
+        return self.site_id
+
     def __enter__(self):
+        cdef long long start_ns = perf_counter_ns() if _profiling else 0
         cdef str tname = current_thread().name
-        _thread_fragments[tname].append(self)
+        d = _thread_fragments[tname]
+        d.append(self)
+        _note_depth(d)
         self.calling = self
+        if _timing and d.timing:
+            self.start_ns = perf_counter_ns()
+        if self.deadline_ns:
+            # until now this held the allowance given to set_deadline()
+            self.deadline_ns += perf_counter_ns()
+        if _inspecting:
+            self.live_depth = _live_push(d, self._site())
+        if _observing:
+            _notify(_on_push, "push", self)
+        if start_ns:
+            # the call is counted on exit
+            _prof_self_ns[self._site()] += perf_counter_ns() - start_ns
         return self
 
     def __exit__(self, exc_type, exc_val, _):
+        cdef long long start_ns
+        if not _profiling:
+            self._exit(exc_type, exc_val)
+            return
+        start_ns = perf_counter_ns()
+        # _exit() may return this fragment to the pool, which clears text_or_func
+        site_id = self._site()
+        try:
+            self._exit(exc_type, exc_val)
+        finally:
+            _profile_record(site_id, perf_counter_ns() - start_ns, exc_type is not None)
+
+    cdef _exit(self, exc_type, exc_val):
+        global _stack_walks
         cdef str tname = current_thread().name
 
         d = _thread_fragments[tname]
+        if self.live_depth >= 0:
+            _live_pop(d, self.live_depth)
+            self.live_depth = -1
         if exc_type is None:
             # then all went well; pop ourselves off the end
             self.status = self.COMPLETED
@@ -298,17 +1150,23 @@ cdef class NarrationFragmentContextManager(NarrationFragment):
                                            "line of the context".format(type(e), str(e),
                                                                         fname, lineno))
 
+            if _observing:
+                _notify(_on_pop, "pop", self)
             if d and d.auto_prune:
-                d.pop_until_true(_pop_until_found_calling)
+                _note_pruned(d.pop_until_true(_pop_until_found_calling))
             self.calling = None  # break ref cycle
         else:
+            self.note_elapsed()
             if d[-1] is self:
                 # this is where the exception was raised
                 self.fragment_exception_text(exc_type, str(exc_val))
                 self.status = self.RAISED_EXCEPTION
+                if exc_val is not None:
+                    _attach_narration(exc_val, d, self)
                 # the following code annotates fragments with stack trace information
                 # so if verbose output is requested it can be included
                 if d.verbose:
+                    _stack_walks += 1
                     tb = inspect.trace()
                     stack = inspect.stack()
                     stack.reverse()
@@ -323,8 +1181,17 @@ cdef class NarrationFragmentContextManager(NarrationFragment):
                         if sc:
                             deck[-1].annotate_fragment(sc[-1])
                             deckpop()
+                if _observing:
+                    _notify(_on_raise, "raise", self)
             else:
                 self.status = self.PASSEDTHRU_EXCEPTION
+                if exc_val is not None:
+                    # already done unless stale fragments sat above the frame that raised it
+                    _attach_narration(exc_val, d, self)
+                if _observing:
+                    _notify(_on_passthru, "passthru", self)
+            _count_failure(self._site(),
+                           self.status == self.RAISED_EXCEPTION, exc_type)
             try:
                 _ = self.format()
             except Exception as e:
@@ -337,7 +1204,7 @@ cdef class NarrationFragmentContextManager(NarrationFragment):
                                                             fname, lineno))
 
 
-def narrate(str_or_func, tags: Iterable[str] = None):
+def narrate(str_or_func, tags: Iterable[str] = None, deadline: float = None):
     """
     Decorator for functions or methods that add narration that can be recovered if the
     method raises an exception
@@ -362,28 +1229,56 @@ def narrate(str_or_func, tags: Iterable[str] = None):
         However, if the decorated function has changed the value of any of the arguments
         and these are in turn used in formatting the narration string, be aware that these
         may not be the values that were actually passed into the decorated function.
+    :param deadline: optional, float. If supplied, the number of seconds a call is
+        expected to take at most; calls still running after that are reported by the
+        watchdog (see enable_watchdog()).
     """
+    cdef long long deadline_ns = _deadline_ns(deadline)
+
     def capture_stanza(m):
         cdef str func_name = m.__name__, source_file = inspect.getsourcefile(m)
-        cdef frozenset the_tags = None
-
-        if tags is not None:
-            the_tags = frozenset(tags)
+        the_mask = tag_mask(tags) if tags is not None else 0
+        cdef int site_id = _register_site(
+            ("narrate", _callable_key(m),
+             str_or_func if isinstance(str_or_func, str) else _callable_key(str_or_func)),
+            func_name, source_file, str_or_func)
 
         def narrate_it(*args, **kwargs):
-            global current_thread
-            cdef NarrationFragment fragment = NarrationFragment.get_instance(str_or_func,
-                                                                             m, *args,
-                                                                             **kwargs)
-            if the_tags is not None:
-                fragment.set_tags(the_tags)
+            global current_thread, _stack_walks
+            cdef NarrationFragment fragment
+            cdef int live_depth = -1
+            # when profiling, prof_self accumulates errator's own time for this call
+            cdef long long prof_self = -1, prof_start = 0
+            if _profiling:
+                prof_start = perf_counter_ns()
+                prof_self = 0
+            frag_deque = _thread_fragments[current_thread().name]
+            fragment = _take_instance(NarrationFragment, frag_deque,
+                                      str_or_func, m, args, kwargs)
+            if the_mask:
+                fragment.tag_mask = the_mask
             fragment.func_name = func_name
             fragment.source_file = source_file
             fragment.calling = m
-            frag_deque = _thread_fragments[current_thread().name]
+            fragment.site_id = site_id
             frag_deque.append(fragment)
+            _note_depth(frag_deque)
+            if _timing and frag_deque.timing:
+                fragment.start_ns = perf_counter_ns()
+            if deadline_ns:
+                fragment.deadline_ns = perf_counter_ns() + deadline_ns
+            if _inspecting:
+                live_depth = _live_push(frag_deque, site_id)
+            if _observing:
+                _notify(_on_push, "push", fragment)
+            if prof_self >= 0:
+                prof_self = perf_counter_ns() - prof_start
             try:
                 _v = m(*args, **kwargs)
+                if prof_self >= 0:
+                    prof_start = perf_counter_ns()
+                if live_depth >= 0:
+                    _live_pop(frag_deque, live_depth)
                 fragment.status = fragment.COMPLETED
                 if frag_deque.check:
                     try:
@@ -392,19 +1287,31 @@ def narrate(str_or_func, tags: Iterable[str] = None):
                         raise ErratorException("Failed formatting the fragment for "
                                                "function {}; received exception "
                                                "{}, '{}'".format(m, type(e), str(e)))
+                if _observing:
+                    _notify(_on_pop, "pop", fragment)
                 if frag_deque and frag_deque.auto_prune:
-                    frag_deque.pop_until_true(lambda item: item.calling == m)
+                    _note_pruned(frag_deque.pop_until_true(lambda item: item.calling == m))
                 fragment = None
+                if prof_self >= 0:
+                    _profile_record(site_id, prof_self + perf_counter_ns() - prof_start,
+                                    False)
                 return _v
             except Exception as e:
+                if prof_self >= 0:
+                    prof_start = perf_counter_ns()
+                if live_depth >= 0:
+                    _live_pop(frag_deque, live_depth)
+                fragment.note_elapsed()
                 if fragment is frag_deque[-1]:
                     # only grab the exception text if this is the last fragment
                     # on the call chain
                     fragment.fragment_exception_text(e.__class__, str(e))
                     fragment.status = fragment.RAISED_EXCEPTION
+                    _attach_narration(e, frag_deque, fragment)
                     # the following code annotates fragments with stack trace information
                     # so if verbose output is requested it can be included
                     if frag_deque.verbose:
+                        _stack_walks += 1
                         tb = inspect.trace()
                         stack = inspect.stack()
                         stack.reverse()
@@ -418,14 +1325,28 @@ def narrate(str_or_func, tags: Iterable[str] = None):
                             if sc:
                                 deck[-1].annotate_fragment(sc[-1])
                                 deckpop()
+                    if _observing:
+                        _notify(_on_raise, "raise", fragment)
                 else:
                     fragment.status = fragment.PASSEDTHRU_EXCEPTION
+                    # already done unless stale fragments sat above the frame that raised it
+                    _attach_narration(e, frag_deque, fragment)
+                    if _observing:
+                        _notify(_on_passthru, "passthru", fragment)
+                _count_failure(site_id, fragment.status == fragment.RAISED_EXCEPTION,
+                               e.__class__)
                 try:
                     _ = fragment.format()  # get the formatted fragment right now!
                 except Exception as e:
+                    if prof_self >= 0:
+                        _profile_record(site_id,
+                                        prof_self + perf_counter_ns() - prof_start, True)
                     raise ErratorException("Failed formatting the fragment for "
                                            "function {}; received exception {}, '{}'".
                                            format(m, type(e), str(e)))
+                if prof_self >= 0:
+                    _profile_record(site_id, prof_self + perf_counter_ns() - prof_start,
+                                    True)
                 raise
 
         narrate_it.__name__ = m.__name__
@@ -435,8 +1356,23 @@ def narrate(str_or_func, tags: Iterable[str] = None):
     return capture_stanza
 
 
+cpdef list fragments_from_here(d):
+    """
+    Return the fragments of narration d from the last one that's IN_PROCESS to the end, or
+    an empty list if none are; the time taken is in proportion to the number returned
+    """
+    cdef list frags = []
+    cdef NarrationFragment nf
+    for nf in reversed(d):
+        frags.append(nf)
+        if nf.status == NarrationFragment.IN_PROCESS:
+            frags.reverse()
+            return frags
+    return []
+
+
 cpdef list get_narration(thread: Thread=None, bint from_here=False,
-                         with_tags: Iterable=None):
+                         with_tags: Iterable=None, int collapse=0):
     """
     Return a list of strings, each one a narration fragment in the function call path.
 
@@ -462,17 +1398,22 @@ cpdef list get_narration(thread: Thread=None, bint from_here=False,
         regardless of the tags supplied. Likewise, if no tags are supplied, then all
         narration fragments are returned. However, if an empty tag list is supplied,
         then no fragments will be returned.
+    :param collapse: int, optional, default 0. If greater than 0, then any run of more
+        than this many consecutive fragments from the same call site (as recursive
+        functions produce) is shown as its first and last fragments with a line between
+        them saying how many were left out; the fragments left out are never formatted.
     :return: list of formatted strings.
     """
-    cdef list l
+    cdef list l, frags
     cdef bint verbose
-    cdef frozenset tags = None
+    tags = None
     cdef NarrationFragment nf
 
     if with_tags is not None:
-        tags = frozenset(with_tags)
+        tags = tag_mask(with_tags)
+    me = current_thread()
     if thread is None:
-        thread = current_thread()
+        thread = me
     elif not isinstance(thread, Thread):
         raise ErratorException("the 'thread' argument isn't an instance "
                                "of Thread: {}".format(thread))
@@ -481,19 +1422,51 @@ cpdef list get_narration(thread: Thread=None, bint from_here=False,
         l = list()
     else:
         verbose = d.verbose
+        if thread is not me:
+            # the other thread may change or reuse its fragments while they're formatted
+            # here, so format copies of them instead
+            d = [f.__class__.clone(f) for f in d.copy()]
         if not from_here:
-            l = [nf.tell(verbose=verbose) for nf in d
-                 if tags is None or not nf.any_tags() or not nf.are_tags_disjoint(tags)]
+            frags = [nf for nf in d
+                     if tags is None or not nf.any_tags() or not nf.are_tags_disjoint(tags)]
         else:
-            # collect from the last IN_PROCESS fragment to the exception
-            l = list()
-            lappend = l.append
-            for i in range(-1, -1 * len(d) - 1, -1):
-                if d[i].status == NarrationFragment.IN_PROCESS:
-                    for j in range(i, 0, 1):
-                        nf = <NarrationFragment>d[j]
-                        if (tags is None or not nf.any_tags() or
-                                not nf.are_tags_disjoint(tags)):
-                            lappend(nf.tell(verbose=verbose))
-                    break
+            frags = [nf for nf in fragments_from_here(d)
+                     if tags is None or not nf.any_tags() or not nf.are_tags_disjoint(tags)]
+        l = tell_fragments(frags, verbose, collapse)
+    return l
+
+
+def _repeat_key(fragment):
+    # fragments of narrated functions are from the same site if their site ids match; for
+    # contexts, it's the same text, or the same callable if they haven't been formatted
+    if fragment.site_id >= 0:
+        return fragment.site_id
+    return fragment.text_or_func
+
+
+cpdef list tell_fragments(list frags, bint verbose, int collapse):
+    """
+    Return the told text of each fragment in frags; if collapse is greater than 0, then
+    runs of more than collapse consecutive fragments from the same site are told as their
+    first and last fragments and a line saying how many were left out, which are never
+    formatted. See get_narration().
+    """
+    cdef list l
+    cdef Py_ssize_t i = 0, j, n = len(frags)
+    if collapse <= 0:
+        return [nf.tell(verbose=verbose) for nf in frags]
+    l = []
+    while i < n:
+        key = _repeat_key(frags[i])
+        j = i + 1
+        while j < n and _repeat_key(frags[j]) == key:
+            j += 1
+        if j - i > collapse and j - i > 2:
+            l.append(frags[i].tell(verbose=verbose))
+            l.append("...repeated {} times (depth {}..{})...".format(j - i - 2, i + 2,
+                                                                    j - 1))
+            l.append(frags[j - 1].tell(verbose=verbose))
+        else:
+            l.extend([nf.tell(verbose=verbose) for nf in frags[i:j]])
+        i = j
     return l
@@ -0,0 +1,637 @@
+"""
+Benchmarks for errator
+
+    python benchmarks.py run [-o results.json] [--quick] [--only TEXT] [--set NAME=VALUE]
+    python benchmarks.py memory [-o results.json] [--quick] [--limit NAME=BYTES]
+    python benchmarks.py threads [-o results.json] [--quick] [--max-threads N]
+    python benchmarks.py compare baseline.json results.json [--threshold 0.1] [--relative]
+
+'run' times a set of scenarios and writes the results as JSON. Each scenario is a chain
+of nested calls, 'depth' deep, that's narrated according to the scenario's parameters
+(see PARAMETERS); the same chain without errator is timed alongside it, and the ratio of
+the two reported. The default suite is a base scenario plus, for each parameter, the
+scenarios varying just that parameter over its sweep values.
+
+'compare' matches the scenarios in two result files by name and flags any that are
+slower than the baseline by more than the threshold, exiting with status 1 if any are.
+
+'memory' uses tracemalloc to measure the memory errator holds: bytes per live fragment,
+the high-water mark of the pools of free fragments, memory retained after many narrated
+calls with and without exceptions, arguments kept alive after calls return, and memory
+left behind by threads that have finished. Each measurement has a limit (see
+MEMORY_LIMITS), and the command exits with status 1 if any is exceeded. Its results can
+also be given to 'compare'.
+
+'threads' runs narrated workloads on increasing numbers of threads at once, with and
+without exceptions, reporting calls per second per thread. Each thread checks that the
+narrations it retrieves are its own, and the command exits with status 1 if any aren't.
+It runs on interpreters with and without the GIL; which one was used is recorded in the
+results.
+"""
+from statistics import median
+import argparse
+import gc
+import json
+import platform
+import sys
+import threading
+import time
+import tracemalloc
+
+import errator
+from errator import (narrate, narrate_cm, get_narration, reset_narration,
+                     reset_all_narrations, set_narration_options, stats)
+
+# name: (base value, values swept in the default suite)
+PARAMETERS = {
+    # number of nested narrated calls
+    "depth": (10, (1, 10, 100, 1000)),
+    # fraction of top-level calls in which the innermost call raises an exception
+    "exception_rate": (0.0, (0.0, 0.01, 0.1, 1.0)),
+    # level that catches the exceptions; 0 is the caller of the outermost call
+    "catch_depth": (0, (0, 1, 5)),
+    # narration given as a 'string' or a 'callable'
+    "narration": ("string", ("string", "callable")),
+    "tags": (False, (False, True)),
+    "verbose": (False, (False, True)),
+    "check": (False, (False, True)),
+    "auto_prune": (True, (True, False)),
+    # 'narrate' decorates each call; 'narrate_cm' puts its body in a context
+    "style": ("narrate", ("narrate", "narrate_cm")),
+    # get_narration(from_here=...) when an exception is caught
+    "from_here": (False, (False, True)),
+}
+
+# parameters that only make a difference when there are exceptions are swept with these
+# values of other parameters
+SWEEP_WITH = {name: {"exception_rate": 0.1}
+              for name in ("catch_depth", "narration", "verbose", "from_here")}
+
+
+def scenario_name(params: dict) -> str:
+    return ",".join("{}={}".format(k, params[k]) for k in PARAMETERS)
+
+
+def default_suite(overrides: dict = None) -> list:
+    """
+    Return the default list of scenarios, each a dict of parameters
+    :param overrides: optional, dict of parameter values that replace the base values
+        and aren't swept
+    """
+    overrides = overrides or {}
+    base = {k: v[0] for k, v in PARAMETERS.items()}
+    base.update(overrides)
+    suite, seen = [], set()
+    for name, (_, sweep) in PARAMETERS.items():
+        if name in overrides:
+            sweep = (overrides[name],)
+        for value in sweep:
+            params = dict(base, **{name: value})
+            for other, other_value in SWEEP_WITH.get(name, {}).items():
+                if other not in overrides:
+                    params[other] = other_value
+            if params["catch_depth"] > params["depth"]:
+                continue
+            key = scenario_name(params)
+            if key not in seen:
+                seen.add(key)
+                suite.append(params)
+    return suite
+
+
+class Chain(object):
+    """
+    A chain of nested calls set up according to a scenario's parameters; call run() once
+    per top-level call
+    """
+    def __init__(self, params: dict, narrated: bool = True):
+        self.params = params
+        self.narrated = narrated
+        self.depth = params["depth"]
+        self.catch_depth = params["catch_depth"]
+        self.from_here = params["from_here"]
+        self.rate = params["exception_rate"]
+        self.calls = 0
+        tags = ["bench"] if params["tags"] else None
+        if params["narration"] == "callable":
+            text = lambda level, *_: "calling level {}".format(level)
+        else:
+            text = "calling a level"
+        if not narrated:
+            self.level = self._plain_level
+        elif params["style"] == "narrate":
+            self.level = narrate(text, tags=tags)(self._plain_level)
+        else:
+            def cm_level(level, fail):
+                with narrate_cm(text, level, tags=tags):
+                    return self._plain_level(level, fail)
+            self.level = cm_level
+
+    def _plain_level(self, level: int, fail: bool):
+        if level == self.depth:
+            if fail:
+                raise ValueError("bottom of the chain")
+            return level
+        if level == self.catch_depth:
+            try:
+                return self.level(level + 1, fail)
+            except ValueError:
+                self.caught()
+                return None
+        return self.level(level + 1, fail)
+
+    def caught(self):
+        if self.narrated:
+            _ = get_narration(from_here=self.from_here)
+            reset_narration(from_here=True)
+
+    def run(self):
+        self.calls += 1
+        fail = int(self.calls * self.rate) != int((self.calls - 1) * self.rate)
+        if self.catch_depth == 0:
+            try:
+                self.level(1, fail)
+            except ValueError:
+                self.caught()
+        else:
+            self.level(1, fail)
+        if self.narrated and not self.params["auto_prune"]:
+            reset_narration()
+
+
+def _time_chain(chain: Chain, number: int, repeat: int) -> list:
+    run = chain.run
+    per_call = []
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        for _ in range(number):
+            run()
+        per_call.append((time.perf_counter_ns() - start) / number)
+    return per_call
+
+
+def run_scenario(params: dict, number: int = None, repeat: int = 5) -> dict:
+    """
+    Time one scenario and its plain counterpart
+    :param params: dict of parameters; see PARAMETERS
+    :param number: optional, int. Top-level calls per timing; by default enough for
+        roughly 20000 narrated calls
+    :param repeat: int, optional, default 5. Number of timings; the median and minimum
+        are reported
+    :return: a dict of the results
+    """
+    if number is None:
+        number = max(20000 // params["depth"], 20)
+    reset_all_narrations()
+    set_narration_options(verbose=params["verbose"], check=params["check"],
+                          auto_prune=params["auto_prune"])
+    try:
+        narrated = Chain(params)
+        plain = Chain(params, narrated=False)
+        narrated.run()
+        plain.run()
+        times = _time_chain(narrated, number, repeat)
+        plain_times = _time_chain(plain, number, repeat)
+    finally:
+        set_narration_options(verbose=False, check=False, auto_prune=True)
+        reset_all_narrations()
+    ns, plain_ns = median(times), median(plain_times)
+    return {"name": scenario_name(params), "params": params, "number": number,
+            "repeat": repeat, "ns_per_call": ns, "min_ns_per_call": min(times),
+            "plain_ns_per_call": plain_ns, "ratio": ns / plain_ns if plain_ns else None}
+
+
+def environment() -> dict:
+    return {"python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(), "machine": platform.machine(),
+            "errator": errator.__version__, "backend": errator.BACKEND,
+            "time": time.time(),
+            "gil": _gil_enabled()}
+
+
+def _gil_enabled() -> bool:
+    is_gil_enabled = getattr(sys, "_is_gil_enabled", None)
+    return True if is_gil_enabled is None else is_gil_enabled()
+
+
+def run_suite(suite: list, number: int = None, repeat: int = 5, log=None) -> dict:
+    results = []
+    for params in suite:
+        result = run_scenario(params, number=number, repeat=repeat)
+        if log is not None:
+            log("{:>12.0f} ns {:>7.2f}x  {}".format(result["ns_per_call"],
+                                                    result["ratio"] or 0, result["name"]))
+        results.append(result)
+    return {"environment": environment(), "results": results}
+
+
+# Memory benchmarks
+# name: limit, in bytes, for the measurement of that name
+MEMORY_LIMITS = {
+    "live_fragment_bytes[narrate]": 1024,
+    "live_fragment_bytes[narrate_cm]": 1024,
+    "pooled_fragment_bytes": 1024,
+    "growth_per_1000_calls[ok]": 256,
+    "growth_per_1000_calls[exception]": 256,
+    "retained_after_return": 65536,
+    # a finished thread's entry is about 1.2KB, plus a 528 byte deque block once its
+    # narration has been reset after deep work; fragments it kept would add ~200 bytes each
+    "bytes_per_finished_thread": 2048,
+}
+
+
+def _traced() -> int:
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+@narrate(lambda payload: "handling a payload of {} bytes".format(len(payload)))
+def _mem_narrated(payload):
+    return len(payload)
+
+
+def _mem_cm(payload):
+    with narrate_cm(lambda p: "handling a payload of {} bytes".format(len(p)), payload):
+        return len(payload)
+
+
+@narrate("failing")
+def _mem_failing():
+    raise ValueError("failing")
+
+
+@narrate("going down")
+def _mem_chain(depth: int):
+    if depth:
+        return _mem_chain(depth - 1)
+
+
+def _mem_live_fragments(call, count: int) -> float:
+    # bytes per fragment held in the narration, with auto_prune off
+    payload = b"x" * 16
+    set_narration_options(auto_prune=False)
+    try:
+        call(payload)   # fill any first-use caches
+        reset_narration()
+        before = _traced()
+        for _ in range(count):
+            call(payload)
+        after = _traced()
+    finally:
+        reset_narration()
+        set_narration_options(auto_prune=True)
+    return (after - before) / count
+
+
+def _mem_pool(depth: int) -> tuple:
+    # bytes per fragment left in the pools after a deep chain, and the pools' sizes
+    before = _traced()
+    _mem_chain(depth)
+    after = _traced()
+    sizes = stats()["pool_sizes"]
+    return (after - before) / max(sum(sizes.values()), 1), sizes
+
+
+def _mem_growth(calls: int, fail: bool) -> float:
+    # growth per 1000 calls once warmed up
+    def batch():
+        for _ in range(1000):
+            if fail:
+                try:
+                    _mem_failing()
+                except ValueError:
+                    _ = get_narration()
+                    reset_narration()
+            else:
+                _mem_narrated(b"")
+    batch()
+    before = _traced()
+    batches = max(calls // 1000, 1)
+    for _ in range(batches):
+        batch()
+    return (_traced() - before) / batches
+
+
+def _mem_retained_args(size: int) -> float:
+    # memory still referenced after narrated calls with a large argument have returned
+    _mem_narrated(b"")
+    _mem_cm(b"")
+    before = _traced()
+    _mem_narrated(b"x" * size)
+    _mem_cm(b"y" * size)
+    return _traced() - before
+
+
+@narrate(lambda depth, fail: "descending, {} to go".format(depth))
+def _mem_deep(depth, fail):
+    if depth:
+        return _mem_deep(depth - 1, fail)
+    if fail:
+        raise ValueError("failing")
+
+
+def _mem_thread_churn(threads: int, depth: int = 50) -> float:
+    # memory left behind per finished thread, each with a unique name, after narrated
+    # work deep enough to fill its pool, with and without an exception
+    def work():
+        try:
+            _mem_deep(depth, True)
+        except ValueError:
+            reset_narration()
+        _mem_deep(depth, False)
+    def churn(n, prefix):
+        for i in range(n):
+            t = threading.Thread(target=work, name="{}-{}".format(prefix, i))
+            t.start()
+            t.join()
+    churn(10, "errator-bench-warmup")
+    before = _traced()
+    churn(threads, "errator-bench-churn")
+    return (_traced() - before) / threads
+
+
+def run_memory(calls: int = 1000000, threads: int = 1000, limits: dict = None,
+               log=None) -> dict:
+    """
+    Run the memory benchmarks
+    :param calls: int, optional, default 1000000. Narrated calls made when measuring
+        growth, with and without exceptions
+    :param threads: int, optional, default 1000. Threads started when measuring thread
+        churn
+    :param limits: optional, dict of limits that replace those in MEMORY_LIMITS
+    :return: a dict like run_suite()'s, whose results have the keys 'name', 'metric',
+        'bytes', 'limit' and 'passed', plus details for some
+    """
+    limits = dict(MEMORY_LIMITS, **(limits or {}))
+    measured = []
+    reset_all_narrations()
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 3000))
+    tracemalloc.start()
+    try:
+        measured.append(("live_fragment_bytes[narrate]",
+                         _mem_live_fragments(_mem_narrated, 10000), {}))
+        measured.append(("live_fragment_bytes[narrate_cm]",
+                         _mem_live_fragments(_mem_cm, 10000), {}))
+        per_fragment, sizes = _mem_pool(500)
+        measured.append(("pooled_fragment_bytes", per_fragment, {"pool_sizes": sizes}))
+        measured.append(("growth_per_1000_calls[ok]", _mem_growth(calls, False),
+                         {"calls": calls}))
+        measured.append(("growth_per_1000_calls[exception]", _mem_growth(calls, True),
+                         {"calls": calls}))
+        measured.append(("retained_after_return", _mem_retained_args(1 << 20),
+                         {"argument_bytes": 2 << 20}))
+        measured.append(("bytes_per_finished_thread", _mem_thread_churn(threads),
+                         {"threads": threads}))
+    finally:
+        tracemalloc.stop()
+        reset_all_narrations()
+    results = []
+    for name, value, details in measured:
+        result = dict({"name": name, "metric": "bytes", "bytes": value,
+                       "limit": limits[name], "passed": value <= limits[name]},
+                      **details)
+        if log is not None:
+            log("{:<6} {:>12.1f} bytes (limit {})  {}".format(
+                "ok" if result["passed"] else "FAILED", value, limits[name], name))
+        results.append(result)
+    return {"environment": environment(), "results": results}
+
+
+# Thread scaling
+class _ScalingWorker(object):
+    # one thread's workload: a chain of narrated calls whose narrations name the thread, so
+    # that each thread can tell if it ever sees another's
+    def __init__(self, index: int, depth: int, calls: int, exception_rate: float):
+        self.index = index
+        self.depth = depth
+        self.calls = calls
+        self.rate = exception_rate
+        self.expected = ["worker {} level {}".format(index, level)
+                         for level in range(1, depth + 1)]
+        self.expected[-1] += (", but exception type: ValueError, value: 'worker {}' "
+                              "was raised".format(index))
+        self.elapsed = 0.0
+        self.mismatches = 0
+        self.error = None
+
+    def level(self, level: int, fail: bool):
+        if level == self.depth:
+            if fail:
+                raise ValueError("worker {}".format(self.index))
+            return level
+        return _scaling_level(self, level + 1, fail)
+
+    def run(self, barrier: threading.Barrier):
+        try:
+            barrier.wait()
+            start = time.perf_counter()
+            for call in range(1, self.calls + 1):
+                fail = int(call * self.rate) != int((call - 1) * self.rate)
+                try:
+                    _scaling_level(self, 1, fail)
+                except ValueError:
+                    if get_narration() != self.expected:
+                        self.mismatches += 1
+                    reset_narration()
+                else:
+                    if get_narration():
+                        self.mismatches += 1
+            self.elapsed = time.perf_counter() - start
+        except Exception as e:
+            self.error = repr(e)
+
+
+@narrate(lambda worker, level, fail: "worker {} level {}".format(worker.index, level))
+def _scaling_level(worker: _ScalingWorker, level: int, fail: bool):
+    return worker.level(level, fail)
+
+
+def run_scaling(max_threads: int = 16, calls: int = 20000, depth: int = 10,
+                exception_rates: tuple = (0.0, 0.1), log=None) -> dict:
+    """
+    Run the thread scaling benchmarks
+    :param max_threads: int, optional, default 16. Workloads are run on 1, 2, 4, ... up
+        to this many threads at once
+    :param calls: int, optional, default 20000. Top-level calls made by each thread
+    :param depth: int, optional, default 10. Nested narrated calls per top-level call
+    :param exception_rates: tuple of floats, optional. The fraction of calls raising an
+        exception in each workload
+    :return: a dict like run_suite()'s, whose results have the keys 'name', 'threads',
+        'exception_rate', 'calls_per_second_per_thread' (the mean over threads),
+        'calls_per_second' (all threads together), 'mismatches' and 'errors'
+    """
+    counts = []
+    n = 1
+    while n < max_threads:
+        counts.append(n)
+        n *= 2
+    counts.append(max_threads)
+    reset_all_narrations()
+    results = []
+    for rate in exception_rates:
+        for count in counts:
+            workers = [_ScalingWorker(i, depth, calls, rate) for i in range(count)]
+            barrier = threading.Barrier(count + 1)
+            threads = [threading.Thread(target=w.run, args=(barrier,),
+                                        name="errator-bench-{}".format(w.index))
+                       for w in workers]
+            for t in threads:
+                t.start()
+            barrier.wait()
+            start = time.perf_counter()
+            for t in threads:
+                t.join()
+            wall = time.perf_counter() - start
+            narrated_calls = calls * depth
+            result = {"name": "threads={},exception_rate={}".format(count, rate),
+                      "metric": "calls_per_second_per_thread",
+                      "higher_is_better": True, "threads": count,
+                      "exception_rate": rate, "depth": depth,
+                      "calls_per_second_per_thread":
+                          sum(narrated_calls / w.elapsed for w in workers if w.elapsed)
+                          / count,
+                      "calls_per_second": narrated_calls * count / wall,
+                      "mismatches": sum(w.mismatches for w in workers),
+                      "errors": [w.error for w in workers if w.error is not None]}
+            if log is not None:
+                log("{:>12.0f} calls/s/thread {:>12.0f} calls/s  {} mismatches  {}".format(
+                    result["calls_per_second_per_thread"], result["calls_per_second"],
+                    result["mismatches"], result["name"]))
+            results.append(result)
+    reset_all_narrations()
+    return {"environment": environment(), "results": results}
+
+
+def compare(baseline: dict, current: dict, threshold: float = 0.1,
+            relative: bool = False) -> list:
+    """
+    Compare two sets of results from run_suite()
+    :param threshold: float, optional, default 0.1. The fractional slowdown beyond which
+        a scenario is flagged as a regression (and speedup as an improvement)
+    :param relative: boolean, optional, default False. If True, compare each scenario's
+        ratio to its plain counterpart rather than its absolute time, which makes results
+        from different machines more comparable
+    :return: list of dicts, one per scenario present in both, with keys 'name',
+        'baseline', 'current', 'change' (fractional) and 'verdict' ('regression',
+        'improvement' or 'ok'). Results marked 'higher_is_better', such as throughputs,
+        regress when they fall by more than the threshold rather than rise
+    """
+    before = {r["name"]: r for r in baseline["results"]}
+    rows = []
+    for r in current["results"]:
+        # memory results name their own metric
+        key = r.get("metric", "ratio" if relative else "ns_per_call")
+        b = before.get(r["name"])
+        if b is None or not b.get(key) or r[key] is None:
+            continue
+        change = r[key] / b[key] - 1.0
+        worse = -change if r.get("higher_is_better") else change
+        verdict = ("regression" if worse > threshold
+                   else "improvement" if worse < -threshold else "ok")
+        rows.append({"name": r["name"], "baseline": b[key], "current": r[key],
+                     "change": change, "verdict": verdict})
+    return rows
+
+
+def _parse_value(name: str, text: str):
+    base = PARAMETERS[name][0]
+    if isinstance(base, bool):
+        return text.lower() in ("1", "true", "yes")
+    return type(base)(text)
+
+
+def _write_results(results: dict, path: str = None):
+    text = json.dumps(results, indent=1)
+    if path:
+        with open(path, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(prog="benchmarks.py",
+                                     description="errator benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run_p = sub.add_parser("run", help="run benchmarks and write the results as JSON")
+    run_p.add_argument("-o", "--output", help="file for the results (default stdout)")
+    run_p.add_argument("--quick", action="store_true",
+                       help="fewer, shorter timings, for a quick look")
+    run_p.add_argument("--only", help="only run scenarios whose names contain this text")
+    run_p.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                       help="fix a parameter's value instead of sweeping it")
+    run_p.add_argument("--repeat", type=int, default=5)
+    mem_p = sub.add_parser("memory", help="run memory benchmarks and write the results "
+                                          "as JSON")
+    mem_p.add_argument("-o", "--output", help="file for the results (default stdout)")
+    mem_p.add_argument("--quick", action="store_true",
+                       help="fewer calls and threads, for a quick look")
+    mem_p.add_argument("--limit", action="append", default=[], metavar="NAME=BYTES",
+                       help="replace the limit for a measurement")
+    thr_p = sub.add_parser("threads", help="run thread scaling benchmarks and write the "
+                                           "results as JSON")
+    thr_p.add_argument("-o", "--output", help="file for the results (default stdout)")
+    thr_p.add_argument("--quick", action="store_true", help="fewer calls per thread")
+    thr_p.add_argument("--max-threads", type=int, default=16)
+    cmp_p = sub.add_parser("compare", help="compare results against a baseline")
+    cmp_p.add_argument("baseline")
+    cmp_p.add_argument("current")
+    cmp_p.add_argument("--threshold", type=float, default=0.1,
+                       help="fractional slowdown flagged as a regression (default 0.1)")
+    cmp_p.add_argument("--relative", action="store_true",
+                       help="compare ratios to plain calls instead of absolute times")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        overrides = {}
+        for item in args.set:
+            name, _, value = item.partition("=")
+            if name not in PARAMETERS:
+                parser.error("unknown parameter: {}".format(name))
+            overrides[name] = _parse_value(name, value)
+        suite = default_suite(overrides)
+        if args.only:
+            suite = [p for p in suite if args.only in scenario_name(p)]
+        sys.setrecursionlimit(max(sys.getrecursionlimit(),
+                                  max(p["depth"] for p in suite) * 4 + 100))
+        number = 200 if args.quick else None
+        repeat = 2 if args.quick else args.repeat
+        results = run_suite(suite, number=number, repeat=repeat,
+                            log=lambda line: print(line, file=sys.stderr))
+        _write_results(results, args.output)
+        return 0
+
+    if args.command == "memory":
+        limits = {}
+        for item in args.limit:
+            name, _, value = item.partition("=")
+            if name not in MEMORY_LIMITS:
+                parser.error("unknown measurement: {}".format(name))
+            limits[name] = float(value)
+        results = run_memory(calls=100000 if args.quick else 1000000,
+                             threads=100 if args.quick else 1000, limits=limits,
+                             log=lambda line: print(line, file=sys.stderr))
+        _write_results(results, args.output)
+        return 0 if all(r["passed"] for r in results["results"]) else 1
+
+    if args.command == "threads":
+        results = run_scaling(max_threads=args.max_threads,
+                              calls=2000 if args.quick else 20000,
+                              log=lambda line: print(line, file=sys.stderr))
+        _write_results(results, args.output)
+        return 0 if all(not r["mismatches"] and not r["errors"]
+                        for r in results["results"]) else 1
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    rows = compare(baseline, current, threshold=args.threshold, relative=args.relative)
+    for row in rows:
+        print("{:<12} {:>+7.1%}  {}".format(row["verdict"], row["change"], row["name"]))
+    return 1 if any(row["verdict"] == "regression" for row in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,56 @@
-from threading import current_thread, Thread
+from abc import ABC, abstractmethod
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from statistics import median
+import argparse
+import gzip
+import hashlib
+import importlib
+import mmap
+import os
+import random
+import socket
+import struct
+import subprocess
+import tempfile
+import zlib
+from threading import current_thread, local, Thread, Condition, Event, Lock
+import json
+import logging
+import time
 import traceback
 import sys
 from io import StringIO
 from typing import List, Union, Callable, Iterable
 
-from _errator import (ErratorException, _default_options, ErratorDeque, _thread_fragments,
-                      NarrationFragment, NarrationFragmentContextManager, narrate,
-                      get_narration)
+# the core is the compiled _errator extension if it's available, otherwise its pure Python
+# equivalent, _errator_py; setting ERRATOR_BACKEND to 'python' selects the latter regardless
+if os.environ.get("ERRATOR_BACKEND", "").lower() == "python":
+    import _errator_py as _errator
+    BACKEND = "python"
+else:
+    try:
+        import _errator
+        BACKEND = "cython"
+    except ImportError:
+        import _errator_py as _errator
+        BACKEND = "python"
+
+ErratorException = _errator.ErratorException
+_default_options = _errator._default_options
+ErratorDeque = _errator.ErratorDeque
+_thread_fragments = _errator._thread_fragments
+NarrationFragment = _errator.NarrationFragment
+NarrationFragmentContextManager = _errator.NarrationFragmentContextManager
+narrate = _errator.narrate
+get_narration = _errator.get_narration
 
 __version__ = "0.4"
 
 
 def set_default_options(auto_prune: bool = None, check: bool = None,
-                        verbose: bool = None) -> dict:
+                        verbose: bool = None, timing: bool = None) -> dict:
     """
     Sets default options that are applied to each per-narration thread
     :param auto_prune: optional, boolean, defaults to True. If not specified, then don't
@@ -41,16 +79,17 @@ def set_default_options(auto_prune: bool = None, check: bool = None,
     :param verbose: boolean, optional, default False. If True, then the returned list of
         strings will include information on file, function, and line number. These more
         verbose strings will have an embedded \n to split the lines into two.
+    :param timing: boolean, optional, default False. If True, each fragment records when
+        its function was called or context entered, and if an exception is raised from
+        or passes through it, how long it had been running is added to its text, for
+        example "loading batch 17 (took 28.4s), but exception type: ... was raised". The
+        elapsed time is also available in the fragment's elapsed_ns attribute. Until
+        some thread's narration has the timing option, it costs a single test per
+        fragment.
     :return: dict of default options.
     """
-    if auto_prune is not None:
-        _default_options["auto_prune"] = bool(auto_prune)
-    if check is not None:
-        _default_options["check"] = bool(check)
-    if verbose is not None:
-        _default_options["verbose"] = bool(verbose)
-
-    return dict(_default_options)
+    return _errator.update_default_options(auto_prune=auto_prune, check=check,
+                                           verbose=verbose, timing=timing)
 
 
 def reset_all_narrations() -> None:
@@ -90,23 +129,21 @@ def reset_narration(thread: Thread = None, from_here: bool = False) -> None:
         if not from_here:
             d.clear()
         else:
-            for i in range(-1, -1 * len(d) - 1, -1):
-                if d[i].status == NarrationFragment.IN_PROCESS:
-                    if d.auto_prune:
-                        if i != -1:
-                            target = d[i+1]
-                            d.pop_until_true(lambda x: x is target)
-                    else:
-                        target = d[i]
-                        d.pop_until_true(lambda x: x is target)
-                    break
-            else:
+            fragments = _errator.fragments_from_here(d)
+            if not fragments:
                 # in this case, nothing was IN_PROCESS, so we should clear all
                 d.clear()
+            elif not d.auto_prune:
+                target = fragments[0]
+                d.pop_until_true(lambda x: x is target)
+            elif len(fragments) > 1:
+                target = fragments[1]
+                d.pop_until_true(lambda x: x is target)
 
 
 def set_narration_options(thread: Thread = None, auto_prune: bool = None,
-                          check: bool = None, verbose: bool = None) -> None:
+                          check: bool = None, verbose: bool = None,
+                          timing: bool = None) -> None:
     """
     Set options for capturing narration for the current thread.
 
@@ -138,6 +175,9 @@ def set_narration_options(thread: Thread = None, auto_prune: bool = None,
     :param verbose: boolean, optional, default False. If True, then the returned list of
         strings will include information on file, function, and line number. These more
         verbose strings will have an embedded \n to split the lines into two.
+    :param timing: boolean, optional, default False. If True, the time each fragment's
+        function or context had been running when an exception was raised from or passed
+        through it is included in the fragment's text; see set_default_options().
     """
     if thread is None:
         thread = current_thread()
@@ -146,7 +186,8 @@ def set_narration_options(thread: Thread = None, auto_prune: bool = None,
                                "of Thread: {}".format(thread))
     try:
         d = _thread_fragments[thread.name]
-        d.set_auto_prune(auto_prune).set_check(check).set_verbose(verbose)
+        (d.set_auto_prune(auto_prune).set_check(check).set_verbose(verbose)
+         .set_timing(timing))
     except KeyError:
         # this should never happen now that _thread_fragments is a defaultdict
         _thread_fragments[thread.name] = ErratorDeque(auto_prune=bool(auto_prune)
@@ -186,25 +227,213 @@ def copy_narration(thread: Thread = None,
         raise ErratorException("the 'thread' argument isn't an instance "
                                "of Thread: {}".format(thread))
     d = _thread_fragments.get(thread.name)
+    if d and thread is not current_thread():
+        # a snapshot, as another thread's narration may change while it's being copied
+        d = d.copy()
     if not d:
         l = []
     elif not from_here:
         l = [o.__class__.clone(o) for o in d]
     else:
-        l = []
-        for i in range(-1, -1 * len(d) - 1, -1):
-            if d[i].status == NarrationFragment.IN_PROCESS:
-                for j in range(i, 0, 1):
-                    l.append(NarrationFragment.clone(d[j]))
-                break
+        l = [NarrationFragment.clone(o) for o in _errator.fragments_from_here(d)]
+    return l
+
+
+def narration_of(exc: BaseException, with_tags: Iterable = None, collapse: int = 0,
+                 add_note: bool = False) -> List[str]:
+    """
+    Return the narration of an exception as it was when the exception was raised
+
+    When an exception is raised from a narrated function or context, the exception is
+    given a reference to the fragments of the narrated calls it's leaving, without what's
+    left of earlier failures that were handled, as they are at that point. This
+    function formats them, so the narration can be recovered wherever the exception ends
+    up: in another thread (for example, from a Future's result()), or in a handler that
+    runs after other narrated calls have changed the thread's narration.
+    :param exc: the exception
+    :param with_tags: iterable, optional, default None. If supplied, only fragments with
+        one or more of these tags, or with no tags, are returned, as for get_narration().
+    :param collapse: int, optional, default 0. If greater than 0, runs of more than this
+        many fragments from the same call site are shortened, as for get_narration().
+    :param add_note: boolean, optional, default False. If True, the narration is also
+        added to the exception's notes (see BaseException.add_note()), so standard
+        tracebacks include it.
+    :return: list of formatted strings, most global first; empty if the exception never
+        passed through a narrated function or context.
+    """
+    snapshot = getattr(exc, "_errator_narration", None)
+    if snapshot is None:
+        return []
+    tags = _errator.tag_mask(with_tags) if with_tags is not None else None
+    # format copies, since the fragments may still be in use by the thread that raised
+    l = _errator.tell_fragments([f.__class__.clone(f) for f in snapshot.fragments
+                                 if tags is None or not f.tag_mask or f.tag_mask & tags],
+                                snapshot.verbose, collapse)
+    if add_note and l:
+        note = "\n".join(l)
+        notes = getattr(exc, "__notes__", None)
+        if not notes or note not in notes:
+            if hasattr(exc, "add_note"):
+                exc.add_note(note)
+            else:
+                exc.__notes__ = list(notes or ()) + [note]
     return l
 
 
+def stats() -> dict:
+    """
+    Return counters that describe what errator itself has been doing
+
+    These counters are cheap enough to always be maintained. Use reset_stats() to zero
+    them, for instance to sample them over fixed intervals. They're incremented without
+    locking, so on free-threaded builds of Python, where threads really do run at once,
+    they're approximate and may slightly undercount.
+    :return: a dict with the keys:
+        'fragments_created': fragments that had to be newly created
+        'fragments_reused': fragments that were reused from a pool of free fragments
+        'pool_sizes': dict of the number of free fragments in the pool for
+            NarrationFragment and NarrationFragmentContextManager
+        'threads': dict keyed by thread name of dicts with the keys 'depth', the number of
+            fragments the thread's narration currently holds, and 'peak_depth', the most
+            it has held since the last reset_stats()
+        'format_calls': the number of times a fragment has been formatted, whether as an
+            exception passed through it or when a narration was asked for; this is the
+            counter the metrics report, counted from the last reset_stats()
+        'format_seconds': the total time spent formatting fragments
+        'stack_walks': the number of times the stack has been inspected to gather
+            information for verbose narrations
+        'orphaned_fragments': fragments that were discarded when a narrated function or
+            context completed because an exception had been handled further in without
+            the narration being retrieved and reset
+        'observer_errors': exceptions raised by observers registered with
+            add_observer()
+    """
+    return _errator.stats()
+
+
+def reset_stats() -> None:
+    """
+    Zero the counters returned by stats(), and set each thread's peak depth to its
+    current depth
+    """
+    _errator.reset_stats()
+
+
+def add_observer(callback: Callable, events: Iterable[str] = None) -> None:
+    """
+    Register a callable to be told about events in the lives of narration fragments
+
+    The callable is called as callback(event, fragment), where event is one of the
+    strings:
+        'push': a narrated function has been called or context entered, and its fragment
+            added to the thread's narration
+        'pop': a narrated function has returned or context exited normally; this is
+            before the fragment is discarded
+        'raise': an exception has been raised from the narrated function or context
+            closest to where it originated
+        'passthru': an exception has passed through a narrated function or context from
+            one called within it
+        'format': the fragment's text has been generated; it's now in the fragment's
+            text_or_func attribute (calling the fragment's tell() or format() from this
+            event would generate the event again)
+    and fragment is errator's own NarrationFragment object, not a copy. Observers are
+    called in the thread the event happens in, so they should be quick, and they mustn't
+    hold on to fragments once they return, as fragments are reused; use
+    NarrationFragment.clone() if one needs to be kept. Exceptions raised by observers are
+    ignored and counted in stats()["observer_errors"]. While no observers are registered,
+    checking for them costs a single test per event.
+    :param callback: callable of two arguments
+    :param events: optional, iterable of event name strings. If supplied, the callback is
+        only called for these events; otherwise it's called for all of them.
+    """
+    _errator.add_observer(callback, events)
+
+
+def remove_observer(callback: Callable) -> None:
+    """
+    Unregister a callable that was registered with add_observer()
+    :param callback: the callable to remove; if it isn't registered, nothing happens
+    """
+    _errator.remove_observer(callback)
+
+
+def enable_profiling(reset: bool = True) -> None:
+    """
+    Start profiling the overhead errator adds to each narrated function and context
+
+    While profiling, each call of a narrated function or use of a narrated context is
+    counted against its call site, along with whether an exception passed through it and
+    the time spent in errator's own code for the call; the time spent in the function
+    itself or in the body of the context isn't included. Profiling adds a few clock
+    reads to each call, so it should only be enabled while gathering a profile.
+    :param reset: boolean, optional, default True. If True, discard counts from any
+        previous profiling.
+    """
+    if reset:
+        _errator.reset_profile()
+    _errator.set_profiling(True)
+
+
+def disable_profiling() -> None:
+    """
+    Stop profiling narrated calls; the counts gathered so far are retained
+    """
+    _errator.set_profiling(False)
+
+
+def profile_data() -> List[dict]:
+    """
+    Return the profile gathered since enable_profiling()
+    :return: a list of dicts, one per narrated call site that was called, with keys
+        'func_name', 'source_file', 'text', 'calls', 'failures', 'self_seconds' (the
+        total time spent in errator for the site) and 'self_ns_per_call', ordered by
+        self_seconds, greatest first. A narrate_cm() site given a string is the line it's
+        used on, with the function and file containing it and the first string given
+        there as its text; one given a callable has func_name None and source_file
+        where the callable was defined.
+    """
+    data = [{"func_name": func_name, "source_file": source_file, "text": text,
+             "calls": calls, "failures": failures, "self_seconds": self_ns / 1e9,
+             "self_ns_per_call": self_ns / calls}
+            for (func_name, source_file, text), calls, failures, self_ns
+            in _errator.profile_snapshot()]
+    data.sort(key=lambda d: d["self_seconds"], reverse=True)
+    return data
+
+
+def profile_report(limit: int = None, as_json: bool = False) -> str:
+    """
+    Render the profile from profile_data() as a text table or as JSON
+    :param limit: optional, int. Only report this many sites, those with the greatest
+        total self time.
+    :param as_json: boolean, optional, default False. If True, return JSON rather than
+        text.
+    :return: string
+    """
+    data = profile_data()[:limit]
+    if as_json:
+        return json.dumps(data, indent=2)
+    return "\n".join(_profile_table(data))
+
+
+def _profile_table(data: List[dict]) -> List[str]:
+    lines = ["{:>12} {:>10} {:>12} {:>10}  {}".format("calls", "failures", "self ms",
+                                                      "ns/call", "site")]
+    for d in data:
+        site = d["text"] if len(d["text"]) <= 40 else d["text"][:37] + "..."
+        if d["func_name"]:
+            site = "{} ({}: {})".format(d["func_name"], d["source_file"], site)
+        lines.append("{:>12} {:>10} {:>12.3f} {:>10.0f}  {}".format(
+            d["calls"], d["failures"], d["self_seconds"] * 1000, d["self_ns_per_call"],
+            site))
+    return lines
+
+
 _magic_name = "narrate_it"
 
 
 def narrate_cm(text_or_func: Union[Callable, str], *args,
-               tags: Iterable[str] = None, **kwargs):
+               tags: Iterable[str] = None, deadline: float = None, **kwargs):
     """
     Create a context manager that captures some narration of the operations being done
     within it
@@ -227,6 +456,9 @@ def narrate_cm(text_or_func: Union[Callable, str], *args,
         the 'tags' argument of this use of the context manager. If tags aren't supplied,
         then this narration fragment appears in any list of strings returned by
         get_narration(), regardless if tags are supplied in that call or not.
+    :param deadline: optional, float. If supplied, the number of seconds the context is
+        expected to last at most; if it's still running after that, it's reported by the
+        watchdog (see enable_watchdog()).
     :param args: sequence of positional arguments; if str_or_func is a callable, these
         will be the  positional arguments passed to the callable. If str_or_func is a
         string itself, positional arguments are ignored.
@@ -238,10 +470,65 @@ def narrate_cm(text_or_func: Union[Callable, str], *args,
     ifsf = NarrationFragmentContextManager.get_instance(text_or_func, None, *args,
                                                         **kwargs)
     if tags is not None:
-        ifsf.set_tags(frozenset(tags))
+        ifsf.tag_mask = _errator.tag_mask(tags)
+    if deadline is not None:
+        ifsf.set_deadline(deadline)
     return ifsf
 
 
+class _NarrationScope(object):
+    _options = ("auto_prune", "check", "verbose", "timing")
+
+    def __init__(self, overrides: dict):
+        self.overrides = overrides
+        self.deque = None
+        self.depth = 0
+        self.saved = None
+
+    def __enter__(self):
+        d = self.deque = _thread_fragments[current_thread().name]
+        self.depth = len(d)
+        self.saved = tuple(getattr(d, name) for name in self._options)
+        (d.set_auto_prune(self.overrides["auto_prune"])
+         .set_check(self.overrides["check"])
+         .set_verbose(self.overrides["verbose"])
+         .set_timing(self.overrides["timing"]))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        d = self.deque
+        d.truncate(self.depth)
+        (d.set_auto_prune(self.saved[0]).set_check(self.saved[1])
+         .set_verbose(self.saved[2]).set_timing(self.saved[3]))
+        self.deque = self.saved = None
+
+
+def narration_scope(auto_prune: bool = None, check: bool = None, verbose: bool = None,
+                    timing: bool = None) -> _NarrationScope:
+    """
+    Create a context manager that leaves the current thread's narration as it found it
+
+    On entry, the number of fragments in the thread's narration and its options are noted,
+    and any options given here are applied. On exit, whether or not an exception was
+    raised, any fragments added within the scope are discarded in one go and the options
+    are restored. Scopes can be nested. This is cheaper than calling reset_narration()
+    before and after each task in a thread pool or job runner, and doesn't disturb any
+    narration of the code running the tasks. The narration of an exception raised in a
+    scope can still be had from narration_of() after the scope has exited.
+    :param auto_prune: optional, boolean; the auto_prune option within the scope, or if
+        None, leave it as it is. See set_narration_options().
+    :param check: optional, boolean; the check option within the scope, or if None,
+        leave it as it is.
+    :param verbose: optional, boolean; the verbose option within the scope, or if None,
+        leave it as it is.
+    :param timing: optional, boolean; the timing option within the scope, or if None,
+        leave it as it is.
+    :return: the context manager
+    """
+    return _NarrationScope({"auto_prune": auto_prune, "check": check, "verbose": verbose,
+                            "timing": timing})
+
+
 # Traceback sanitizers
 # errator leaves a bunch of cruft in the stack trace when an exception occurs; this cruft
 # appears when you use the various functions in the standard traceback module. The
@@ -394,9 +681,1862 @@ def print_stack(f=None, limit: int = None, file=sys.stderr) -> None:
     file.flush()
 
 
+# Background narration sinks
+# Formatting and writing a narration from within an except block adds latency to the
+# thread that is already dealing with a failure. A NarrationSink lets that thread take
+# a cheap snapshot of its narration and hand it off to a worker thread that does the
+# formatting and writing in batches.
+
+def _site_text(fragment: NarrationFragment):
+    # what tells apart the narrate_cm() sites of a function, as their fragments have no
+    # func_name unless verbose: the text of the site registered for the fragment, or the
+    # text or callable it was given; None for fragments of narrated functions
+    if not isinstance(fragment, NarrationFragmentContextManager):
+        return None
+    if fragment.site_id >= 0:
+        return _errator._sites[fragment.site_id][2]
+    text_or_func = fragment.text_or_func
+    if isinstance(text_or_func, str):
+        return text_or_func
+    return getattr(text_or_func, "__qualname__", None) or type(text_or_func).__name__
+
+
+def narration_record(fragments: List[NarrationFragment], thread_name: str = None,
+                     timestamp: float = None, verbose: bool = False,
+                     exception: str = None) -> dict:
+    """
+    Render a list of NarrationFragment objects into a plain dict
+    :param fragments: list of NarrationFragment objects, such as returned by
+        copy_narration()
+    :param thread_name: optional, string. The name of the thread the narration came from.
+    :param timestamp: optional, float. Time the narration was captured, in seconds since
+        the epoch. Defaults to the current time.
+    :param verbose: boolean, optional, default False. Passed to each fragment's tell()
+        method when generating the fragment's text.
+    :param exception: optional, string. Name of the type of the exception being
+        narrated.
+    :return: a dict with keys 'time', 'thread', 'exception' and 'fragments';
+        'fragments' is a list of dicts, one per fragment, with keys 'text', 'func_name',
+        'source_file', 'lineno', 'status', 'tags', 'elapsed' (seconds the fragment's
+        function or context had run when it failed, or None if not timed; see the timing
+        option of set_narration_options()) and 'site' (for narrate_cm() fragments, the
+        text or callable name that identifies the context, otherwise None). All values
+        are JSON-serialisable.
+    """
+    return {"time": time.time() if timestamp is None else timestamp,
+            "thread": thread_name,
+            "exception": exception,
+            "fragments": [{"text": f.tell(verbose=verbose),
+                           "func_name": f.func_name,
+                           "source_file": f.source_file,
+                           "lineno": f.lineno,
+                           "status": f.status,
+                           "tags": sorted(f.tags),
+                           "elapsed": (f.elapsed_ns / 1e9 if f.elapsed_ns >= 0
+                                       else None),
+                           "site": _site_text(f)} for f in fragments]}
+
+
+def format_record_text(record: dict) -> str:
+    """
+    Formats a record from narration_record() as human-readable text, one fragment per
+    line, preceded by a header line with the capture time and thread name
+    """
+    header = "--- {} [{}]".format(time.strftime("%Y-%m-%d %H:%M:%S",
+                                                time.localtime(record["time"])),
+                                  record["thread"])
+    return "\n".join([header] + [f["text"] for f in record["fragments"]])
+
+
+def format_record_json(record: dict) -> str:
+    """
+    Formats a record from narration_record() as a single line of JSON
+    """
+    return json.dumps(record, separators=(",", ":"))
+
+
+class _BatchWorker(ABC):
+    """
+    A bounded queue of items that a background thread writes in batches
+
+    put() never blocks waiting for the worker. If the queue is full, the overflow policy
+    decides whether the new item (DROP_NEWEST) or the oldest queued item (DROP_OLDEST) is
+    discarded; either way the 'dropped' counter is incremented. Subclasses implement
+    _write(), which is called in the worker thread with a list of items.
+    """
+    DROP_NEWEST = "drop_newest"
+    DROP_OLDEST = "drop_oldest"
+
+    def __init__(self, max_queue: int, overflow: str, batch_size: int,
+                 flush_interval: float, name: str):
+        if overflow not in (self.DROP_NEWEST, self.DROP_OLDEST):
+            raise ErratorException("unknown overflow policy: {}".format(overflow))
+        if max_queue < 1 or batch_size < 1:
+            raise ErratorException("max_queue and batch_size must be at least 1")
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.submitted = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self._queue = deque()
+        self._in_flight = 0
+        self._closed = False
+        self._cond = Condition()
+        self._worker = Thread(target=self._run, name="{}-{}".format(name, id(self)),
+                              daemon=True)
+        self._worker.start()
+
+    def put(self, item) -> bool:
+        """
+        Queue an item for writing
+        :return: True if queued, False if dropped
+        """
+        with self._cond:
+            if self._closed:
+                self.dropped += 1
+                return False
+            self.submitted += 1
+            if len(self._queue) >= self.max_queue:
+                self.dropped += 1
+                if self.overflow == self.DROP_NEWEST:
+                    return False
+                self._queue.popleft()
+            self._queue.append(item)
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify()
+        return True
+
+    def counters(self) -> dict:
+        """
+        Return a dict of the counters: submitted, dropped, written, failed and the
+        current queue depth ('queued')
+        """
+        with self._cond:
+            return {"submitted": self.submitted, "dropped": self.dropped,
+                    "written": self.written, "failed": self.failed,
+                    "queued": len(self._queue) + self._in_flight}
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Wait until everything queued so far has been written
+        :param timeout: optional, float. Maximum number of seconds to wait.
+        :return: True if the queue was drained, False if the timeout expired
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._cond.notify()
+            while self._queue or self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining if remaining is None
+                                else min(remaining, self.flush_interval))
+        return True
+
+    def close(self, timeout: float = None) -> None:
+        """
+        Write anything queued and stop the worker thread; further items are dropped
+        :param timeout: optional, float. Maximum number of seconds to wait for the worker.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._worker.join(timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _run(self):
+        cond = self._cond
+        while True:
+            with cond:
+                if not self._queue and not self._closed:
+                    cond.wait(self.flush_interval)
+                if not self._queue:
+                    if self._closed:
+                        return
+                    continue
+                n = min(len(self._queue), self.batch_size)
+                batch = [self._queue.popleft() for _ in range(n)]
+                self._in_flight = n
+            try:
+                self._write(batch)
+                written, failed = n, 0
+            except Exception:
+                written, failed = 0, n
+            with cond:
+                self.written += written
+                self.failed += failed
+                self._in_flight = 0
+                cond.notify_all()
+
+    @abstractmethod
+    def _write(self, batch: list):
+        """
+        Write a batch of items; called in the worker thread
+        :param batch: list of the items, oldest first
+        """
+
+
+class NarrationSink(_BatchWorker):
+    """
+    Writes narrations from a bounded queue using a background worker thread
+
+    Threads call submit() to enqueue a snapshot of their narration; submit() never
+    formats fragments and never blocks waiting for the worker. The worker formats queued
+    narrations and writes them in batches to the target. If the queue is full, the
+    overflow policy decides whether the new narration (DROP_NEWEST) or the oldest queued
+    narration (DROP_OLDEST) is discarded; either way the 'dropped' counter is incremented.
+    """
+    def __init__(self, target, max_queue: int = 1000,
+                 overflow: str = _BatchWorker.DROP_NEWEST, batch_size: int = 100,
+                 flush_interval: float = 0.5, formatter: Callable = format_record_text,
+                 verbose: bool = None):
+        """
+        Create a sink and start its worker thread
+        :param target: either a callable which is called with a list of formatted
+            narrations for each batch, or an open file-like object with write() (and
+            optionally flush()), in which case each formatted narration is written
+            followed by a newline.
+        :param max_queue: int, optional, default 1000. The maximum number of narrations
+            that may be waiting to be written.
+        :param overflow: string, optional, one of NarrationSink.DROP_NEWEST (the default)
+            or NarrationSink.DROP_OLDEST. Which narration to discard when the queue is full.
+        :param batch_size: int, optional, default 100. Maximum number of narrations the
+            worker writes at one time.
+        :param flush_interval: float, optional, default 0.5. Maximum number of seconds a
+            narration waits in the queue before the worker writes it.
+        :param formatter: callable, optional. Called by the worker with the dict from
+            narration_record() for each narration; the return value is what's written
+            to the target. Defaults to format_record_text; format_record_json writes
+            JSONL. If None, the record dicts are passed to the target unchanged.
+        :param verbose: boolean, optional. If supplied, overrides the submitting thread's
+            verbose narration option when fragments are formatted.
+        """
+        self.target = target
+        self.formatter = formatter
+        self.verbose = verbose
+        super(NarrationSink, self).__init__(max_queue, overflow, batch_size,
+                                            flush_interval, "errator-sink")
+
+    def submit(self, thread: Thread = None, from_here: bool = False) -> bool:
+        """
+        Snapshot a thread's narration and queue it for writing
+        :param thread: optional, instance of Thread. If unspecified, the current thread is
+            used.
+        :param from_here: boolean, optional, default False. Same meaning as for
+            copy_narration().
+        :return: True if the narration was queued, False if it was dropped because the
+            queue was full (DROP_NEWEST only) or the sink has been closed.
+        """
+        if thread is None:
+            thread = current_thread()
+        fragments = copy_narration(thread=thread, from_here=from_here)
+        verbose = (self.verbose if self.verbose is not None
+                   else _thread_fragments[thread.name].verbose)
+        etype = sys.exc_info()[0]
+        return self.put((time.time(), thread.name, fragments, verbose,
+                         etype.__name__ if etype is not None else None))
+
+    def put(self, item: tuple) -> bool:
+        """
+        Queue an already-captured narration; submit() is normally used instead
+        :param item: a tuple of (timestamp, thread name, list of NarrationFragment,
+            verbose flag, exception type name or None)
+        :return: True if queued, False if dropped
+        """
+        return super(NarrationSink, self).put(item)
+
+    def _write(self, batch: list):
+        formatter = self.formatter
+        items = []
+        for ts, tname, fragments, verbose, exception in batch:
+            record = narration_record(fragments, thread_name=tname, timestamp=ts,
+                                      verbose=verbose, exception=exception)
+            items.append(record if formatter is None else formatter(record))
+        if callable(self.target):
+            self.target(items)
+        else:
+            self.target.write("".join("{}\n".format(i) for i in items))
+            flush = getattr(self.target, "flush", None)
+            if flush is not None:
+                flush()
+
+
+# logging integration
+# NarrationFilter takes a snapshot of the narration when a record is created, but no
+# formatting is done unless a handler actually emits the record.
+
+class LazyNarration(object):
+    """
+    A snapshot of a thread's narration fragments that's only formatted when needed
+
+    str() of a LazyNarration is the narration with one fragment per line; it's empty if
+    there were no fragments when the snapshot was taken.
+    """
+    __slots__ = ("_fragments", "_verbose", "_lines")
+
+    def __init__(self, fragments: List[NarrationFragment] = (), verbose: bool = False):
+        self._fragments = fragments
+        self._verbose = verbose
+        self._lines = None
+
+    def lines(self) -> List[str]:
+        """
+        Return the narration as a list of strings, as get_narration() would have
+        """
+        if self._lines is None:
+            self._lines = [f.tell(verbose=self._verbose) for f in self._fragments]
+        return self._lines
+
+    def fragments(self) -> List[dict]:
+        """
+        Return the narration as a list of dicts, one per fragment, with the same keys as
+        the 'fragments' in narration_record()
+        """
+        return narration_record(self._fragments, verbose=self._verbose)["fragments"]
+
+    def __bool__(self):
+        return len(self._fragments) != 0
+
+    def __str__(self):
+        return "\n".join(self.lines())
+
+    def __getstate__(self):
+        # fragments may hold unpicklable callables, so ship the rendered text instead
+        return {"fragments": (), "lines": self.lines(), "verbose": self._verbose}
+
+    def __setstate__(self, state):
+        self._fragments = state["fragments"]
+        self._lines = state["lines"]
+        self._verbose = state["verbose"]
+
+
+_no_narration = LazyNarration()
+
+
+class NarrationFilter(logging.Filter):
+    """
+    logging filter that attaches the current thread's narration to log records
+
+    Add this to a logger (or handler) and every record that passes it gets a 'narration'
+    attribute, a LazyNarration. Only a copy of the fragments is taken when the record is
+    logged; the text is generated only if a handler formats the narration. Records that
+    don't pass the logger's level never reach the filter, so cost nothing at all.
+    """
+    def __init__(self, name: str = "", from_here: bool = False,
+                 exceptions_only: bool = True):
+        """
+        :param name: passed to logging.Filter
+        :param from_here: boolean, optional, default False. Same meaning as for
+            copy_narration().
+        :param exceptions_only: boolean, optional, default True. If True, only records
+            logged with exception info (for example, by logger.exception()) get the
+            narration; other records get an empty narration.
+        """
+        super(NarrationFilter, self).__init__(name)
+        self.from_here = from_here
+        self.exceptions_only = exceptions_only
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not super(NarrationFilter, self).filter(record):
+            return False
+        if getattr(record, "narration", None) is None:
+            if record.exc_info or not self.exceptions_only:
+                fragments = copy_narration(from_here=self.from_here)
+                record.narration = (LazyNarration(fragments, _thread_fragments[
+                    current_thread().name].verbose) if fragments else _no_narration)
+            else:
+                record.narration = _no_narration
+        return True
+
+
+class NarrationFormatter(logging.Formatter):
+    """
+    logging formatter that appends the narration attached by NarrationFilter
+
+    The narration is added after the formatted message (and any exception text), each
+    line prefixed with 'prefix'. If you'd rather place the narration yourself, use
+    '%(narration)s' in the format string of any Formatter instead.
+    """
+    def __init__(self, fmt: str = None, datefmt: str = None, style: str = "%",
+                 prefix: str = "  "):
+        super(NarrationFormatter, self).__init__(fmt, datefmt, style)
+        self.prefix = prefix
+
+    def format(self, record: logging.LogRecord) -> str:
+        s = super(NarrationFormatter, self).format(record)
+        narration = getattr(record, "narration", None)
+        if narration:
+            prefix = self.prefix
+            s = "\n".join([s] + [prefix + l.replace("\n", "\n" + prefix)
+                                 for l in narration.lines()])
+        return s
+
+
+# SQLite narration store
+# Narration records (see narration_record()) are stored with all their strings interned
+# into a single table, and are written in batches, one transaction per batch.
+
+_store_schema = """
+CREATE TABLE IF NOT EXISTS strings (id INTEGER PRIMARY KEY, value TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS narrations (id INTEGER PRIMARY KEY, time REAL NOT NULL,
+    thread INTEGER, exception INTEGER);
+CREATE TABLE IF NOT EXISTS fragments (narration INTEGER NOT NULL, position INTEGER NOT NULL,
+    func_name INTEGER, source_file INTEGER, lineno INTEGER, text INTEGER, status INTEGER);
+CREATE TABLE IF NOT EXISTS tags (narration INTEGER NOT NULL, position INTEGER NOT NULL,
+    tag INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS narrations_time ON narrations (time);
+CREATE INDEX IF NOT EXISTS narrations_exception ON narrations (exception);
+CREATE INDEX IF NOT EXISTS fragments_site ON fragments (source_file, func_name);
+CREATE INDEX IF NOT EXISTS fragments_narration ON fragments (narration);
+CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag);
+"""
+
+
+class NarrationStore(object):
+    """
+    Persists narration records into an SQLite database and queries them
+
+    Records are the dicts produced by narration_record(). A store can be used as the
+    target of a NarrationSink created with formatter=None, in which case each batch the
+    sink writes is stored in a single transaction:
+
+        store = NarrationStore("narrations.db")
+        sink = NarrationSink(store, formatter=None)
+
+    Records can also be added one at a time with add(); these are buffered and written
+    when 'batch_size' records have accumulated or flush() is called. The database is put
+    into WAL mode so that queries can run while narrations are being written.
+    """
+    def __init__(self, path: str, batch_size: int = 500, cache_size: int = 100000):
+        """
+        :param path: path to the SQLite database file; it's created if it doesn't exist.
+        :param batch_size: int, optional, default 500. Number of records add() buffers
+            before writing them.
+        :param cache_size: int, optional, default 100000. Number of stored strings
+            (fragment texts, function names and so on) whose ids are kept in memory; the
+            least recently used are looked up in the database again when next needed.
+        """
+        import sqlite3
+        self.path = path
+        self.batch_size = batch_size
+        self._lock = Lock()
+        self._pending = []
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_store_schema)
+        # an LRU cache of string ids, and the strings inserted by the current write()
+        self.cache_size = cache_size
+        self._string_ids = OrderedDict()
+        self._inserted = []
+
+    def _intern(self, value) -> int:
+        if value is None:
+            return None
+        string_ids = self._string_ids
+        try:
+            sid = string_ids[value]
+            string_ids.move_to_end(value)
+            return sid
+        except KeyError:
+            pass
+        row = self._conn.execute("SELECT id FROM strings WHERE value = ?",
+                                 (value,)).fetchone()
+        if row is not None:
+            sid = row[0]
+        else:
+            sid = self._conn.execute("INSERT INTO strings (value) VALUES (?)",
+                                     (value,)).lastrowid
+            self._inserted.append(value)
+        string_ids[value] = sid
+        if len(string_ids) > self.cache_size:
+            string_ids.popitem(last=False)
+        return sid
+
+    def write(self, records: Iterable[dict]) -> None:
+        """
+        Store a batch of narration records in a single transaction
+        :param records: iterable of dicts as returned by narration_record()
+        """
+        intern = self._intern
+        with self._lock:
+            conn = self._conn
+            self._inserted = []
+            try:
+                with conn:
+                    cursor = conn.cursor()
+                    frag_rows = []
+                    tag_rows = []
+                    for r in records:
+                        nid = cursor.execute("INSERT INTO narrations (time, thread, "
+                                             "exception) VALUES (?, ?, ?)",
+                                             (r["time"], intern(r.get("thread")),
+                                              intern(r.get("exception")))).lastrowid
+                        for pos, f in enumerate(r["fragments"]):
+                            frag_rows.append((nid, pos, intern(f["func_name"]),
+                                              intern(f["source_file"]), f["lineno"],
+                                              intern(f["text"]), f["status"]))
+                            tag_rows.extend((nid, pos, intern(t)) for t in f["tags"])
+                    cursor.executemany("INSERT INTO fragments VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                       frag_rows)
+                    cursor.executemany("INSERT INTO tags VALUES (?, ?, ?)", tag_rows)
+            except Exception:
+                # the strings interned during the failed transaction were rolled back
+                for value in self._inserted:
+                    self._string_ids.pop(value, None)
+                raise
+            finally:
+                self._inserted = []
+
+    __call__ = write
+
+    def add(self, record: dict) -> None:
+        """
+        Buffer a single narration record, writing the buffer if it's full
+        :param record: a dict as returned by narration_record()
+        """
+        with self._lock:
+            self._pending.append(record)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write any records buffered by add()
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if pending:
+            self.write(pending)
+
+    def close(self) -> None:
+        """
+        Write any buffered records and close the database
+        """
+        self.flush()
+        with self._lock:
+            self._conn.close()
+
+    def query(self, func_name: str = None, source_file: str = None,
+              exception: str = None, tag: str = None, since: float = None,
+              until: float = None, limit: int = 100) -> List[dict]:
+        """
+        Retrieve stored narration records, most recent first
+        :param func_name: optional, string. Only return narrations that include a
+            fragment for a function with this name.
+        :param source_file: optional, string. Only return narrations that include a
+            fragment from this source file (and func_name, if that's also given).
+        :param exception: optional, string. Only return narrations of exceptions with
+            this type name.
+        :param tag: optional, string. Only return narrations with a fragment that has
+            this tag.
+        :param since: optional, float. Only return narrations captured at or after this
+            time (seconds since the epoch).
+        :param until: optional, float. Only return narrations captured before this time.
+        :param limit: int, optional, default 100. Maximum number of records to return.
+        :return: a list of dicts with the same structure as those from
+            narration_record()
+        """
+        where, params = [], []
+        if func_name is not None or source_file is not None:
+            site = ["f.narration = n.id"]
+            for col, value in (("source_file", source_file), ("func_name", func_name)):
+                if value is not None:
+                    site.append("f.{} = (SELECT id FROM strings WHERE value = ?)".format(col))
+                    params.append(value)
+            where.append("EXISTS (SELECT 1 FROM fragments f WHERE {})".format(
+                " AND ".join(site)))
+        if exception is not None:
+            where.append("n.exception = (SELECT id FROM strings WHERE value = ?)")
+            params.append(exception)
+        if tag is not None:
+            where.append("EXISTS (SELECT 1 FROM tags t WHERE t.narration = n.id AND "
+                         "t.tag = (SELECT id FROM strings WHERE value = ?))")
+            params.append(tag)
+        if since is not None:
+            where.append("n.time >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("n.time < ?")
+            params.append(until)
+        sql = ("SELECT n.id, n.time, th.value, ex.value FROM narrations n "
+               "LEFT JOIN strings th ON th.id = n.thread "
+               "LEFT JOIN strings ex ON ex.id = n.exception")
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY n.time DESC, n.id DESC LIMIT ?"
+        params.append(limit)
+        frags, tags = [], []
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+            ids = [r[0] for r in rows]
+            if ids:
+                marks = ",".join("?" * len(ids))
+                frags = self._conn.execute(
+                    "SELECT f.narration, fn.value, sf.value, f.lineno, tx.value, f.status "
+                    "FROM fragments f LEFT JOIN strings fn ON fn.id = f.func_name "
+                    "LEFT JOIN strings sf ON sf.id = f.source_file "
+                    "LEFT JOIN strings tx ON tx.id = f.text "
+                    "WHERE f.narration IN ({}) ORDER BY f.narration, f.position".format(
+                        marks), ids).fetchall()
+                tags = self._conn.execute(
+                    "SELECT t.narration, t.position, s.value FROM tags t JOIN strings s "
+                    "ON s.id = t.tag WHERE t.narration IN ({})".format(marks),
+                    ids).fetchall()
+        records = {nid: {"time": ts, "thread": thread, "exception": exc, "fragments": []}
+                   for nid, ts, thread, exc in rows}
+        for nid, fn, sf, lineno, text, status in frags:
+            records[nid]["fragments"].append({"text": text, "func_name": fn,
+                                              "source_file": sf, "lineno": lineno,
+                                              "status": status, "tags": []})
+        for nid, pos, t in tags:
+            records[nid]["fragments"][pos]["tags"].append(t)
+        for r in records.values():
+            for f in r["fragments"]:
+                f["tags"].sort()
+        return list(records.values())
+
+    def site_counts(self, since: float = None, limit: int = 20) -> List[tuple]:
+        """
+        Count stored narrations by the call site where the exception was raised
+        :param since: optional, float. Only count narrations captured at or after this
+            time.
+        :param limit: int, optional, default 20. Maximum number of sites to return.
+        :return: list of (source_file, func_name, exception, count) tuples, most
+            frequent first
+        """
+        sql = ("SELECT sf.value, fn.value, ex.value, COUNT(*) AS c FROM narrations n "
+               "JOIN fragments f ON f.narration = n.id AND f.position = "
+               "(SELECT MAX(position) FROM fragments WHERE narration = n.id) "
+               "LEFT JOIN strings sf ON sf.id = f.source_file "
+               "LEFT JOIN strings fn ON fn.id = f.func_name "
+               "LEFT JOIN strings ex ON ex.id = n.exception ")
+        params = []
+        if since is not None:
+            sql += "WHERE n.time >= ? "
+            params.append(since)
+        sql += "GROUP BY f.source_file, f.func_name, n.exception ORDER BY c DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            return [tuple(r) for r in self._conn.execute(sql, params)]
+
+
+# Storm suppression
+# When the same failure happens over and over, rendering and emitting every narration
+# costs CPU and floods logs. NarrationSuppressor identifies narrations by fingerprint
+# (without formatting them), only emits the first few of each per time window, and
+# summarises the rest.
+
+def narration_fingerprint(thread: Thread = None, from_here: bool = False,
+                          exception: str = None) -> str:
+    """
+    Compute the fingerprint of a thread's current narration without formatting it
+
+    The value is the same as record_fingerprint() returns for a record of the same
+    narration: it depends only on the call sites of the fragments and the exception type.
+    :param thread: optional, instance of Thread. If unspecified, the current thread is
+        used.
+    :param from_here: boolean, optional, default False. Same meaning as for
+        copy_narration().
+    :param exception: optional, string. The name of the exception type; if not supplied,
+        the type of the exception currently being handled is used.
+    :return: a 16 character hex string
+    """
+    if thread is None:
+        thread = current_thread()
+    elif not isinstance(thread, Thread):
+        raise ErratorException("the 'thread' argument isn't an instance "
+                               "of Thread: {}".format(thread))
+    if exception is None:
+        etype = sys.exc_info()[0]
+        exception = etype.__name__ if etype is not None else None
+    d = _thread_fragments.get(thread.name)
+    fragments = ()
+    if d:
+        fragments = _errator.fragments_from_here(d) if from_here else d.copy()
+    return _fingerprint([(f.source_file, f.func_name, _site_text(f)) for f in fragments],
+                        exception)
+
+
+class NarrationSuppressor(object):
+    """
+    Emits only the first few narrations of each failure path per time window
+
+    Call report() from an except block in place of rendering the narration yourself. The
+    narration's fingerprint is computed without formatting any fragments; only the first
+    'limit' narrations with a given fingerprint in each window are rendered and passed to
+    'emit'. At the end of each window, a one-line summary is emitted for each fingerprint
+    that had narrations suppressed, such as:
+
+        narration 9357e60c4007ca8a (KeyError) repeated 14,203 times in the last 60s
+
+    Windows end when report() or flush() is called after 'window' seconds have passed.
+    """
+    def __init__(self, emit: Callable, limit: int = 10, window: float = 60.0,
+                 clock: Callable = time.monotonic):
+        """
+        :param emit: callable, called with a list of strings: either the rendered
+            narration (as from get_narration()) or a single summary line
+        :param limit: int, optional, default 10. Number of narrations per fingerprint to
+            emit in each window.
+        :param window: float, optional, default 60.0. Length of a window in seconds.
+        :param clock: callable, optional. Returns the current time in seconds; defaults to
+            time.monotonic.
+        """
+        self.emit = emit
+        self.limit = limit
+        self.window = window
+        self.clock = clock
+        self.suppressed = 0
+        self._lock = Lock()
+        self._window_start = clock()
+        self._counts = {}
+        self._exceptions = {}
+
+    def allow(self, fingerprint: str, exception: str = None) -> bool:
+        """
+        Count an occurrence of a fingerprint, returning True if it should be emitted
+        :param fingerprint: string, as from narration_fingerprint()
+        :param exception: optional, string. Exception type name to use in the summary.
+        :return: True if fewer than 'limit' occurrences have been seen in this window
+        """
+        summaries = self._roll()
+        with self._lock:
+            count = self._counts.get(fingerprint, 0) + 1
+            self._counts[fingerprint] = count
+            if count > self.limit:
+                self.suppressed += 1
+                self._exceptions[fingerprint] = exception
+        for lines in summaries:
+            self.emit(lines)
+        return count <= self.limit
+
+    def report(self, thread: Thread = None, from_here: bool = False) -> bool:
+        """
+        Emit a thread's narration unless its fingerprint is over the limit for this window
+        :param thread: optional, instance of Thread. If unspecified, the current thread is
+            used.
+        :param from_here: boolean, optional, default False. Same meaning as for
+            get_narration().
+        :return: True if the narration was emitted, False if it was suppressed
+        """
+        etype = sys.exc_info()[0]
+        exception = etype.__name__ if etype is not None else None
+        fp = narration_fingerprint(thread=thread, from_here=from_here, exception=exception)
+        if not self.allow(fp, exception):
+            return False
+        self.emit(get_narration(thread=thread, from_here=from_here))
+        return True
+
+    def flush(self, force: bool = False) -> None:
+        """
+        Emit summaries if the current window has ended
+        :param force: boolean, optional, default False. If True, end the current window
+            now.
+        """
+        for lines in self._roll(force):
+            self.emit(lines)
+
+    def _roll(self, force: bool = False) -> list:
+        now = self.clock()
+        if not force and now - self._window_start < self.window:
+            return []
+        with self._lock:
+            elapsed = now - self._window_start
+            if not force and elapsed < self.window:
+                return []  # another thread ended the window first
+            counts, exceptions = self._counts, self._exceptions
+            self._counts, self._exceptions = {}, {}
+            self._window_start = now
+        return [["narration {} ({}) repeated {:,} times in the last {:.0f}s".format(
+                 fp, exceptions[fp], counts[fp] - self.limit, elapsed)]
+                for fp in exceptions]
+
+
+# Crash-surviving narration ring files
+# A ring file is a fixed-size file that's memory-mapped by the writing process. Records
+# are copied into the mapping, so they're in the operating system's page cache as soon as
+# they're written; if the process dies, the records survive for read_ring_file() to
+# recover. Nothing is flushed to disk by the writer.
+#
+# Layout, all little-endian:
+#   header, _ring_header_size bytes: magic, version, header size, data capacity, offset
+#       of the next record in the data region, sequence number of the last record, pid
+#   data region, 'capacity' bytes of records, each of which is:
+#       record magic (u32), payload length (u32), crc32 of seq+time+payload (u32),
+#       sequence number (u64), time (f64), payload
+#   A record that doesn't fit at the end of the data region is written at its start.
+#   The payload is the thread name and exception type name followed by a fragment count
+#   (u16) and, per fragment, its line number (u32), status (u8), function name, source
+#   file, text, a tag count (u16) and the tags. Each string is a u32 byte count
+#   (0xFFFFFFFF for None) followed by UTF-8 bytes.
+
+_ring_magic = b"ERRRING\0"
+_ring_version = 1
+_ring_header = struct.Struct("<8sIIQQQI")
+_ring_header_size = 64
+_ring_record = struct.Struct("<IIIQd")
+_ring_record_magic = 0x52524545
+_ring_record_magic_bytes = struct.pack("<I", _ring_record_magic)
+_ring_none = 0xFFFFFFFF
+
+
+def _ring_pack_str(parts: list, value) -> None:
+    if value is None:
+        parts.append(struct.pack("<I", _ring_none))
+    else:
+        b = str(value).encode("utf-8", "replace")
+        parts.append(struct.pack("<I", len(b)))
+        parts.append(b)
+
+
+def _ring_encode(record: dict) -> bytes:
+    parts = []
+    _ring_pack_str(parts, record.get("thread"))
+    _ring_pack_str(parts, record.get("exception"))
+    parts.append(struct.pack("<H", len(record["fragments"])))
+    for f in record["fragments"]:
+        parts.append(struct.pack("<IB", f["lineno"] or 0, f["status"]))
+        _ring_pack_str(parts, f["func_name"])
+        _ring_pack_str(parts, f["source_file"])
+        _ring_pack_str(parts, f["text"])
+        parts.append(struct.pack("<H", len(f["tags"])))
+        for t in f["tags"]:
+            _ring_pack_str(parts, t)
+    return b"".join(parts)
+
+
+def _ring_decode(payload: bytes) -> dict:
+    pos = 0
+
+    def unpack(fmt):
+        nonlocal pos
+        values = struct.unpack_from(fmt, payload, pos)
+        pos += struct.calcsize(fmt)
+        return values
+
+    def string():
+        nonlocal pos
+        n, = unpack("<I")
+        if n == _ring_none:
+            return None
+        pos += n
+        return payload[pos - n:pos].decode("utf-8", "replace")
+
+    thread = string()
+    exception = string()
+    fragments = []
+    for _ in range(unpack("<H")[0]):
+        lineno, status = unpack("<IB")
+        func_name, source_file, text = string(), string(), string()
+        tags = [string() for _ in range(unpack("<H")[0])]
+        fragments.append({"text": text, "func_name": func_name,
+                          "source_file": source_file, "lineno": lineno,
+                          "status": status, "tags": tags})
+    return {"thread": thread, "exception": exception, "fragments": fragments}
+
+
+class NarrationRingFile(object):
+    """
+    Writes narrations into a fixed-size, memory-mapped ring file
+
+    Once the file is full, new narrations overwrite the oldest ones. Writing a narration
+    only copies its encoded bytes into memory, so it's cheap enough to do from an except
+    block, and because the memory is a shared mapping of the file, the narrations can be
+    recovered with read_ring_file() even if the process is killed or crashes.
+
+    A ring file can also be used as the target of a NarrationSink created with
+    formatter=None, although narrations still in the sink's queue are lost in a crash.
+    """
+    def __init__(self, path: str = None, size: int = 1 << 20):
+        """
+        :param path: optional, string. Path of the ring file; it's created or overwritten.
+            If not supplied, a file named errator-<pid>.ring in the system's temporary
+            directory is used.
+        :param size: int, optional, default 1MB. Size of the file's data region in bytes;
+            this bounds the size of a single narration as well as how many are retained.
+        """
+        if path is None:
+            path = os.path.join(tempfile.gettempdir(), "errator-{}.ring".format(os.getpid()))
+        if size < _ring_record.size:
+            raise ErratorException("ring file size is too small: {}".format(size))
+        self.path = path
+        self.size = size
+        self.written = 0
+        self.dropped = 0
+        self._lock = Lock()
+        self._offset = 0
+        self._seq = 0
+        with open(path, "w+b") as f:
+            f.truncate(_ring_header_size + size)
+            self._mm = mmap.mmap(f.fileno(), _ring_header_size + size)
+        _ring_header.pack_into(self._mm, 0, _ring_magic, _ring_version,
+                               _ring_header_size, size, 0, 0, os.getpid())
+
+    def write_record(self, record: dict) -> bool:
+        """
+        Write one narration record into the ring
+        :param record: a dict as returned by narration_record()
+        :return: True if written, False if the record is too large for the ring or the
+            ring has been closed
+        """
+        payload = _ring_encode(record)
+        length = _ring_record.size + len(payload)
+        ts = record["time"]
+        with self._lock:
+            if length > self.size or self._mm is None:
+                self.dropped += 1
+                return False
+            offset = self._offset
+            if offset + length > self.size:
+                offset = 0
+            self._seq += 1
+            seq = self._seq
+            crc = zlib.crc32(payload, zlib.crc32(struct.pack("<Qd", seq, ts)))
+            pos = _ring_header_size + offset
+            self._mm[pos + _ring_record.size:pos + length] = payload
+            _ring_record.pack_into(self._mm, pos, _ring_record_magic, len(payload), crc,
+                                   seq, ts)
+            self._offset = offset + length
+            struct.pack_into("<QQ", self._mm, 24, self._offset, seq)
+            self.written += 1
+        return True
+
+    def write(self, records: Iterable[dict]) -> None:
+        """
+        Write a batch of narration records into the ring
+        """
+        for r in records:
+            self.write_record(r)
+
+    __call__ = write
+
+    def capture(self, thread: Thread = None, from_here: bool = False) -> bool:
+        """
+        Write a thread's current narration into the ring
+        :param thread: optional, instance of Thread. If unspecified, the current thread is
+            used.
+        :param from_here: boolean, optional, default False. Same meaning as for
+            copy_narration().
+        :return: True if written
+        """
+        if thread is None:
+            thread = current_thread()
+        etype = sys.exc_info()[0]
+        return self.write_record(narration_record(
+            copy_narration(thread=thread, from_here=from_here), thread_name=thread.name,
+            verbose=_thread_fragments[thread.name].verbose,
+            exception=etype.__name__ if etype is not None else None))
+
+    def close(self) -> None:
+        """
+        Unmap the ring file; the file itself is left in place
+        """
+        with self._lock:
+            if self._mm is not None:
+                self._mm.close()
+                self._mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def read_ring_file(path: str, last: int = None) -> List[dict]:
+    """
+    Recover the narrations from a ring file written by NarrationRingFile
+
+    This can be used while the writing process is running or after it has died. Records
+    that were only partially written or have been partly overwritten are skipped.
+    :param path: path of the ring file
+    :param last: optional, int. If supplied, only the most recent 'last' narrations are
+        returned.
+    :return: list of dicts with the same structure as those from narration_record(),
+        plus the keys 'seq' (the record's sequence number) and 'pid' (the writer's process
+        id), oldest first
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < _ring_header_size:
+        raise ErratorException("{} is not an errator ring file".format(path))
+    magic, version, header_size, size, _, _, pid = _ring_header.unpack_from(data, 0)
+    if magic != _ring_magic:
+        raise ErratorException("{} is not an errator ring file".format(path))
+    if version != _ring_version:
+        raise ErratorException("{} has unsupported ring file version {}".format(path,
+                                                                                version))
+    region = data[header_size:header_size + size]
+    found = []
+    pos = region.find(_ring_record_magic_bytes)
+    while 0 <= pos <= len(region) - _ring_record.size:
+        _, length, crc, seq, ts = _ring_record.unpack_from(region, pos)
+        start = pos + _ring_record.size
+        payload = region[start:start + length]
+        if (len(payload) == length and
+                zlib.crc32(payload, zlib.crc32(struct.pack("<Qd", seq, ts))) == crc):
+            found.append((seq, ts, payload))
+            pos = region.find(_ring_record_magic_bytes, start + length)
+        else:
+            pos = region.find(_ring_record_magic_bytes, pos + 1)
+    found.sort()
+    if last is not None:
+        found = found[-last:] if last > 0 else []
+    records = []
+    for seq, ts, payload in found:
+        record = _ring_decode(payload)
+        record.update(time=ts, seq=seq, pid=pid)
+        records.append(record)
+    return records
+
+
+# Watchdog for overdue calls
+# narrate() and narrate_cm() given a deadline only store the time by which the call should
+# finish in its fragment; no timers are created. A single watchdog thread looks through
+# every thread's narration every so often and reports each fragment found past its
+# deadline once. The fragments belong to other threads, so they're only ever read: which
+# have been reported is kept here instead, by thread, fragment and deadline, as pooled
+# fragments are reused for later calls.
+
+_watchdog = None
+_watchdog_lock = Lock()
+_overdue_reported = set()
+_overdue_lock = Lock()
+
+
+def _peek_text(fragment: NarrationFragment) -> str:
+    # the fragment's text, without altering it or calling anything: a callable's arguments
+    # belong to another thread's call in progress, so the text of its site is used instead
+    text = fragment.text_or_func
+    if isinstance(text, str):
+        return text
+    if fragment.site_id >= 0:
+        return _errator._sites[fragment.site_id][2]
+    return _site_text(fragment) or "<{}>".format(type(text).__name__)
+
+
+def find_overdue(now_ns: int = None) -> List[dict]:
+    """
+    Look through every thread's narration for calls and contexts past their deadlines
+
+    Each overdue fragment is only reported by the first call that finds it. Fragments are
+    only read, never formatted, so a fragment whose text comes from a callable is
+    reported with the text of its site (the callable's name and line) rather than the text
+    the callable would give.
+    :param now_ns: optional, int. The time to compare deadlines against, in
+        time.perf_counter_ns() units; defaults to now.
+    :return: a list of dicts, one per newly overdue fragment, each like those returned by
+        narration_record() for the thread's whole narration, with the extra keys
+        'overdue' (the index in 'fragments' of the overdue one) and 'overdue_by' (seconds)
+    """
+    global _overdue_reported
+    if now_ns is None:
+        now_ns = time.perf_counter_ns()
+    found = []
+    with _overdue_lock:
+        overdue = set()
+        for tname, d in list(_thread_fragments.items()):
+            fragments = list(d.copy())
+            if not fragments:
+                continue
+            for i, f in enumerate(fragments):
+                deadline_ns = f.deadline_ns
+                if not deadline_ns or now_ns <= deadline_ns or f.status != f.IN_PROCESS:
+                    continue
+                key = (tname, id(f), deadline_ns)
+                overdue.add(key)
+                if key in _overdue_reported:
+                    continue
+                found.append({"time": time.time(), "thread": tname, "exception": None,
+                              "fragments": [{"text": _peek_text(g),
+                                             "func_name": g.func_name,
+                                             "source_file": g.source_file,
+                                             "lineno": g.lineno,
+                                             "status": g.status,
+                                             "tags": sorted(g.tags),
+                                             "elapsed": None} for g in fragments],
+                              "overdue": i,
+                              "overdue_by": (now_ns - deadline_ns) / 1e9})
+        # forget the calls that have finished, so this doesn't grow
+        _overdue_reported = overdue
+    return found
+
+
+class _Watchdog(Thread):
+    def __init__(self, callback: Callable, interval: float, logger: logging.Logger):
+        super(_Watchdog, self).__init__(name="errator-watchdog", daemon=True)
+        self.callback = callback
+        self.interval = interval
+        self.logger = logger
+        self.stopping = Event()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            for record in find_overdue():
+                try:
+                    if self.callback is not None:
+                        self.callback(record)
+                    else:
+                        self.logger.warning(
+                            "narrated call overdue by %.1fs in thread %s:\n%s",
+                            record["overdue_by"], record["thread"],
+                            "\n".join(f["text"] for f in record["fragments"]))
+                except Exception:
+                    # a faulty callback mustn't stop the watchdog
+                    pass
+
+
+def enable_watchdog(callback: Callable = None, interval: float = 1.0,
+                    logger: logging.Logger = None) -> None:
+    """
+    Start a thread that reports narrated calls and contexts that overrun their deadlines
+
+    Only narrate() and narrate_cm() uses given a deadline are watched. Every interval
+    seconds the watchdog calls find_overdue() and reports each record it returns; a call
+    is reported once, up to interval seconds after its deadline. Enabling the watchdog
+    again replaces the existing one.
+    :param callback: optional, callable of one argument, a dict as returned in the list
+        from find_overdue(). If not supplied, overdue calls are logged as warnings.
+    :param interval: float, optional, default 1.0. Seconds between looks.
+    :param logger: optional, logging.Logger. Where to log overdue calls if no callback
+        is given; defaults to the 'errator' logger.
+    """
+    global _watchdog
+    with _watchdog_lock:
+        _stop_watchdog()
+        _watchdog = _Watchdog(callback, interval,
+                              logger if logger is not None else logging.getLogger("errator"))
+        _watchdog.start()
+
+
+def _stop_watchdog() -> None:
+    global _watchdog
+    if _watchdog is not None:
+        _watchdog.stopping.set()
+        if _watchdog is not current_thread():
+            _watchdog.join()
+        _watchdog = None
+
+
+def disable_watchdog() -> None:
+    """
+    Stop the watchdog thread started by enable_watchdog(), if any
+    """
+    with _watchdog_lock:
+        _stop_watchdog()
+
+
+# Live inspection
+# enable_inspection() has errator mirror each thread's stack of narrated calls into a
+# shared memory file (see the live table in _errator.pyx) that read_live_table() or
+# 'python -m errator inspect <pid>' can read from another process, without stopping or
+# signalling the inspected process.
+
+def _live_table_path(pid: int) -> str:
+    return os.path.join(tempfile.gettempdir(), "errator-{}.live".format(pid))
+
+
+def enable_inspection(path: str = None, max_threads: int = 256, max_depth: int = 128,
+                      site_bytes: int = 1 << 20) -> str:
+    """
+    Start mirroring every thread's stack of narrated calls into a shared memory file
+
+    Once enabled, each call to a narrated function or entry into a narrate_cm() context
+    stores the id of its call site into the calling thread's slot in the file, and each
+    return or exit stores the thread's new call depth. The call sites' function names,
+    file names and text are written to the file once. Fragment text generated by
+    callables isn't mirrored; the callable's name and line are shown instead.
+    :param path: optional, string. The file to use. Defaults to errator-<pid>.live in the
+        system's temporary directory, which is where 'python -m errator inspect <pid>'
+        looks for it.
+    :param max_threads: int, optional, default 256. Number of thread slots; once these are
+        used, slots of threads that have finished are reused, and further threads aren't
+        mirrored.
+    :param max_depth: int, optional, default 128. The number of nested calls recorded per
+        thread; deeper calls are counted but their sites aren't recorded.
+    :param site_bytes: int, optional, default 1MB. Space for call site descriptions.
+    :return: the path of the file
+    """
+    if path is None:
+        path = _live_table_path(os.getpid())
+    _errator.enable_live_table(path, max_threads, max_depth, site_bytes // 4)
+    return path
+
+
+def disable_inspection() -> None:
+    """
+    Stop mirroring narrated calls; the file is left in place
+    """
+    _errator.disable_live_table()
+
+
+def read_live_table(pid_or_path: Union[int, str]) -> dict:
+    """
+    Read the stacks of narrated calls of each thread in a process with inspection enabled
+
+    The file is read without any coordination with the process writing it, so a stack
+    that was changing as it was read may be slightly inconsistent.
+    :param pid_or_path: either the process id of a process that called
+        enable_inspection() with the default path, or the path of the file
+    :return: a dict with keys 'pid' and 'threads'. 'threads' is a list of dicts, one per
+        thread, with keys 'name', 'ident', 'depth' and 'stack'; 'stack' is a list of
+        dicts for each narrated call the thread is in, outermost first, with keys
+        'site', 'func_name', 'source_file' and 'text'.
+    """
+    path = (_live_table_path(pid_or_path) if isinstance(pid_or_path, int)
+            else pid_or_path)
+    with open(path, "rb") as f:
+        data = f.read()
+    hdr = _errator.LIVE_HEADER_WORDS
+    words = struct.unpack_from("<{}I".format(hdr), data, 0)
+    if words[0] != _errator.LIVE_MAGIC:
+        raise ErratorException("{} is not an errator live table".format(path))
+    if words[1] != _errator.LIVE_VERSION:
+        raise ErratorException("{} has unsupported live table version {}".format(
+            path, words[1]))
+    (pid, max_threads, max_depth, slot_words, slots_base, sites_base, _, sites_used,
+     site_count) = words[2:11]
+    sites = {}
+    pos = sites_base * 4
+    end = pos + sites_used * 4
+    while pos < end and len(sites) < site_count:
+        site_id, nbytes = struct.unpack_from("<II", data, pos)
+        parts = data[pos + 8:pos + 8 + nbytes].decode("utf-8", "replace").split("\0")
+        sites[site_id] = [p or None for p in (parts + [None] * 3)[:3]]
+        pos += 8 + (nbytes + 3) // 4 * 4
+    threads = []
+    name_words = _errator.LIVE_NAME_WORDS
+    for i in range(max_threads):
+        base = (slots_base + i * slot_words) * 4
+        in_use, lo, hi, depth = struct.unpack_from("<4I", data, base)
+        if not in_use:
+            continue
+        name = data[base + 16:base + 16 + name_words * 4].rstrip(b"\0")
+        ids = struct.unpack_from("<{}I".format(min(depth, max_depth)), data,
+                                 base + (_errator.LIVE_SLOT_HEADER_WORDS * 4))
+        stack = []
+        for site_id in ids:
+            func_name, source_file, text = sites.get(site_id, (None, None, None))
+            stack.append({"site": site_id, "func_name": func_name,
+                          "source_file": source_file, "text": text})
+        threads.append({"name": name.decode("utf-8", "replace"), "ident": lo | hi << 32,
+                        "depth": depth, "stack": stack})
+    return {"pid": pid, "threads": threads}
+
+
+def _format_live_table(table: dict) -> str:
+    lines = ["process {}".format(table["pid"])]
+    for t in table["threads"]:
+        lines.append("")
+        lines.append("thread '{}' ({}), {} narrated calls deep".format(t["name"],
+                                                                    t["ident"],
+                                                                    t["depth"]))
+        for i, s in enumerate(t["stack"]):
+            where = ("  [{} in {}]".format(s["func_name"], s["source_file"])
+                     if s["func_name"] else "")
+            lines.append("{}{}{}".format("  " * (i + 1), s["text"], where))
+        if t["depth"] > len(t["stack"]):
+            lines.append("{}... {} deeper calls not recorded".format(
+                "  " * (len(t["stack"]) + 1), t["depth"] - len(t["stack"])))
+    return "\n".join(lines)
+
+
+# Prometheus metrics
+# errator counts exceptions passing through each narrated call site (see metrics in
+# _errator.pyx); these functions render the counts in Prometheus' text exposition format.
+
+def _prometheus_label(value) -> str:
+    return (str(value).replace("\\", "\\\\").replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+
+def prometheus_metrics(prefix: str = "errator") -> str:
+    """
+    Render errator's failure metrics in the Prometheus text exposition format
+
+    The metrics are:
+        <prefix>_site_failures_total: exceptions that passed out of each narrated call
+            site, labelled by func, file and (truncated) narration text
+        <prefix>_site_raised_total: exceptions that were raised from within each narrated
+            call site, rather than passing through it from a narrated call further in
+        <prefix>_exceptions_total: exceptions raised from narrated call sites, labelled by
+            exception type
+        <prefix>_format_errors_total: fragments that couldn't be formatted, either
+            raising an ErratorException or, when a narration was asked for, giving a
+            description of the failure in its place
+        <prefix>_format_seconds_total and <prefix>_format_calls_total: time spent
+            formatting fragments, and how many times one was formatted
+    As with stats(), the counts aren't locked, so on free-threaded builds of Python
+    they're approximate.
+    :param prefix: string, optional, default 'errator'. Prefix for the metric names.
+    :return: string in the exposition format
+    """
+    m = _errator.metrics_snapshot()
+    lines = []
+
+    def metric(name, help_text, samples):
+        lines.append("# HELP {}_{} {}".format(prefix, name, help_text))
+        lines.append("# TYPE {}_{} counter".format(prefix, name))
+        for labels, value in samples:
+            label_text = ",".join('{}="{}"'.format(k, _prometheus_label(v))
+                                  for k, v in labels)
+            lines.append("{}_{}{} {}".format(prefix, name,
+                                             "{%s}" % label_text if label_text else "",
+                                             value))
+
+    def site_labels(site):
+        func_name, source_file, text = site
+        return (("func", func_name or ""), ("file", source_file or ""),
+                ("text", text if len(text) <= 80 else text[:77] + "..."))
+
+    metric("site_failures_total", "Exceptions that passed out of a narrated call site.",
+           [(site_labels(site), failures) for site, failures, _ in m["sites"]])
+    metric("site_raised_total", "Exceptions raised within a narrated call site.",
+           [(site_labels(site), raised) for site, _, raised in m["sites"] if raised])
+    metric("exceptions_total", "Exceptions raised within narrated call sites by type.",
+           sorted(((("type", getattr(t, "__name__", t)),), n)
+                  for t, n in m["exceptions"].items()))
+    metric("format_errors_total", "Narration fragments that failed to format.",
+           [((), m["format_errors"])])
+    metric("format_seconds_total", "Time spent formatting narration fragments.",
+           [((), repr(m["format_seconds"]))])
+    metric("format_calls_total", "Narration fragments formatted.",
+           [((), m["format_calls"])])
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus_textfile(path: str, prefix: str = "errator") -> None:
+    """
+    Write errator's metrics to a file for the node exporter's textfile collector
+
+    The file is written under a temporary name and then renamed, so the collector never
+    reads a partially written file. Call this periodically, for example from a timer
+    thread.
+    :param path: path of the file to write; it should end in '.prom' and be in the
+        collector's directory
+    :param prefix: string, optional, default 'errator'. Prefix for the metric names.
+    """
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        f.write(prometheus_metrics(prefix))
+    os.replace(tmp_path, path)
+
+
+# Trace spans
+# SpanExporter is an observer (see add_observer()) that turns each fragment's life into a
+# span: a push starts it, a pop ends it, and a raise or passthru ends it with error status,
+# after which the following 'format' event supplies the narration text. A span's parent is
+# the span of the fragment below it in the thread's narration. Finished spans are queued
+# and handed to a backend in batches by a background thread.
+
+class JsonlSpanBackend(object):
+    """
+    A SpanExporter backend that writes each span as a line of JSON
+    """
+    def __init__(self, file_or_path):
+        """
+        :param file_or_path: either an open text file-like object, or the path of a file
+            to append to (which is opened here and closed by close())
+        """
+        if isinstance(file_or_path, str):
+            self.file = open(file_or_path, "a", encoding="utf-8")
+            self._owned = True
+        else:
+            self.file = file_or_path
+            self._owned = False
+
+    def __call__(self, spans: List[dict]) -> None:
+        self.file.write("".join("{}\n".format(json.dumps(s, separators=(",", ":")))
+                                for s in spans))
+        self.file.flush()
+
+    def close(self) -> None:
+        if self._owned:
+            self.file.close()
+
+
+class SocketSpanBackend(object):
+    """
+    A SpanExporter backend that sends each span as a JSON datagram to a local collector
+    """
+    def __init__(self, address: Union[tuple, str]):
+        """
+        :param address: either a (host, port) tuple, to send UDP datagrams, or the path of
+            a Unix domain datagram socket
+        """
+        family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+        self.address = address
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+
+    def __call__(self, spans: List[dict]) -> None:
+        for s in spans:
+            self.sock.sendto(json.dumps(s, separators=(",", ":")).encode("utf-8"),
+                             self.address)
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+class SpanExporter(_BatchWorker):
+    """
+    Exports narrated calls and contexts as trace spans
+
+    Each span is a dict with the keys trace_id and span_id (hex strings), parent_id (the
+    span_id of the enclosing narrated call, or None), name (the narrated function's name,
+    or for narrate_cm() the text it was given, or the callable's qualified name),
+    source_file, thread, depth (1 for the outermost narrated call), start_ns and end_ns
+    (from time.time_ns()), status ('ok' or 'error'), and, for spans with error status,
+    text (the fragment's narration text) and exception (the exception text, if the
+    exception was raised within this span rather than passing through it).
+
+    Spans are only recorded for fragments pushed while the exporter is open. Recording
+    happens in the narrated thread and is a few dict operations per fragment; the
+    backend is only ever called from the exporter's worker thread.
+    """
+    def __init__(self, backend: Callable, max_queue: int = 10000,
+                 overflow: str = _BatchWorker.DROP_NEWEST, batch_size: int = 500,
+                 flush_interval: float = 1.0):
+        """
+        Create an exporter, start its worker thread and start observing fragments
+        :param backend: callable which is called with a list of span dicts for each
+            batch, such as a JsonlSpanBackend or SocketSpanBackend. If it has a close()
+            method, that's called when the exporter is closed.
+        :param max_queue: int, optional, default 10000. The maximum number of finished
+            spans that may be waiting to be exported.
+        :param overflow: string, optional, one of SpanExporter.DROP_NEWEST (the default)
+            or SpanExporter.DROP_OLDEST. Which span to discard when the queue is full.
+        :param batch_size: int, optional, default 500. Maximum number of spans given to
+            the backend at one time.
+        :param flush_interval: float, optional, default 1.0. Maximum number of seconds a
+            span waits in the queue before it's exported.
+        """
+        self.backend = backend
+        self._local = local()
+        super(SpanExporter, self).__init__(max_queue, overflow, batch_size,
+                                           flush_interval, "errator-spans")
+        add_observer(self._observe)
+
+    def close(self, timeout: float = None) -> None:
+        """
+        Stop observing fragments, export any queued spans, stop the worker thread and
+        close the backend
+        :param timeout: optional, float. Maximum number of seconds to wait for the worker.
+        """
+        remove_observer(self._observe)
+        super(SpanExporter, self).close(timeout)
+        close = getattr(self.backend, "close", None)
+        if close is not None:
+            close()
+
+    def _observe(self, event: str, fragment: NarrationFragment) -> None:
+        state = self._local
+        try:
+            spans = state.spans
+        except AttributeError:
+            spans = state.spans = []
+            state.pending = None
+        pending = state.pending
+        if pending is not None:
+            state.pending = None
+            if event == "format" and pending[0] is fragment:
+                span = pending[1]
+                span["text"] = str(fragment.text_or_func)
+                self.put(span)
+                return
+            self.put(pending[1])
+        if event == "push":
+            thread = current_thread()
+            depth = len(_thread_fragments[thread.name])
+            while spans and spans[-1][1]["depth"] >= depth:
+                spans.pop()
+            parent = spans[-1][1] if spans and spans[-1][1]["depth"] == depth - 1 else None
+            spans.append((fragment, {
+                "trace_id": (parent["trace_id"] if parent is not None
+                             else "%032x" % random.getrandbits(128)),
+                "span_id": "%016x" % random.getrandbits(64),
+                "parent_id": parent["span_id"] if parent is not None else None,
+                "name": _site_text(fragment) or fragment.func_name,
+                "source_file": fragment.source_file,
+                "thread": thread.name, "depth": depth,
+                "start_ns": time.time_ns(), "end_ns": None, "status": "ok"}))
+        elif event != "format":
+            for i in range(len(spans) - 1, -1, -1):
+                if spans[i][0] is fragment:
+                    break
+            else:
+                return
+            span = spans[i][1]
+            span["end_ns"] = time.time_ns()
+            del spans[i:]
+            if event == "pop":
+                self.put(span)
+            else:
+                span["status"] = "error"
+                if event == "raise":
+                    span["exception"] = fragment.exception_text
+                state.pending = (fragment, span)
+
+    def _write(self, batch: list):
+        self.backend(batch)
+
+
+# Offline analysis of narration logs
+# Narrations written as JSON lines (by a NarrationSink using format_record_json) can be
+# summarised with analyze(), or from the command line with 'python -m errator analyze'.
+
+def record_fingerprint(record: dict) -> str:
+    """
+    Compute a fingerprint for a narration record that identifies its failure path
+
+    The fingerprint is computed from the call site (source file and function name, and
+    for narrate_cm() fragments the text or callable that identifies the context) of each
+    fragment and the exception type; fragment text, and hence any argument values in
+    it, is ignored, so narrations of the same failure with different data share a
+    fingerprint. A narrate_cm() site given text built for each use is identified by the
+    first text it was given in the process that recorded it.
+    :param record: a dict as returned by narration_record()
+    :return: a 16 character hex string
+    """
+    return _fingerprint([(f.get("source_file"), f.get("func_name"), f.get("site"))
+                         for f in record["fragments"]], record.get("exception"))
+
+
+def _fingerprint(sites: Iterable[tuple], exception: str) -> str:
+    h = hashlib.blake2b(digest_size=8)
+    for source_file, func_name, site in sites:
+        h.update("{}:{}:{}\0".format(source_file, func_name, site).encode())
+    h.update(str(exception).encode())
+    return h.hexdigest()
+
+
+def _open_narration_log(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, "r", encoding="utf-8", errors="replace")
+
+
+def _analyze_file(path: str, since: float = None, until: float = None) -> tuple:
+    # returns a dict of fingerprint -> summary for the file, and a count of unusable lines
+    groups = {}
+    bad = 0
+    with _open_narration_log(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                ts = record["time"]
+                fragments = record["fragments"]
+            except (ValueError, KeyError, TypeError):
+                bad += 1
+                continue
+            if (since is not None and ts < since) or (until is not None and ts >= until):
+                continue
+            fp = record_fingerprint(record)
+            g = groups.get(fp)
+            if g is None:
+                groups[fp] = {"fingerprint": fp, "count": 1, "first_seen": ts,
+                              "last_seen": ts, "exception": record.get("exception"),
+                              "path": [f.get("func_name") or f.get("site") or "<context>"
+                                       for f in fragments],
+                              "example": [f.get("text") for f in fragments]}
+            else:
+                g["count"] += 1
+                if ts < g["first_seen"]:
+                    g["first_seen"] = ts
+                    g["example"] = [f.get("text") for f in fragments]
+                if ts > g["last_seen"]:
+                    g["last_seen"] = ts
+    return groups, bad
+
+
+def analyze(paths: Iterable[str], since: float = None, until: float = None,
+            top: int = 20, processes: int = None) -> dict:
+    """
+    Summarise JSON lines narration logs by failure path
+
+    Each file is read a line at a time, so files of any size can be processed; when there
+    is more than one file, they're processed in parallel in a pool of processes. Files
+    whose names end in '.gz' are decompressed as they're read.
+    :param paths: iterable of paths to files of JSON narration records, as written by a
+        NarrationSink using format_record_json
+    :param since: optional, float. Only consider narrations captured at or after this
+        time (seconds since the epoch).
+    :param until: optional, float. Only consider narrations captured before this time.
+    :param top: int, optional, default 20. The number of failure paths to report.
+    :param processes: int, optional. Maximum number of worker processes; defaults to the
+        number of CPUs.
+    :return: a dict with keys 'total' (the number of narrations considered),
+        'unreadable' (the number of lines that couldn't be parsed), and 'groups', a list
+        of dicts of the 'top' most frequent failure paths, most frequent first. Each
+        group has the keys 'fingerprint', 'count', 'first_seen', 'last_seen',
+        'exception', 'path' (the function names of the fragments) and 'example' (the
+        fragment text of the earliest narration in the group).
+    """
+    paths = list(paths)
+    if len(paths) <= 1 or processes == 1:
+        results = [_analyze_file(p, since, until) for p in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(_analyze_file, paths, [since] * len(paths),
+                                    [until] * len(paths)))
+    merged = {}
+    bad = 0
+    for groups, file_bad in results:
+        bad += file_bad
+        for fp, g in groups.items():
+            m = merged.get(fp)
+            if m is None:
+                merged[fp] = g
+            else:
+                m["count"] += g["count"]
+                if g["first_seen"] < m["first_seen"]:
+                    m["first_seen"] = g["first_seen"]
+                    m["example"] = g["example"]
+                m["last_seen"] = max(m["last_seen"], g["last_seen"])
+    ordered = sorted(merged.values(), key=lambda g: (-g["count"], g["first_seen"]))
+    return {"total": sum(g["count"] for g in ordered), "unreadable": bad,
+            "groups": ordered[:top]}
+
+
+def _parse_time(value: str) -> float:
+    # either seconds since the epoch, or an age such as '90s', '30m', '1h' or '2d'
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if value and value[-1] in units:
+        return time.time() - float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
+def _format_analysis(result: dict) -> str:
+    def when(ts):
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
+
+    lines = ["{} narrations, {} unreadable lines".format(result["total"],
+                                                        result["unreadable"])]
+    for g in result["groups"]:
+        lines.append("")
+        lines.append("{:>8}  {}  {} .. {}".format(g["count"], g["fingerprint"],
+                                                  when(g["first_seen"]),
+                                                  when(g["last_seen"])))
+        lines.append("          {}: {}".format(g["exception"], " > ".join(g["path"])))
+        lines.extend("            " + (t or "").replace("\n", "\n            ")
+                     for t in g["example"])
+    return "\n".join(lines)
+
+
+# Measuring overhead in an application's own workload
+# measure_overhead() runs a workload in two child processes: one as normal, and one in
+# which narrate() and narrate_cm() are replaced by pass-throughs before the workload's
+# module is imported. The normal child also makes one profiled run for the per-site
+# breakdown (see enable_profiling()).
+
+def _resolve_workload(target: str) -> Callable:
+    module_name, _, attr = target.partition(":")
+    if "" not in sys.path:
+        sys.path.insert(0, "")
+    obj = importlib.import_module(module_name)
+    for part in attr.split("."):
+        obj = getattr(obj, part)
+    return obj
+
+
+def _passthrough_narrate(str_or_func, tags: Iterable[str] = None, deadline: float = None):
+    return lambda m: m
+
+
+_null_cm = nullcontext()
+
+
+def _passthrough_narrate_cm(text_or_func, *args, **kwargs):
+    return _null_cm
+
+
+def _overhead_child(target: str, mode: str, repeat: int, warmup: int,
+                    result_file: str) -> None:
+    if mode == "passthru":
+        errator_module = sys.modules.get("errator")
+        if errator_module is None:
+            import errator as errator_module
+        for module in {errator_module, sys.modules[__name__]}:
+            module.narrate = _passthrough_narrate
+            module.narrate_cm = _passthrough_narrate_cm
+        _errator.narrate = _passthrough_narrate
+    workload = _resolve_workload(target)
+    for _ in range(warmup):
+        workload()
+    times = []
+    for _ in range(repeat):
+        reset_narration()
+        start = time.perf_counter_ns()
+        workload()
+        times.append(time.perf_counter_ns() - start)
+    sites = []
+    if mode == "normal":
+        reset_narration()
+        enable_profiling()
+        try:
+            workload()
+        finally:
+            disable_profiling()
+        sites = profile_data()
+    with open(result_file, "w") as f:
+        json.dump({"times_ns": times, "sites": sites}, f)
+
+
+def measure_overhead(target: str, repeat: int = 5, warmup: int = 1) -> dict:
+    """
+    Measure what narration costs in a workload of your own
+
+    The workload is run in a child process as normal, and in another with narrate() and
+    narrate_cm() replaced by pass-throughs that add no narration, and the times compared.
+    The workload's module mustn't be imported before errator, or have narrated functions
+    in modules imported before errator is; it's imported in each child after the
+    replacement is made. The normal child also runs the workload once more with profiling
+    enabled to find errator's own time at each narrated call site.
+    :param target: string, 'module:callable'. The callable is called with no arguments,
+        once per run; the module is imported from the current directory or sys.path.
+    :param repeat: int, optional, default 5. Number of timed runs in each child.
+    :param warmup: int, optional, default 1. Number of untimed runs first.
+    :return: dict with keys 'target', 'repeat', 'narrated_seconds' and
+        'passthru_seconds' (median run times), 'narrated_min_seconds' and
+        'passthru_min_seconds', 'overhead_seconds' (the difference of the medians per
+        run), 'overhead_fraction' (relative to the pass-through time) and 'sites' (a
+        list of dicts as from profile_data() for the profiled run)
+    """
+    module_name, _, attr = target.partition(":")
+    if not module_name or not attr:
+        raise ErratorException("workload must be given as module:callable, "
+                               "not {}".format(target))
+    env = dict(os.environ)
+    here = os.path.dirname(os.path.abspath(__file__))
+    env["PYTHONPATH"] = os.pathsep.join(p for p in (here, env.get("PYTHONPATH")) if p)
+    runs = {}
+    with tempfile.TemporaryDirectory(prefix="errator-overhead-") as tmp:
+        for mode in ("normal", "passthru"):
+            result_file = os.path.join(tmp, mode + ".json")
+            subprocess.run([sys.executable, "-m", "errator", "overhead", target,
+                            "--repeat", str(repeat), "--warmup", str(warmup),
+                            "--mode", mode, "--result-file", result_file],
+                           env=env, check=True)
+            with open(result_file) as f:
+                runs[mode] = json.load(f)
+    narrated = median(runs["normal"]["times_ns"]) / 1e9
+    passthru = median(runs["passthru"]["times_ns"]) / 1e9
+    return {"target": target, "repeat": repeat,
+            "narrated_seconds": narrated, "passthru_seconds": passthru,
+            "narrated_min_seconds": min(runs["normal"]["times_ns"]) / 1e9,
+            "passthru_min_seconds": min(runs["passthru"]["times_ns"]) / 1e9,
+            "overhead_seconds": narrated - passthru,
+            "overhead_fraction": (narrated - passthru) / passthru if passthru else None,
+            "sites": runs["normal"]["sites"]}
+
+
+def _format_overhead(result: dict, limit: int = 20) -> str:
+    lines = ["workload {}, median of {} runs".format(result["target"], result["repeat"]),
+             "  narrated:     {:10.3f} ms".format(result["narrated_seconds"] * 1000),
+             "  pass-through: {:10.3f} ms".format(result["passthru_seconds"] * 1000),
+             "  overhead:     {:10.3f} ms per run{}".format(
+                 result["overhead_seconds"] * 1000,
+                 "" if result["overhead_fraction"] is None
+                 else " ({:+.1%})".format(result["overhead_fraction"])),
+             "",
+             "errator's own time per call site, in one profiled run:"]
+    return "\n".join(lines + _profile_table(result["sites"][:limit]))
+
+
+def main(argv: List[str] = None) -> int:
+    """
+    Entry point for 'python -m errator'
+    """
+    parser = argparse.ArgumentParser(prog="python -m errator")
+    commands = parser.add_subparsers(dest="command")
+    p = commands.add_parser("analyze", help="summarise JSON lines narration logs by "
+                                            "failure path")
+    p.add_argument("files", nargs="+", help="narration log files (.gz allowed)")
+    p.add_argument("--since", type=_parse_time,
+                   help="only narrations after this time: seconds since the epoch, or "
+                        "an age like 30m, 1h or 2d")
+    p.add_argument("--until", type=_parse_time, help="only narrations before this time")
+    p.add_argument("--top", type=int, default=20, help="number of failure paths to "
+                                                       "report (default 20)")
+    p.add_argument("-j", "--processes", type=int, default=None,
+                   help="number of worker processes (default: number of CPUs)")
+    p.add_argument("--json", action="store_true", help="write the report as JSON")
+    p = commands.add_parser("ring", help="recover narrations from a ring file")
+    p.add_argument("file", help="ring file written by NarrationRingFile")
+    p.add_argument("-n", "--last", type=int, default=None,
+                   help="only show the most recent LAST narrations")
+    p.add_argument("--json", action="store_true", help="write the narrations as JSON "
+                                                       "lines")
+    p = commands.add_parser("inspect", help="show what each thread of a process with "
+                                            "inspection enabled is in the middle of")
+    p.add_argument("pid", help="process id, or the path of a live table file")
+    p.add_argument("--json", action="store_true", help="write the stacks as JSON")
+    p = commands.add_parser("overhead", help="measure what narration costs in a workload "
+                                             "of your own")
+    p.add_argument("target", help="the workload, as module:callable; the callable is "
+                                  "called with no arguments")
+    p.add_argument("--repeat", type=int, default=5, help="timed runs (default 5)")
+    p.add_argument("--warmup", type=int, default=1, help="untimed runs first (default 1)")
+    p.add_argument("--top", type=int, default=20, help="number of call sites to report "
+                                                       "(default 20)")
+    p.add_argument("--json", action="store_true", help="write the report as JSON")
+    p.add_argument("--mode", choices=("normal", "passthru"), help=argparse.SUPPRESS)
+    p.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.command == "overhead":
+        if args.mode is not None:
+            _overhead_child(args.target, args.mode, args.repeat, args.warmup,
+                            args.result_file)
+            return 0
+        result = measure_overhead(args.target, repeat=args.repeat, warmup=args.warmup)
+        result["sites"] = result["sites"][:args.top]
+        print(json.dumps(result, indent=2) if args.json
+              else _format_overhead(result, limit=args.top))
+        return 0
+    if args.command == "inspect":
+        table = read_live_table(int(args.pid) if args.pid.isdigit() else args.pid)
+        print(json.dumps(table, indent=2) if args.json else _format_live_table(table))
+        return 0
+    if args.command == "ring":
+        for record in read_ring_file(args.file, last=args.last):
+            print(format_record_json(record) if args.json else format_record_text(record))
+        return 0
+    if args.command == "analyze":
+        result = analyze(args.files, since=args.since, until=args.until, top=args.top,
+                         processes=args.processes)
+        print(json.dumps(result, indent=2) if args.json else _format_analysis(result))
+        return 0
+    parser.print_help()
+    return 2
+
+
 __all__ = ("narrate", "narrate_cm", "copy_narration", "NarrationFragment",
            "NarrationFragmentContextManager", "reset_all_narrations", "reset_narration",
            "get_narration", "set_narration_options", "ErratorException",
            "set_default_options", "extract_tb", "extract_stack", "format_tb",
            "format_stack", "format_exception_only", "format_exception", "print_tb",
-           "print_exception", "print_exc", "format_exc", "print_last", "print_stack")
+           "print_exception", "print_exc", "format_exc", "print_last", "print_stack",
+           "NarrationSink", "narration_record", "format_record_text",
+           "format_record_json", "LazyNarration", "NarrationFilter",
+           "NarrationFormatter", "NarrationStore", "record_fingerprint", "analyze",
+           "narration_fingerprint", "NarrationSuppressor", "NarrationRingFile",
+           "read_ring_file", "enable_inspection", "disable_inspection",
+           "read_live_table", "prometheus_metrics", "write_prometheus_textfile",
+           "stats", "reset_stats", "enable_profiling", "disable_profiling",
+           "profile_data", "profile_report", "add_observer", "remove_observer",
+           "SpanExporter", "JsonlSpanBackend", "SocketSpanBackend", "find_overdue",
+           "enable_watchdog", "disable_watchdog", "measure_overhead",
+           "narration_of", "narration_scope")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
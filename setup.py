@@ -2,13 +2,19 @@
 Use this setup for Python3 builds of errator
 """
 
+import re
 from distutils.core import setup
+from Cython import __version__ as cython_version
 from Cython.Build import cythonize
 
+directives = {'language_level': '3', 'embedsignature': True}
+# only the leading major.minor digits, as pre-releases are versioned like 3.1b2 or 3.1.0a1
+if tuple(int(v) for v in re.match(r"(\d+)\.(\d+)", cython_version).groups()) >= (3, 1):
+    # lets the extension load on free-threaded Python without enabling the GIL
+    directives['freethreading_compatible'] = True
+
 ext_modules = []
-ext_modules.extend(cythonize("_errator.pyx",
-                             compiler_directives={'language_level': '3',
-                                                  'embedsignature': True}))
+ext_modules.extend(cythonize("_errator.pyx", compiler_directives=directives))
 
 version = "0.4"
 
@@ -22,7 +28,7 @@ def get_readme():
 setup(
     name="errator",
     ext_modules=ext_modules,
-    py_modules=["errator"],
+    py_modules=["errator", "_errator_py"],
     version=version,
     description="Errator allows you to create human-readable exception narrations",
     long_description=get_readme(),
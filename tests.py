@@ -1,8 +1,9 @@
 import traceback
 import sys
 import threading
+import time
 from errator import *
-from _errator import (_thread_fragments,)
+from errator import _thread_fragments, ErratorDeque
 from io import StringIO
 
 
@@ -1320,6 +1321,1381 @@ def test57():
         assert len(get_narration(with_tags=["common"])) == 2
 
 
+def test58():
+    """
+    test58: check that a NarrationSink writes submitted narrations to a file
+    """
+    set_narration_options(check=False, verbose=False)
+    reset_all_narrations()
+
+    @narrate("test58 outer")
+    def f1():
+        f2(3)
+
+    @narrate(lambda x: f"test58 inner with {x}")
+    def f2(x):
+        raise KeyError("sunk")
+
+    out = StringIO()
+    sink = NarrationSink(out, flush_interval=0.05)
+    try:
+        f1()
+    except KeyError:
+        assert sink.submit()
+    sink.close()
+    text = out.getvalue()
+    assert "test58 outer" in text and "KeyError" in text, f"got: {text}"
+    assert sink.counters()["written"] == 1, f"got: {sink.counters()}"
+
+
+def test59():
+    """
+    test59: check that a full NarrationSink drops the newest narration and counts it
+    """
+    import json
+    reset_all_narrations()
+    gate = threading.Event()
+    batches = []
+
+    def handler(items):
+        gate.wait(5)
+        batches.append(items)
+
+    sink = NarrationSink(handler, max_queue=2, batch_size=1, flush_interval=0.01,
+                         formatter=format_record_json)
+    with narrate_cm("test59"):
+        results = [sink.submit() for _ in range(10)]
+    gate.set()
+    sink.close()
+    c = sink.counters()
+    assert results.count(False) == c["dropped"] and c["dropped"] >= 7, f"got: {c}"
+    assert c["written"] + c["dropped"] == 10, f"got: {c}"
+    assert json.loads(batches[0][0])["fragments"][0]["text"].strip() == "test59"
+
+
+def test60():
+    """
+    test60: check that DROP_OLDEST keeps the most recent narrations
+    """
+    reset_all_narrations()
+    gate = threading.Event()
+    written = []
+
+    def handler(items):
+        gate.wait(5)
+        written.extend(items)
+
+    sink = NarrationSink(handler, max_queue=3, batch_size=1, flush_interval=0.01,
+                         overflow=NarrationSink.DROP_OLDEST, formatter=None)
+    sink.put((0.0, "t", [], False, None))
+    while not sink._in_flight:
+        time.sleep(0.001)  # wait for the worker to block in the handler
+    for i in range(1, 10):
+        assert sink.put((float(i), "t", [], False, None))
+    gate.set()
+    assert sink.flush(timeout=5)
+    sink.close()
+    assert [r["time"] for r in written] == [0.0, 7.0, 8.0, 9.0], f"got {written}"
+    assert sink.counters()["dropped"] == 6
+
+
+def test61():
+    """
+    test61: check that NarrationFilter/NarrationFormatter add the narration to an emitted
+    log record
+    """
+    import logging
+    reset_all_narrations()
+    out = StringIO()
+    handler = logging.StreamHandler(out)
+    handler.setFormatter(NarrationFormatter("%(message)s"))
+    logger = logging.getLogger("errator.test61")
+    logger.propagate = False
+    logger.addHandler(handler)
+    logger.addFilter(NarrationFilter())
+
+    @narrate("test61 narration")
+    def f():
+        raise KeyError("nope")
+
+    try:
+        f()
+    except KeyError:
+        logger.info("not an exception")
+        logger.exception("it failed")
+    text = out.getvalue()
+    assert text.count("test61 narration") == 1, f"got: {text}"
+    assert text.index("it failed") < text.index("test61 narration")
+
+
+def test62():
+    """
+    test62: check that a record's narration isn't changed by resetting the narration
+    after the record was logged
+    """
+    import logging
+
+    class Keep(logging.Handler):
+        def __init__(self):
+            super().__init__()
+            self.records = []
+
+        def emit(self, record):
+            self.records.append(record)
+
+    reset_all_narrations()
+    keeper = Keep()
+    logger = logging.getLogger("errator.test62")
+    logger.propagate = False
+    logger.addHandler(keeper)
+    logger.addFilter(NarrationFilter(exceptions_only=False))
+    logger.setLevel(logging.WARNING)
+
+    @narrate("test62 narration")
+    def f():
+        raise KeyError("nope")
+
+    try:
+        f()
+    except KeyError:
+        logger.info("filtered out")
+        logger.warning("kept")
+        reset_narration()
+    assert len(keeper.records) == 1
+    assert str(keeper.records[0].narration).startswith("test62 narration")
+    assert keeper.records[0].narration.fragments()[0]["func_name"] == "f"
+
+
+def test63():
+    """
+    test63: check that a NarrationStore can be written by a sink and queried
+    """
+    import os
+    import tempfile
+    set_narration_options(verbose=False)
+    reset_all_narrations()
+
+    @narrate("test63 outer", tags=["store"])
+    def f1(x):
+        f2(x)
+
+    @narrate(lambda x: f"test63 inner {x}")
+    def f2(x):
+        if x % 2:
+            raise KeyError(x)
+        raise ValueError(x)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = NarrationStore(os.path.join(tmp, "narrations.db"))
+        with NarrationSink(store, formatter=None, flush_interval=0.01) as sink:
+            for i in range(10):
+                try:
+                    f1(i)
+                except Exception:
+                    sink.submit()
+                    reset_narration()
+        assert sink.counters()["written"] == 10, f"got {sink.counters()}"
+        assert len(store.query()) == 10
+        assert len(store.query(exception="KeyError")) == 5
+        assert len(store.query(func_name="f2", tag="store")) == 10
+        assert len(store.query(func_name="nope")) == 0
+        assert len(store.query(since=time.time() + 60)) == 0
+        r = store.query(limit=1)[0]
+        assert r["fragments"][0]["tags"] == ["store"]
+        assert r["fragments"][1]["text"].startswith("test63 inner 9"), f"got: {r}"
+        counts = store.site_counts()
+        assert sorted(c[2:] for c in counts) == [("KeyError", 5), ("ValueError", 5)]
+        store.close()
+        # a small cache looks strings up again, and a failed batch forgets the strings
+        # it inserted
+        small = NarrationStore(os.path.join(tmp, "narrations.db"), cache_size=2)
+        small.write([r])
+        assert len(small._string_ids) == 2
+        bad = dict(r, thread="test63 new thread", fragments=[{"func_name": "test63 new"}])
+        try:
+            small.write([bad])
+        except KeyError:
+            pass
+        else:
+            assert False, "incomplete record was written"
+        assert "test63 new thread" not in small._string_ids
+        small.write([dict(r, thread="test63 new thread")])
+        assert len(small.query()) == 12
+        small.close()
+
+
+def test64():
+    """
+    test64: check that analyze() groups narrations across files by failure path
+    """
+    import os
+    import tempfile
+    import errator
+    set_narration_options(verbose=False)
+    reset_all_narrations()
+
+    @narrate(lambda x: f"test64 outer {x}")
+    def f1(x):
+        f2(x)
+
+    @narrate("test64 inner")
+    def f2(x):
+        if x % 3:
+            raise KeyError(x)
+        raise ValueError(x)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [os.path.join(tmp, f"log{i}.jsonl") for i in range(2)]
+        for i, path in enumerate(paths):
+            with open(path, "w") as out, NarrationSink(out, formatter=format_record_json,
+                                                       flush_interval=0.01) as sink:
+                for j in range(6):
+                    try:
+                        f1(i * 6 + j)
+                    except Exception:
+                        sink.submit()
+                        reset_narration()
+            if i:
+                with open(path, "a") as out:
+                    out.write("not json\n")
+        result = analyze(paths, processes=2)
+        assert result["total"] == 12 and result["unreadable"] == 1, f"got {result}"
+        groups = result["groups"]
+        assert [(g["exception"], g["count"]) for g in groups] == [("KeyError", 8),
+                                                                ("ValueError", 4)]
+        assert groups[0]["path"] == ["f1", "f2"]
+        assert groups[1]["example"][0] == "test64 outer 0", f"got {groups[1]}"
+        assert analyze(paths, since=time.time() + 60)["total"] == 0
+
+        out = StringIO()
+        old_stdout, sys.stdout = sys.stdout, out
+        try:
+            assert errator.main(["analyze", "--top", "1", paths[0]]) == 0
+        finally:
+            sys.stdout = old_stdout
+        assert "KeyError: f1 > f2" in out.getvalue(), f"got {out.getvalue()}"
+
+
+def test65():
+    """
+    test65: check that narration_fingerprint ignores argument values and agrees with
+    record_fingerprint
+    """
+    set_narration_options(verbose=False)
+    reset_all_narrations()
+
+    @narrate(lambda x: f"test65 {x}")
+    def f(x):
+        raise KeyError(x)
+
+    prints = []
+    for i in range(2):
+        try:
+            f(i)
+        except KeyError:
+            prints.append(narration_fingerprint())
+            record = narration_record(copy_narration(), exception="KeyError")
+            assert record_fingerprint(record) == prints[-1]
+            reset_narration()
+    assert prints[0] == prints[1]
+    try:
+        f(1)
+    except KeyError:
+        assert narration_fingerprint(exception="ValueError") != prints[0]
+        reset_narration()
+
+
+def test66():
+    """
+    test66: check that NarrationSuppressor only emits the first 'limit' narrations of a
+    failure path in a window, then summarises the rest
+    """
+    set_narration_options(verbose=False)
+    reset_all_narrations()
+    now = [0.0]
+    emitted = []
+    sup = NarrationSuppressor(emitted.append, limit=2, window=10.0,
+                              clock=lambda: now[0])
+
+    @narrate(lambda x: f"test66 {x}")
+    def f(x):
+        raise KeyError(x)
+
+    results = []
+    for i in range(50):
+        try:
+            f(i)
+        except KeyError:
+            results.append(sup.report())
+            reset_narration()
+    assert results.count(True) == 2 and sup.suppressed == 48
+    assert emitted[1][0].startswith("test66 1"), f"got {emitted}"
+    now[0] = 11.0
+    sup.flush()
+    assert len(emitted) == 3 and "(KeyError) repeated 48 times" in emitted[2][0], \
+        f"got {emitted[2]}"
+    sup.flush(force=True)
+    assert len(emitted) == 3
+
+
+def test67():
+    """
+    test67: check that narrations written to a ring file can be recovered, including
+    after the ring wraps around
+    """
+    import os
+    import tempfile
+    set_narration_options(verbose=False)
+    reset_all_narrations()
+
+    @narrate(lambda x: f"test67 {x}", tags=["ring"])
+    def f(x):
+        raise KeyError(x)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "test67.ring")
+        ring = NarrationRingFile(path, size=1000)
+        for i in range(40):
+            try:
+                f(i)
+            except KeyError:
+                assert ring.capture()
+                reset_narration()
+        records = read_ring_file(path)
+        assert 0 < len(records) < 40
+        last = records[-1]
+        assert last["seq"] == 40 and last["exception"] == "KeyError"
+        assert last["fragments"][0]["text"].startswith("test67 39"), f"got {last}"
+        assert last["fragments"][0]["tags"] == ["ring"]
+        assert [r["seq"] for r in read_ring_file(path, last=3)] == [38, 39, 40]
+        assert not ring.write_record(narration_record(
+            [NarrationFragment("x" * 2000, None)]))
+        ring.close()
+
+        # damage the most recent record; it should be skipped
+        with open(path, "r+b") as fh:
+            fh.seek(24)
+            offset = int.from_bytes(fh.read(8), "little")
+            fh.seek(64 + offset - 5)
+            fh.write(b"XXXXX")
+        assert read_ring_file(path)[-1]["seq"] == 39
+
+
+def test68():
+    """
+    test68: check that the live table mirrors the stacks of narrated calls in each thread
+    """
+    import os
+    import tempfile
+    reset_all_narrations()
+    seen = {}
+    inside = threading.Event()
+    finish = threading.Event()
+
+    @narrate("test68 outer")
+    def f1():
+        with narrate_cm("test68 cm"):
+            f2()
+
+    @narrate(lambda: "test68 inner")
+    def f2():
+        seen["main"] = read_live_table(path)
+
+    @narrate("test68 waiting")
+    def waiter():
+        inside.set()
+        finish.wait(5)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = enable_inspection(os.path.join(tmp, "test68.live"), max_threads=4,
+                                 max_depth=2)
+        try:
+            t = threading.Thread(target=waiter, name="test68-thread")
+            t.start()
+            inside.wait(5)
+            f1()
+            finish.set()
+            t.join()
+            after = read_live_table(path)
+        finally:
+            disable_inspection()
+    threads = {t["name"]: t for t in seen["main"]["threads"]}
+    me = threads[threading.current_thread().name]
+    assert me["depth"] == 3, f"got {me}"
+    assert [s["text"] for s in me["stack"]] == ["test68 outer", "test68 cm"]
+    assert me["stack"][0]["func_name"] == "f1"
+    assert threads["test68-thread"]["stack"][0]["text"] == "test68 waiting"
+    assert seen["main"]["pid"] == os.getpid()
+    assert all(t["depth"] == 0 for t in after["threads"]), f"got {after}"
+
+
+def test69():
+    """
+    test69: check that failures are counted per call site and rendered for Prometheus
+    """
+    import os
+    import tempfile
+    set_narration_options(check=False)
+    reset_all_narrations()
+
+    class Test69Error(Exception):
+        pass
+
+    @narrate("test69 outer")
+    def f1():
+        with narrate_cm('test69 "cm"'):
+            f2()
+
+    @narrate("test69 inner")
+    def f2():
+        raise Test69Error()
+
+    @narrate(lambda: 1 / 0)
+    def f3():
+        raise KeyError()
+
+    for _ in range(3):
+        try:
+            f1()
+        except Test69Error:
+            reset_narration()
+    try:
+        f3()
+    except ErratorException:
+        reset_narration()
+    text = prometheus_metrics()
+    assert 'errator_exceptions_total{type="Test69Error"} 3' in text, text
+    lines = [l for l in text.splitlines() if "test69 inner" in l]
+    assert len(lines) == 2 and all(l.endswith(" 3") for l in lines), lines
+    assert any(l.startswith("errator_site_failures_total{") and
+               'text="test69 \\"cm\\""' in l and l.endswith(" 3")
+               for l in text.splitlines()), text
+    assert not any(l.startswith("errator_site_raised_total") and "test69 outer" in l
+                   for l in text.splitlines())
+    assert [int(l.split()[1]) for l in text.splitlines()
+            if l.startswith("errator_format_errors_total ")][0] >= 1
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "errator.prom")
+        write_prometheus_textfile(path)
+        assert os.listdir(tmp) == ["errator.prom"]
+
+
+def test70():
+    """
+    test70: check the counters returned by stats()
+    """
+    set_narration_options(check=False, verbose=False)
+    reset_all_narrations()
+
+    @narrate("test70 outer")
+    def f1():
+        try:
+            f2()
+        except KeyError:
+            pass
+        with narrate_cm("test70 cm"):
+            pass
+
+    @narrate("test70 inner")
+    def f2():
+        f3()
+
+    @narrate("test70 innermost")
+    def f3():
+        raise KeyError()
+
+    f1()
+    reset_stats()
+    s0 = stats()
+    me = threading.current_thread().name
+    assert s0["threads"][me] == {"depth": 0, "peak_depth": 0}, f"got {s0}"
+    f1()
+    s1 = stats()
+    # the fragments for f2 and f3 are left over when the cm is entered, and are
+    # discarded when f1 returns
+    assert s1["threads"][me]["peak_depth"] == 4, f"got {s1}"
+    assert s1["fragments_created"] == 0 and s1["fragments_reused"] == 4, f"got {s1}"
+    assert s1["orphaned_fragments"] == 2, f"got {s1}"
+    assert s1["format_calls"] == 2 and s1["stack_walks"] == 0, f"got {s1}"
+    assert s1["pool_sizes"]["NarrationFragmentContextManager"] >= 1
+    set_narration_options(verbose=True)
+    try:
+        f2()
+    except KeyError:
+        pass
+    finally:
+        set_narration_options(verbose=False)
+        reset_narration()
+    assert stats()["stack_walks"] == 1
+
+
+def test71():
+    """
+    test71: check that profiling counts calls, failures and self time per site
+    """
+    import json
+    reset_all_narrations()
+
+    @narrate("test71 hot")
+    def hot(x):
+        if x < 0:
+            raise ValueError(x)
+        return x
+
+    def cold():
+        with narrate_cm("test71 cm"):
+            pass
+
+    hot(1)
+    enable_profiling()
+    try:
+        for i in range(100):
+            hot(i)
+            cold()
+        try:
+            hot(-1)
+        except ValueError:
+            reset_narration()
+    finally:
+        disable_profiling()
+    hot(1)
+    data = {d["text"]: d for d in profile_data()}
+    assert data["test71 hot"]["calls"] == 101 and data["test71 hot"]["failures"] == 1
+    assert data["test71 hot"]["func_name"] == "hot"
+    assert data["test71 cm"]["calls"] == 100 and data["test71 cm"]["failures"] == 0
+    assert all(d["self_seconds"] > 0 for d in data.values())
+    assert "test71 hot" in profile_report()
+    assert len(json.loads(profile_report(limit=1, as_json=True))) == 1
+
+
+def test72():
+    """
+    test72: check that observers are told about fragment events
+    """
+    set_narration_options(check=False, verbose=False)
+    reset_all_narrations()
+    events = []
+
+    def observer(event, fragment):
+        events.append((event, fragment.text_or_func))
+
+    def broken(event, fragment):
+        raise RuntimeError("observer bug")
+
+    @narrate("test72 outer")
+    def f1(fail):
+        with narrate_cm("test72 cm"):
+            f2(fail)
+
+    @narrate("test72 inner")
+    def f2(fail):
+        if fail:
+            raise KeyError()
+
+    reset_stats()
+    add_observer(observer)
+    add_observer(broken, events=["pop"])
+    try:
+        f1(False)
+        assert events == [("push", "test72 outer"), ("push", "test72 cm"),
+                          ("push", "test72 inner"), ("pop", "test72 inner"),
+                          ("pop", "test72 cm"), ("pop", "test72 outer")], f"got {events}"
+        assert stats()["observer_errors"] == 3
+        del events[:]
+        try:
+            f1(True)
+        except KeyError:
+            reset_narration()
+    finally:
+        remove_observer(observer)
+        remove_observer(broken)
+    assert [e for e, _ in events] == ["push", "push", "push", "raise", "format",
+                                      "passthru", "format", "passthru", "format"]
+    assert events[4][1].startswith("test72 inner, but"), f"got {events}"
+    del events[:]
+    f1(False)
+    assert events == []
+    try:
+        add_observer(observer, events=["nope"])
+    except ErratorException:
+        pass
+    else:
+        assert False, "unknown event accepted"
+
+
+def test73():
+    """
+    test73: check that fragment lifecycles are exported as spans
+    """
+    set_narration_options(check=False, verbose=False)
+    reset_all_narrations()
+    batches = []
+
+    @narrate("test73 outer")
+    def f1(fail):
+        with narrate_cm("test73 cm"):
+            f2(fail)
+
+    @narrate(lambda fail: "test73 inner {}".format(fail))
+    def f2(fail):
+        if fail:
+            raise KeyError("k")
+
+    with SpanExporter(batches.append, batch_size=2, flush_interval=0.05) as exporter:
+        f1(False)
+        try:
+            f1(True)
+        except KeyError:
+            reset_narration()
+        assert exporter.flush(timeout=5)
+    spans = [s for b in batches for s in b]
+    assert all(len(b) <= 2 for b in batches)
+    assert len(spans) == 6, f"got {spans}"
+    ok, failed = spans[:3], spans[3:]
+    assert [s["depth"] for s in ok] == [3, 2, 1]
+    assert [s["status"] for s in ok] == ["ok"] * 3
+    assert ok[0]["parent_id"] == ok[1]["span_id"]
+    assert ok[1]["parent_id"] == ok[2]["span_id"]
+    assert ok[2]["parent_id"] is None
+    assert [s["name"] for s in ok] == ["f2", "test73 cm", "f1"]
+    assert len({s["trace_id"] for s in ok}) == 1
+    assert failed[2]["trace_id"] != ok[2]["trace_id"]
+    assert all(s["end_ns"] >= s["start_ns"] for s in spans)
+    assert [s["status"] for s in failed] == ["error"] * 3
+    assert failed[0]["name"] == "f2"
+    assert failed[0]["text"].startswith("test73 inner True, but"), failed[0]["text"]
+    assert "KeyError" in failed[0]["exception"]
+    assert "exception" not in failed[1]
+    assert failed[1]["name"] == "test73 cm"
+    assert failed[2]["text"] == "test73 outer"
+    # once closed, nothing more is recorded
+    f1(False)
+    assert len([s for b in batches for s in b]) == 6
+
+    out = StringIO()
+    with SpanExporter(JsonlSpanBackend(out)) as exporter:
+        f2(False)
+    lines = out.getvalue().splitlines()
+    assert len(lines) == 1 and '"name":"f2"' in lines[0], lines
+
+
+def test74():
+    """
+    test74: check that the timing option adds elapsed time to failed fragments
+    """
+    set_narration_options(check=False, verbose=False, timing=True)
+    reset_all_narrations()
+
+    @narrate("test74 outer")
+    def f1():
+        with narrate_cm("test74 cm"):
+            f2()
+
+    @narrate(lambda: "test74 inner")
+    def f2():
+        time.sleep(0.02)
+        raise KeyError()
+
+    try:
+        try:
+            f1()
+        except KeyError:
+            fragments = copy_narration()
+            lines = get_narration()
+            record = narration_record(fragments)
+            lines_again = get_narration()
+            reset_narration()
+        assert len(lines) == 3, lines
+        assert all(" (took " in l for l in lines), lines
+        assert lines[2].startswith("test74 inner (took "), lines
+        assert lines[2].endswith("ms), but exception type: KeyError, value: '' was raised")
+        assert lines_again == lines, lines_again
+        assert all(f.elapsed_ns >= 20000000 for f in fragments)
+        assert all(f["elapsed"] >= 0.02 for f in record["fragments"]), record
+        assert record["fragments"][0]["text"] == lines[0]
+    finally:
+        set_narration_options(timing=False)
+    try:
+        f1()
+    except KeyError:
+        lines = get_narration()
+        reset_narration()
+    assert not any("took" in l for l in lines), lines
+
+
+def test75():
+    """
+    test75: check that the watchdog reports calls past their deadlines, once
+    """
+    set_narration_options(check=False, verbose=False)
+    reset_all_narrations()
+    reports = []
+    started = threading.Event()
+    release = threading.Event()
+
+    described = []
+
+    def describe(n):
+        described.append(threading.current_thread().name)
+        return "test75 outer {}".format(n)
+
+    @narrate(describe)
+    def slow(n):
+        with narrate_cm("test75 cm", deadline=0.01):
+            started.set()
+            release.wait(5)
+
+    @narrate("test75 quick", deadline=60)
+    def quick():
+        slow(1)
+
+    t = threading.Thread(target=quick, name="test75-thread")
+    enable_watchdog(callback=reports.append, interval=0.01)
+    try:
+        t.start()
+        assert started.wait(5)
+        deadline = time.time() + 5
+        while not reports and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        release.set()
+        t.join()
+    finally:
+        disable_watchdog()
+    assert len(reports) == 1, reports
+    record = reports[0]
+    assert record["thread"] == "test75-thread"
+    # the watchdog doesn't call another thread's callables; it gives their site instead
+    assert [f["text"] for f in record["fragments"]] == [
+        "test75 quick", "describe at line {}".format(describe.__code__.co_firstlineno),
+        "test75 cm"], record
+    assert described == []
+    assert record["overdue"] == 2
+    assert record["overdue_by"] > 0
+    # the narration of the overdue thread is undisturbed
+    assert find_overdue() == []
+    try:
+        narrate_cm("test75", deadline=0)
+    except ErratorException:
+        pass
+    else:
+        assert False, "zero deadline accepted"
+
+
+def test76():
+    """
+    test76: check that fragments returned to the pool don't keep arguments alive
+    """
+    import weakref
+    set_narration_options(check=False, verbose=False)
+    reset_all_narrations()
+
+    class Payload(object):
+        pass
+
+    @narrate(lambda p: "test76 {}".format(p))
+    def f(p):
+        with narrate_cm(lambda q: "test76 cm {}".format(q), p):
+            return 1
+
+    payload = Payload()
+    ref = weakref.ref(payload)
+    assert f(payload) == 1
+    del payload
+    assert ref() is None
+
+
+def test77():
+    """
+    test77: check that measure_overhead() times a workload with and without narration
+    """
+    import os
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, "test77_workload.py"), "w") as f:
+            f.write("from errator import narrate, narrate_cm\n"
+                    "@narrate('test77 site')\n"
+                    "def f(i):\n"
+                    "    with narrate_cm('test77 cm'):\n"
+                    "        return i\n"
+                    "def main():\n"
+                    "    for i in range(1000):\n"
+                    "        f(i)\n")
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            result = measure_overhead("test77_workload:main", repeat=2, warmup=0)
+        finally:
+            os.chdir(cwd)
+    assert result["narrated_seconds"] > result["passthru_seconds"] > 0, result
+    assert result["overhead_seconds"] > 0
+    sites = {d["text"]: d for d in result["sites"]}
+    assert sites["test77 site"]["calls"] == 1000, sites
+    assert sites["test77 cm"]["calls"] == 1000, sites
+    try:
+        measure_overhead("no_callable_given")
+    except ErratorException:
+        pass
+    else:
+        assert False, "bad target accepted"
+
+
+def test78():
+    """
+    test78: check that fragment pools are per thread and that another thread's narration
+    can be read while it's in progress without changing it
+    """
+    inside = threading.Event()
+    release = threading.Event()
+
+    @narrate(lambda n: "test78 worker {}".format(n))
+    def waiter(n):
+        inside.set()
+        release.wait(5)
+
+    @narrate("test78 churn")
+    def churn():
+        pass
+
+    worker = threading.Thread(target=waiter, args=(1,), name="test78-worker")
+    worker.start()
+    try:
+        assert inside.wait(5)
+        before = stats()["pool_sizes"]["NarrationFragment"]
+        for _ in range(10):
+            churn()
+        mine = _thread_fragments[threading.current_thread().name].pools
+        theirs = _thread_fragments["test78-worker"].pools
+        assert len(mine[NarrationFragment]) >= 1
+        assert not theirs[NarrationFragment]
+        assert stats()["pool_sizes"]["NarrationFragment"] >= before
+        for _ in range(2):
+            assert get_narration(thread=worker) == ["test78 worker 1"]
+        # the worker's own fragment is still unformatted
+        assert callable(_thread_fragments["test78-worker"][-1].text_or_func)
+    finally:
+        release.set()
+        worker.join()
+    d = set_default_options(check=True)
+    try:
+        assert d["check"] is True
+        assert ErratorDeque().check is True
+    finally:
+        set_default_options(check=False)
+        reset_all_narrations()
+    assert ErratorDeque().check is False
+
+
+def test79():
+    """
+    test79: check that an exception carries its narration to other threads and past
+    later narrated calls
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    reset_all_narrations()
+
+    @narrate(lambda x: "test79 outer {}".format(x))
+    def outer(x):
+        inner(x * 2)
+
+    @narrate("test79 inner", tags=["detail"])
+    def inner(y):
+        with narrate_cm(lambda v: "test79 cm {}".format(v), y):
+            raise ValueError("test79 {}".format(y))
+
+    with ThreadPoolExecutor(1) as pool:
+        future = pool.submit(outer, 1)
+        try:
+            future.result()
+            assert False, "expected ValueError"
+        except ValueError as e:
+            first = e
+    expected = ["test79 outer 1", "test79 inner",
+                "  test79 cm 2, but exception type: ValueError, value: 'test79 2' "
+                "was raised"]
+    assert narration_of(first) == expected, narration_of(first)
+    assert get_narration() == []
+
+    # another failure in this thread doesn't disturb the first exception's narration
+    try:
+        outer(5)
+    except ValueError as e:
+        second = e
+    assert "test79 outer 5" in get_narration()
+    assert narration_of(first) == expected
+    assert narration_of(second)[0] == "test79 outer 5"
+    assert narration_of(second, with_tags=["other"]) == ["test79 outer 5",
+                                                         narration_of(second)[2]]
+    reset_narration()
+
+    assert narration_of(ValueError("never narrated")) == []
+    narration_of(first, add_note=True)
+    narration_of(first, add_note=True)
+    assert first.__notes__ == ["\n".join(expected)]
+    if sys.version_info >= (3, 11):
+        assert "test79 inner" in "".join(traceback.format_exception(
+            type(first), first, first.__traceback__))
+
+
+def test80():
+    """
+    test80: check that get_narration(collapse=...) shortens runs of recursive calls without
+    formatting the fragments it leaves out
+    """
+    reset_all_narrations()
+
+    @narrate("test80 start")
+    def start():
+        walk(1)
+
+    @narrate(lambda n: "test80 walking {}".format(n))
+    def walk(n):
+        if n == 20:
+            with narrate_cm("test80 leaf"):
+                raise KeyError(n)
+        walk(n + 1)
+
+    try:
+        start()
+    except KeyError:
+        full = get_narration()
+        formatted = []
+
+        def count(event, fragment):
+            formatted.append(fragment)
+
+        add_observer(count, ["format"])
+        reset_stats()
+        try:
+            short = get_narration(collapse=3)
+        finally:
+            remove_observer(count)
+        assert len(formatted) == 4, formatted
+        # every format() is counted, not just those as the exception passed through
+        assert stats()["format_calls"] == 4, stats()
+        assert get_narration(collapse=30) == full
+        short_copy = narration_of(sys.exc_info()[1], collapse=3)
+    finally:
+        reset_narration()
+    assert len(full) == 22
+    assert short == [full[0], full[1], "...repeated 18 times (depth 3..20)...", full[20],
+                     full[21]], short
+    assert short_copy == short
+    assert full[20].startswith("test80 walking 20")
+    assert get_narration(collapse=3) == []
+
+
+def test81():
+    """
+    test81: check that tags are kept as bit masks and still read back as strings
+    """
+    import errator
+    reset_all_narrations()
+    a = errator._errator.tag_mask(["test81-a"])
+    b = errator._errator.tag_mask(("test81-b",))
+    assert a and b and not a & b
+    assert errator._errator.tag_mask(["test81-b", "test81-a"]) == a | b
+    assert errator._errator.tag_names(a | b) == frozenset(["test81-a", "test81-b"])
+
+    @narrate("test81 f", tags=["test81-a"])
+    def f():
+        with narrate_cm("test81 cm", tags=["test81-b", "test81-a"]):
+            raise KeyError()
+
+    try:
+        f()
+    except KeyError:
+        frags = copy_narration()
+        assert frags[0].tag_mask == a and frags[1].tag_mask == a | b
+        assert frags[1].tags == frozenset(["test81-a", "test81-b"])
+        assert len(get_narration(with_tags=["test81-b"])) == 1
+        assert len(get_narration(with_tags=frozenset(["test81-a"]))) == 2
+        assert get_narration(with_tags=["test81-unused"]) == []
+        assert len(get_narration(with_tags=[])) == 0
+        record = narration_record(frags)
+        assert record["fragments"][1]["tags"] == ["test81-a", "test81-b"]
+    finally:
+        reset_narration()
+    frag = NarrationFragment("test81", None)
+    frag.tags = ["test81-b"]
+    assert frag.tag_mask == b and frag.tags == frozenset(["test81-b"])
+
+
+def test82():
+    """
+    test82: check the from_here forms of get_narration(), copy_narration(),
+    narration_fingerprint() and reset_narration() against a long narration
+    """
+    import errator
+    reset_all_narrations()
+    d = _thread_fragments[threading.current_thread().name]
+    d.extend(NarrationFragment("test82 {}".format(i), None) for i in range(100000))
+    for text, status in (("test82 done", NarrationFragment.COMPLETED),
+                         ("test82 raised", NarrationFragment.RAISED_EXCEPTION)):
+        nf = NarrationFragment(text, None)
+        nf.status = status
+        d.append(nf)
+    try:
+        assert [f.text_or_func for f in errator._errator.fragments_from_here(d)] == \
+            ["test82 99999", "test82 done", "test82 raised"]
+        assert get_narration(from_here=True) == ["test82 99999", "test82 done",
+                                                 "test82 raised"]
+        assert [f.tell() for f in copy_narration(from_here=True)] == \
+            get_narration(from_here=True)
+        assert narration_fingerprint(from_here=True) != narration_fingerprint()
+        set_narration_options(auto_prune=True)
+        reset_narration(from_here=True)
+        assert len(d) == 100000 and d[-1].text_or_func == "test82 99999"
+        set_narration_options(auto_prune=False)
+        reset_narration(from_here=True)
+        assert len(d) == 99999
+        for f in d:
+            f.status = NarrationFragment.COMPLETED
+        assert get_narration(from_here=True) == []
+        reset_narration(from_here=True)
+        assert len(d) == 0
+    finally:
+        set_narration_options(auto_prune=True)
+        reset_narration()
+
+
+def test83():
+    """
+    test83: check that narration_scope() discards what's narrated within it and restores
+    the narration's options, including when nested
+    """
+    reset_all_narrations()
+    d = _thread_fragments[threading.current_thread().name]
+
+    @narrate(lambda n: "test83 task {}".format(n))
+    def task(n):
+        raise KeyError(n)
+
+    @narrate("test83 runner")
+    def runner():
+        with narration_scope(auto_prune=False, verbose=True):
+            assert d.auto_prune is False and d.verbose is True
+            try:
+                task(1)
+            except KeyError:
+                pass
+            assert len(d) == 2
+            with narration_scope(check=True):
+                assert d.check is True and d.auto_prune is False
+                try:
+                    task(2)
+                except KeyError:
+                    assert len(d) == 3
+            assert len(d) == 2 and d.check is False
+            raise ValueError("test83")
+
+    try:
+        runner()
+    except ValueError:
+        assert [s.split("\n")[0] for s in get_narration()] == \
+            ["test83 runner, but exception type: ValueError, value: 'test83' was raised"]
+    finally:
+        reset_narration()
+    assert d.auto_prune is True and d.verbose is False
+    d.pools.clear()
+    pooled = stats()["pool_sizes"]["NarrationFragment"]
+    with narration_scope():
+        d.append(NarrationFragment("test83 left over", None))
+        d.append(NarrationFragment("test83 left over", None))
+    assert len(d) == 0
+    assert stats()["pool_sizes"]["NarrationFragment"] == pooled + 2
+
+
+
+def test84():
+    """
+    test84: check that a thread's pool is capped and that a finished thread's pooled
+    fragments are released
+    """
+    import errator
+
+    @narrate(lambda n: "test84 depth {}".format(n))
+    def deep(n):
+        if n:
+            deep(n - 1)
+
+    d = _thread_fragments[threading.current_thread().name]
+    deep(errator._errator.POOL_LIMIT * 2)
+    assert len(d.pools[NarrationFragment]) == errator._errator.POOL_LIMIT
+
+    worker = threading.Thread(target=deep, args=(50,), name="test84-worker")
+    worker.start()
+    worker.join()
+    assert len(_thread_fragments["test84-worker"]) == 0
+    assert not _thread_fragments["test84-worker"].pools
+    # the worker counted its own fragments, and stats() includes them
+    assert _thread_fragments["test84-worker"].fragments_created == 51
+    assert _thread_fragments["test84-worker"].fragments_reused == 0
+    assert stats()["fragments_created"] >= 51
+    # a later thread of the same name releases its pools too
+    worker = threading.Thread(target=deep, args=(50,), name="test84-worker")
+    worker.start()
+    worker.join()
+    assert not _thread_fragments["test84-worker"].pools
+    del _thread_fragments["test84-worker"]
+
+
+def test85():
+    """
+    test85: check that narrate_cm() given a different string on each use is still one
+    call site, with the with statement's function and file
+    """
+    import errator
+
+    def failing(n):
+        with narrate_cm("test85 item {}".format(n)):
+            raise KeyError(n)
+
+    def sites():
+        return [site for site, _, _ in errator._errator.metrics_snapshot()["sites"]
+                if site[0] == "failing" and site[1] == __file__]
+
+    before = len(errator._errator._sites)
+    for n in range(100):
+        try:
+            failing(n)
+        except KeyError:
+            reset_narration()
+    assert len(errator._errator._sites) == before + 1
+    assert len(sites()) == 1 and sites()[0][2] == "test85 item 0"
+
+
+def test86():
+    """
+    test86: check that narration_of() has the narration of an exception raised below
+    stale fragments left by one that was handled
+    """
+    @narrate("test86 inner")
+    def inner():
+        raise KeyError("test86")
+
+    @narrate("test86 outer")
+    def outer():
+        try:
+            inner()
+        except KeyError:
+            pass
+        raise ValueError("test86")
+
+    reset_all_narrations()
+    try:
+        outer()
+    except ValueError as e:
+        told = narration_of(e)
+        # the handled failure's fragment is still in the narration, but not in the
+        # exception's
+        assert len(get_narration()) == 2
+        assert told == get_narration()[:1]
+        assert told[0].startswith("test86 outer")
+    finally:
+        reset_narration()
+
+
+def test87():
+    """
+    test87: check that narration fingerprints tell narrate_cm() sites apart, but not
+    different text given to the same site
+    """
+    def fail(which, n):
+        if which:
+            with narrate_cm("test87 reading {}".format(n)):
+                raise KeyError(n)
+        with narrate_cm(lambda n: "test87 writing {}".format(n), n):
+            raise KeyError(n)
+
+    def fingerprint(which, n):
+        try:
+            fail(which, n)
+        except KeyError:
+            fp = narration_fingerprint()
+            record = narration_record(copy_narration(), exception="KeyError")
+            assert record_fingerprint(record) == fp
+            return fp
+        finally:
+            reset_narration()
+
+    assert fingerprint(True, 1) == fingerprint(True, 2)
+    assert fingerprint(False, 1) == fingerprint(False, 2)
+    assert fingerprint(True, 1) != fingerprint(False, 1)
+
+
+def test88():
+    """
+    test88: check that copying a verbose narration doesn't walk the stack again
+    """
+    set_narration_options(verbose=True)
+    reset_all_narrations()
+    try:
+        with narrate_cm("test88 context"):
+            walks = stats()["stack_walks"]
+            copied = copy_narration()
+            assert stats()["stack_walks"] == walks
+            assert copied[0].func_name == "test88"
+            assert copied[0].source_file == __file__
+    finally:
+        set_narration_options(verbose=False)
+        reset_narration()
+
+
+def test89():
+    """
+    test89: check that partials, callable instances and closures made for each use share
+    one call site, and that the registry doesn't keep them alive
+    """
+    import errator
+    import functools
+    import weakref
+
+    def describe(n):
+        return "test89 partial {}".format(n)
+
+    class Describer(object):
+        def __call__(self):
+            return "test89 instance"
+
+    def fail_with(text_or_func):
+        try:
+            with narrate_cm(text_or_func):
+                raise KeyError("test89")
+        except KeyError:
+            reset_narration()
+
+    def decorate(n):
+        @narrate("test89 closure")
+        def closure():
+            return n
+        return closure
+
+    fail_with(functools.partial(describe, 0))
+    fail_with(Describer())
+    decorate(0)
+    before = len(errator._errator._sites)
+    refs = []
+    for n in range(100):
+        p = functools.partial(describe, n)
+        d = Describer()
+        refs.extend((weakref.ref(p), weakref.ref(d)))
+        fail_with(p)
+        fail_with(d)
+        assert decorate(n)() == n
+    del p, d
+    assert len(errator._errator._sites) == before
+    assert all(r() is None for r in refs)
+    # past the limit, new sites all share one
+    limit = errator._errator.SITE_LIMIT
+    errator._errator.SITE_LIMIT = len(errator._errator._sites)
+    try:
+        for n in range(3):
+            narrate("test89 overflow {}".format(n))(describe)
+        assert len(errator._errator._sites) == errator._errator.SITE_LIMIT + 1
+        assert errator._errator._sites[-1][2] == "<other sites>"
+    finally:
+        errator._errator.SITE_LIMIT = limit
+
+
+def test90():
+    """
+    test90: check that the narration of each of several exceptions handled in a loop,
+    without resetting the narration, has only its own fragments
+    """
+    @narrate(lambda n: "test90 inner {}".format(n))
+    def inner(n):
+        with narrate_cm("test90 step {}".format(n)):
+            raise KeyError(n)
+
+    @narrate("test90 outer")
+    def outer():
+        caught = []
+        for n in range(3):
+            try:
+                inner(n)
+            except KeyError as e:
+                caught.append(e)
+        return caught
+
+    reset_all_narrations()
+    try:
+        caught = outer()
+        for n, e in enumerate(caught):
+            told = narration_of(e)
+            assert len(told) == 3, told
+            assert told[0] == "test90 outer"
+            assert told[1].startswith("test90 inner {}".format(n)), told
+            assert told[2].strip().startswith("test90 step {}".format(n)), told
+    finally:
+        reset_narration()
+
+
+
+def test91():
+    """
+    test91: check that records added to a NarrationStore from several threads at once
+    are each stored once
+    """
+    import os
+    import tempfile
+
+    def add_many(store, n):
+        for i in range(200):
+            store.add({"time": time.time(), "thread": "test91-{}".format(n),
+                       "exception": "KeyError",
+                       "fragments": [{"text": "test91 {} {}".format(n, i),
+                                      "func_name": "add_many", "source_file": "tests.py",
+                                      "lineno": i, "status": 2, "tags": []}]})
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            store = NarrationStore(os.path.join(tmp, "narrations.db"), batch_size=7)
+            threads = [threading.Thread(target=add_many, args=(store, n))
+                       for n in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            store.flush()
+            texts = [r["fragments"][0]["text"] for r in store.query(limit=10000)]
+            store.close()
+    finally:
+        sys.setswitchinterval(interval)
+    assert len(texts) == 1600, len(texts)
+    assert len(set(texts)) == 1600
+
+
+
+def test92():
+    """
+    test92: check that tags past TAG_LIMIT are refused, while known ones still work
+    """
+    import errator
+    core = errator._errator
+
+    @narrate("test92 known", tags=["test92"])
+    def known():
+        pass
+
+    limit = core.TAG_LIMIT
+    core.TAG_LIMIT = len(core._tag_names)
+    try:
+        known()
+        assert get_narration(with_tags=["test92"]) == []
+        try:
+            narrate("test92 new", tags=["test92 new tag"])(lambda: None)
+        except ErratorException as e:
+            assert "test92 new tag" in str(e)
+        else:
+            assert False, "a tag past the limit was accepted"
+        assert "test92 new tag" not in core._tag_bits
+    finally:
+        core.TAG_LIMIT = limit
+
+
 def do_all():
     for k, v in sorted(globals().items()):
         if callable(v) and k.startswith("test"):